@@ -0,0 +1,143 @@
+# Copyright 2015 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import threading
+
+from jujubundlelib import (
+    changeset,
+    validation,
+)
+from jujubundlelib.typeutils import (
+    isdict,
+    islist,
+)
+
+
+class BundleCache(object):
+    """A LRU cache for bundle validation errors and change sets.
+
+    Results are keyed by a canonical hash of the YAML decoded bundle, so that
+    equal bundles share the same cache entries regardless of key ordering.
+    The cache holds at most max_entries results and, if max_bytes is not
+    None, at most max_bytes bytes of encoded results: least recently used
+    entries are evicted first.
+
+    Cached results are copied when retrieved, so that callers cannot modify
+    the cache contents. Instances can be shared between threads.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def validate(self, bundle):
+        """Return the validation errors for the given bundle.
+
+        See validation.validate().
+        """
+        key = ('validate', bundle_hash(bundle))
+        errors = self._get(key)
+        if errors is None:
+            errors = tuple(validation.validate(bundle))
+            self._set(key, errors, sum(len(error) for error in errors))
+        return list(errors)
+
+    def parse(self, bundle):
+        """Return the list of changes required to deploy the given bundle.
+
+        See changeset.parse(). The returned changes are deep copies of the
+        cached ones, and therefore never shared. The size of the cached
+        changes is approximated by the length of their JSON encoding.
+        """
+        key = ('parse', bundle_hash(bundle))
+        changes = self._get(key)
+        if changes is None:
+            changes = list(changeset.parse(bundle))
+            self._set(key, changes, _encoded_size(changes))
+        return copy.deepcopy(changes)
+
+    def clear(self):
+        """Remove all the cache entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.size = 0
+
+    def _get(self, key):
+        """Return the value stored for the given key, or None on misses."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # Mark the entry as the most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def _set(self, key, value, size):
+        """Store the given value, evicting old entries if required."""
+        if self.max_bytes is not None and size > self.max_bytes:
+            # The value would not fit in the cache anyway.
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self._entries and (
+                len(self._entries) > self.max_entries or
+                (self.max_bytes is not None and self.size > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+def bundle_hash(bundle):
+    """Return a canonical hash of the given YAML decoded bundle.
+
+    The hash does not depend on the ordering of mapping keys.
+    """
+    return hashlib.sha256(_canonical(bundle).encode('utf-8')).hexdigest()
+
+
+def _encoded_size(value):
+    """Return the length of the JSON encoding of the given value.
+
+    Values which are not JSON serializable, e.g. dates, are encoded using
+    their representation.
+    """
+    return len(json.dumps(value, default=repr))
+
+
+def _canonical(value):
+    """Return a string uniquely representing the given value."""
+    if isdict(value):
+        items = sorted(
+            '{}:{}'.format(_canonical(key), _canonical(item))
+            for key, item in value.items())
+        return '{{{}}}'.format(','.join(items))
+    if islist(value):
+        return '[{}]'.format(','.join(_canonical(item) for item in value))
+    try:
+        return json.dumps(value)
+    except TypeError:
+        # The value is not a JSON scalar, e.g. a date.
+        return repr(value)
@@ -7,12 +7,17 @@ from __future__ import (
 )
 
 
-import copy
+import array
+import collections
+from concurrent import futures
 import itertools
+import json
 
 from jujubundlelib import (
     models,
+    pyutils,
     utils,
+    validation,
 )
 
 
@@ -20,17 +25,83 @@ class ChangeSet(object):
     """Hold the state for parser handlers.
 
     Also expose methods to send and receive changes (usually Python dicts).
+    All the state is owned by the instance: a change set can be reused to
+    parse several bundles by calling reset().
+
+    If a sink callable is set, changes are passed to it as soon as they are
+    sent, rather than being stored.
+
+    If a model is provided, only the changes required to bring that model to
+    the state described by the bundle are generated: see parse() for a
+    description of the model.
+
+    Bundle components are parsed using the given models.ParseCache, or a new
+    one if not provided.
+
+    If int_ids is True, change ids are integers and changes refer to each
+    other using Placeholder instances: see render().
+    If stable_ids is True, change ids are derived from the entities changes
+    act on, like "deploy-wordpress" or "addUnit-wordpress/3", rather than
+    from the position of changes in the change set.
+    If compact is True, changes are stored as Change instances as soon as
+    they are sent.
     """
-    services_added = {}
-    machines_added = {}
 
-    def __init__(self, bundle):
+    def __init__(
+            self, bundle, sink=None, model=None, parse_cache=None,
+            int_ids=False, stable_ids=False, compact=False):
+        self.sink = sink
+        self.compact = compact
+        self.set_ids(int_ids=int_ids, stable_ids=stable_ids)
+        self.reset(bundle, model=model, parse_cache=parse_cache)
+
+    def set_ids(self, int_ids=False, stable_ids=False):
+        """Set the scheme used for change ids.
+
+        Raise a ValueError if both integer and stable ids are requested.
+        """
+        if int_ids and stable_ids:
+            raise ValueError(
+                b'integer ids and stable ids are mutually exclusive')
+        self.int_ids = int_ids
+        self.stable_ids = stable_ids
+
+    def reset(self, bundle, model=None, parse_cache=None):
+        """Discard the state collected so far and prepare to parse a bundle.
+
+        This allows long-running processes to pool and reuse change sets.
+        """
         self.bundle = bundle
+        if parse_cache is None:
+            parse_cache = models.ParseCache()
+        self.parse_cache = parse_cache
+        self.services_added = {}
+        self.machines_added = {}
         self._changeset = []
         self._counter = itertools.count()
+        # Index the entities already present in the model.
+        model = model or {}
+        self.existing_services = dict(
+            (name, service or {})
+            for name, service in model.get('services', {}).items())
+        self.existing_machines = dict(
+            (str(name), machine or {})
+            for name, machine in model.get('machines', {}).items())
+        self.existing_relations = [
+            [models.parse_endpoint(endpoint) for endpoint in relation]
+            for relation in model.get('relations', [])]
 
     def send(self, change):
-        """Store a change in this change set."""
+        """Store a change in this change set, or pass it to the sink.
+
+        Change dicts are converted to Change instances if the change set is
+        compact.
+        """
+        if self.compact:
+            change = Change.from_dict(change)
+        if self.sink is not None:
+            self.sink(change)
+            return
         self._changeset.append(change)
 
     def recv(self):
@@ -46,148 +117,347 @@ class ChangeSet(object):
         """Return an incremental integer to be included in the changes ids."""
         return next(self._counter)
 
+    def new_id(self, method, key):
+        """Return the id of a new change with the given method.
+
+        The key identifies the entity the change acts on, and it is used in
+        place of the action number when using stable ids.
+        """
+        action = self.next_action()
+        if self.stable_ids:
+            return '{}-{}'.format(method, key)
+        return self.make_id(method, action)
+
+    def make_id(self, method, action):
+        """Return the id of the change with the given method and action."""
+        if self.int_ids:
+            return action
+        return '{}-{}'.format(method, action)
+
+    def placeholder(self, method, record_id):
+        """Return the placeholder referring to the result of a change."""
+        if self.int_ids:
+            return Placeholder(method, record_id)
+        return '${}'.format(record_id)
+
+    def next_actions(self, count):
+        """Reserve the given number of consecutive actions.
+
+        Return the first reserved action.
+        """
+        action = next(self._counter)
+        self._counter = itertools.count(action + count)
+        return action
+
     def is_legacy_bundle(self):
         """Report whether the bundle uses the legacy (version 3) syntax."""
         return utils.is_legacy_bundle(self.bundle)
 
 
+# Map method names to their canonical instance, so that compact changes share
+# the same method strings.
+_methods = {}
+
+
+class Change(object):
+    """A compact representation of a single change.
+
+    Changes are usually represented as dicts including the id, method, args
+    and requires keys. Instances of this class hold the same information
+    using less memory: method names are shared, and args and requires are
+    stored as tuples. Use to_dict() and to_json() to retrieve the usual
+    representation when required.
+    """
+
+    __slots__ = ('id', 'method', 'args', 'requires')
+
+    def __init__(self, id, method, args, requires):
+        self.id = id
+        self.method = _methods.setdefault(method, method)
+        self.args = tuple(args)
+        self.requires = tuple(requires)
+
+    @classmethod
+    def from_dict(cls, change):
+        """Create and return a compact change from the given change dict."""
+        return cls(
+            change['id'], change['method'], change['args'],
+            change['requires'])
+
+    def to_dict(self):
+        """Return this change as a dict."""
+        return {
+            'id': self.id,
+            'method': self.method,
+            'args': list(self.args),
+            'requires': list(self.requires),
+        }
+
+    def to_json(self):
+        """Return this change as a JSON encoded string.
+
+        Raise a ValueError if the change has an integer id: such changes must
+        be converted with render() first.
+        """
+        if isinstance(self.id, int):
+            raise ValueError(
+                b'changes with integer ids cannot be encoded: use render()')
+        return json.dumps(self.to_dict())
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, self.__class__) and
+            self.id == other.id and
+            self.method == other.method and
+            self.args == other.args and
+            self.requires == other.requires
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<Change {}: {}{} requires {}>'.format(
+            self.id, self.method, self.args, self.requires)
+
+
+@pyutils.string_class
+class Placeholder(object):
+    """A reference to the result of a change with an integer id.
+
+    Placeholders are used in the arguments of changes generated with integer
+    ids, and are rendered as the usual placeholder strings, like
+    "$deploy-1" or "$deploy-1:db" if an interface is specified.
+    """
+
+    __slots__ = ('method', 'id', 'interface')
+
+    def __init__(self, method, id, interface=''):
+        self.method = _methods.setdefault(method, method)
+        self.id = id
+        self.interface = interface
+
+    def __str__(self):
+        placeholder = '${}-{}'.format(self.method, self.id)
+        if self.interface:
+            placeholder += ':{}'.format(self.interface)
+        return placeholder
+
+    def __repr__(self):
+        return '<Placeholder: {}>'.format(self)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, self.__class__) and
+            self.method == other.method and
+            self.id == other.id and
+            self.interface == other.interface
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.method, self.id, self.interface))
+
+
 def handle_services(changeset):
     """Populate the change set with addCharm and deploy changes."""
+    for change in _services_changes(changeset):
+        changeset.send(change)
+    return handle_machines
+
+
+def _services_changes(changeset):
+    """Yield addCharm, deploy, expose and service setAnnotations changes."""
     charms = {}
     for service_name, service in sorted(changeset.bundle['services'].items()):
-        # Add the addCharm record if one hasn't been added yet.
-        if service['charm'] not in charms:
-            record_id = 'addCharm-{}'.format(changeset.next_action())
-            changeset.send({
+        existing = changeset.existing_services.get(service_name)
+        if existing is None:
+            # Add the addCharm record if one hasn't been added yet.
+            charm_id = _charm_id(changeset, service['charm'])
+            if charm_id not in charms:
+                # Colons separate interfaces in placeholders.
+                record_id = changeset.new_id(
+                    'addCharm', charm_id.replace(':', '/'))
+                yield {
+                    'id': record_id,
+                    'method': 'addCharm',
+                    'args': [service['charm']],
+                    'requires': [],
+                }
+                charms[charm_id] = record_id
+
+            # Add the deploy record for this service.
+            record_id = changeset.new_id('deploy', service_name)
+            changeset.services_added[service_name] = record_id
+            yield {
                 'id': record_id,
-                'method': 'addCharm',
-                'args': [service['charm']],
-                'requires': [],
-            })
-            charms[service['charm']] = record_id
-
-        # Add the deploy record for this service.
-        record_id = 'deploy-{}'.format(changeset.next_action())
-        changeset.send({
-            'id': record_id,
-            'method': 'deploy',
-            'args': [
-                '${}'.format(charms[service['charm']]),
-                service_name,
-                service.get('options', {}),
-                service.get('constraints', ''),
-                service.get('storage', {}),
-            ],
-            'requires': [charms[service['charm']]],
-        })
-        changeset.services_added[service_name] = record_id
+                'method': 'deploy',
+                'args': [
+                    changeset.placeholder('addCharm', charms[charm_id]),
+                    service_name,
+                    service.get('options', {}),
+                    service.get('constraints', ''),
+                    service.get('storage', {}),
+                ],
+                'requires': [charms[charm_id]],
+            }
+        service_arg, requires = _service_reference(changeset, service_name)
 
         # Expose this service if required.
-        if service.get('expose'):
-            changeset.send({
-                'id': 'expose-{}'.format(changeset.next_action()),
+        if service.get('expose') and not (existing or {}).get('expose'):
+            yield {
+                'id': changeset.new_id('expose', service_name),
                 'method': 'expose',
-                'args': ['${}'.format(record_id)],
-                'requires': [record_id],
-            })
+                'args': [service_arg],
+                'requires': list(requires),
+            }
 
         # Set the annotations for this service.
         if 'annotations' in service:
-            changeset.send({
-                'id': 'setAnnotations-{}'.format(changeset.next_action()),
-                'method': 'setAnnotations',
-                'args': [
-                    '${}'.format(record_id),
-                    'service',
-                    service['annotations'],
-                ],
-                'requires': [record_id],
-            })
+            annotations = _annotations_to_set(service, existing)
+            if annotations is not None:
+                yield {
+                    'id': changeset.new_id('setAnnotations', service_name),
+                    'method': 'setAnnotations',
+                    'args': [service_arg, 'service', annotations],
+                    'requires': list(requires),
+                }
 
-    return handle_machines
+
+def _charm_id(changeset, charm):
+    """Return the canonical id of the given charm URL.
+
+    Equivalent URLs, like "cs:trusty/django-42" and "trusty/django-42",
+    share the same id. Charms not identified by a valid URL, like local charm
+    paths, are identified by the given string.
+    """
+    try:
+        return changeset.parse_cache.reference(charm.strip()).id()
+    except ValueError:
+        return charm
 
 
 def handle_machines(changeset):
     """Populate the change set with addMachines changes."""
+    for change in _machines_changes(changeset):
+        changeset.send(change)
+    return handle_relations
+
+
+def _machines_changes(changeset):
+    """Yield addMachines and machine setAnnotations changes."""
     machines = sorted(changeset.bundle.get('machines', {}).items())
     for machine_name, machine in machines:
         if machine is None:
             # We allow the machine value to be unset in the YAML.
             machine = {}
-        record_id = 'addMachines-{}'.format(changeset.next_action())
-        changeset.send({
-            'id': record_id,
-            'method': 'addMachines',
-            'args': [
-                {
-                    'series': machine.get('series', ''),
-                    'constraints': machine.get('constraints', ''),
-                },
-            ],
-            'requires': [],
-        })
-        changeset.machines_added[str(machine_name)] = record_id
-        if 'annotations' in machine:
-            changeset.send({
-                'id': 'setAnnotations-{}'.format(changeset.next_action()),
-                'method': 'setAnnotations',
+        machine_name = str(machine_name)
+        existing = changeset.existing_machines.get(machine_name)
+        if existing is None:
+            record_id = changeset.new_id('addMachines', machine_name)
+            changeset.machines_added[machine_name] = record_id
+            yield {
+                'id': record_id,
+                'method': 'addMachines',
                 'args': [
-                    '${}'.format(record_id),
-                    'machine',
-                    machine['annotations'],
+                    {
+                        'series': machine.get('series', ''),
+                        'constraints': machine.get('constraints', ''),
+                    },
                 ],
-                'requires': [record_id],
-            })
-    return handle_relations
+                'requires': [],
+            }
+        if 'annotations' in machine:
+            annotations = _annotations_to_set(machine, existing)
+            if annotations is not None:
+                machine_arg, requires = _machine_reference(
+                    changeset, machine_name)
+                yield {
+                    'id': changeset.new_id('setAnnotations', machine_name),
+                    'method': 'setAnnotations',
+                    'args': [machine_arg, 'machine', annotations],
+                    'requires': list(requires),
+                }
 
 
 def handle_relations(changeset):
     """Populate the change set with addRelation changes."""
+    for change in _relations_changes(changeset):
+        changeset.send(change)
+    return handle_units
+
+
+def _relations_changes(changeset):
+    """Yield addRelation changes.
+
+    When using stable ids, repeated relations are given ids with an
+    occurrence suffix, like "addRelation-django,mysql#1", so that ids are
+    unique.
+    """
+    # Map relation keys to the number of times they have been found.
+    occurrences = {}
     for relation in changeset.bundle.get('relations', []):
-        relations = [models.Relation(*i.split(':')) if ':' in i
-                     else models.Relation(i, '') for i in relation]
-        changeset.send({
-            'id': 'addRelation-{}'.format(changeset.next_action()),
+        endpoints = [
+            changeset.parse_cache.endpoint(endpoint) for endpoint in relation]
+        if _relation_exists(changeset, endpoints):
+            continue
+        args, requires, keys = [], [], []
+        for endpoint in endpoints:
+            service_arg, service_requires = _service_reference(
+                changeset, endpoint.name)
+            if endpoint.interface:
+                if isinstance(service_arg, Placeholder):
+                    service_arg = Placeholder(
+                        service_arg.method, service_arg.id, endpoint.interface)
+                else:
+                    service_arg += ':{}'.format(endpoint.interface)
+                keys.append('{}:{}'.format(*endpoint))
+            else:
+                keys.append(endpoint.name)
+            args.append(service_arg)
+            requires.extend(service_requires)
+        key = ','.join(keys)
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        if occurrence:
+            key = '{}#{}'.format(key, occurrence)
+        yield {
+            'id': changeset.new_id('addRelation', key),
             'method': 'addRelation',
-            'args': [
-                '${}'.format(
-                    changeset.services_added[rel.name]) +
-                (':{}'.format(rel.interface) if rel.interface else '')
-                for rel in relations
-            ],
-            'requires': [changeset.services_added[rel.name] for
-                         rel in relations],
-        })
-    return handle_units
+            'args': args,
+            'requires': requires,
+        }
 
 
 def handle_units(changeset):
     """Populate the change set with addUnit changes."""
-    units, records = {}, {}
-    for service_name, service in sorted(changeset.bundle['services'].items()):
-        for i in range(service.get('num_units', 0)):
-            record_id = 'addUnit-{}'.format(changeset.next_action())
-            unit_name = '{}/{}'.format(service_name, i)
-            records[record_id] = {
-                'id': record_id,
-                'method': 'addUnit',
-                'args': [
-                    '${}'.format(changeset.services_added[service_name]),
-                    None,
-                ],
-                'requires': [changeset.services_added[service_name]],
-            }
-            units[unit_name] = {
-                'record': record_id,
-                'service': service_name,
-                'unit': i,
-            }
-    _handle_units_placement(changeset, units, records)
+    for change in _units_changes(changeset):
+        changeset.send(change)
 
 
-def _handle_units_placement(changeset, units, records):
-    """Ensure that requires and placement directives are taken into account."""
-    for service_name, service in sorted(changeset.bundle['services'].items()):
+def _units_changes(changeset, skip=0):
+    """Yield addUnit changes, preceded by the machines they are placed on.
+
+    Only a constant amount of state is kept for each service, so that memory
+    usage does not depend on the number of units.
+
+    The first skip changes are not yielded: changes for new units are
+    skipped without building them, both for units with their own placement
+    directive and for runs of units sharing the same placement.
+    """
+    services = sorted(changeset.bundle['services'].items())
+    # Reserve the ids of all the new units up front, so that units can be
+    # placed on units belonging to services which are handled later.
+    first_units = {}
+    for service_name, service in services:
+        num_new_units = (
+            service.get('num_units', 0) -
+            _num_existing_units(changeset, service_name))
+        first_units[service_name] = changeset.next_actions(
+            max(num_new_units, 0))
+    for service_name, service in services:
         num_units = service.get('num_units')
         if num_units is None:
             # This is a subordinate service.
@@ -195,66 +465,160 @@ def _handle_units_placement(changeset, units, records):
         placement_directives = service.get('to', [])
         if not isinstance(placement_directives, (list, tuple)):
             placement_directives = [placement_directives]
-        if placement_directives and not changeset.is_legacy_bundle():
-            placement_directives += (
-                placement_directives[-1:] *
-                (num_units - len(placement_directives)))
+        num_directives = len(placement_directives)
+        num_existing_units = _num_existing_units(changeset, service_name)
+        service_arg, requires = _service_reference(changeset, service_name)
         placed_in_services = {}
-        for i in range(num_units):
-            unit = units['{}/{}'.format(service_name, i)]
-            record = records[unit['record']]
-            if i < len(placement_directives):
-                record = _handle_unit_placement(
-                    changeset, units, unit, record, placement_directives[i],
-                    placed_in_services)
-            changeset.send(record)
-
-
-def _handle_unit_placement(
-        changeset, units, unit, record, placement_directive,
-        placed_in_services):
-    record = copy.deepcopy(record)
-    if changeset.is_legacy_bundle():
-        placement = models.parse_v3_unit_placement(placement_directive)
+        i = 0
+        while i < num_units:
+            if i < num_directives:
+                placement_directive = placement_directives[i]
+            elif num_directives and not changeset.is_legacy_bundle():
+                # In version 4 bundles, the last placement directive applies
+                # to all the remaining units.
+                placement_directive = placement_directives[-1]
+            else:
+                placement_directive = None
+            placement = None
+            if placement_directive is not None:
+                placement = _parse_placement(changeset, placement_directive)
+            # Past the placement directives, all the remaining units share
+            # the same placement and can be skipped at once.
+            shared = i >= num_directives
+            if i < num_existing_units:
+                # Units already in the model: just keep track of the units
+                # they are placed on.
+                count = num_existing_units - i if shared else 1
+                _skip_units(changeset, placement, placed_in_services, 0, count)
+                i += count
+                continue
+            num_machines = _num_placement_machines(changeset, placement)
+            num_changes = num_machines + 1
+            count = skip // num_changes
+            if count:
+                count = min(num_units - i, count) if shared else 1
+                _check_placed_units(
+                    changeset, placement, placed_in_services, count)
+                _skip_units(
+                    changeset, placement, placed_in_services,
+                    count * num_machines, count)
+                skip -= count * num_changes
+                i += count
+                continue
+            # Build each record only once, including its placement.
+            record = {
+                'id': _unit_record_id(
+                    changeset, first_units, service_name, i),
+                'method': 'addUnit',
+                'args': [service_arg, None],
+                'requires': list(requires),
+            }
+            changes = []
+            if placement is not None:
+                changes.extend(_unit_placement_changes(
+                    changeset, record, first_units, placement,
+                    placed_in_services, '{}/{}'.format(service_name, i)))
+            changes.append(record)
+            for change in changes:
+                if skip:
+                    skip -= 1
+                    continue
+                yield change
+            i += 1
+
+
+def _skip_units(
+        changeset, placement, placed_in_services, num_machines, num_units):
+    """Update the parser state as if units with the given placement were
+    added, along with the given number of machines.
+    """
+    changeset.next_actions(num_machines)
+    if placement is not None and placement.service:
+        if placement.unit is None:
+            current = placed_in_services.get(placement.service, -1)
+            placed_in_services[placement.service] = current + num_units
+
+
+def _check_placed_units(changeset, placement, placed_in_services, num_units):
+    """Check the units hosting the given number of skipped units.
+
+    Raise a ValueError, as if the units were added, if the placement refers
+    to units that do not exist.
+    """
+    if placement is None or not placement.service:
+        return
+    if placement.unit is not None:
+        first = last = placement.unit
     else:
-        placement = models.parse_v4_unit_placement(placement_directive)
+        first = placed_in_services.get(placement.service, -1) + 1
+        last = first + num_units - 1
+    _check_units(changeset, placement.service, first, last)
+
+
+def _num_placement_machines(changeset, placement):
+    """Return the number of machines created to place a unit."""
+    if placement is None:
+        return 0
+    new_machine, container_type = _placement_summary(changeset, placement)
+    return int(new_machine or container_type is not None)
+
+
+def _parse_placement(changeset, placement_directive):
+    """Return the UnitPlacement for the given placement directive."""
+    return changeset.parse_cache.placement(
+        placement_directive, changeset.is_legacy_bundle())
+
+
+def _unit_placement_changes(
+        changeset, record, first_units, placement, placed_in_services,
+        unit_name):
+    """Yield the changes required to place the unit in the given record.
+
+    Receive a dict mapping service names to the action number of their first
+    new unit, the unit placement, a dict mapping service names to the
+    current number of placed units in that service and the name of the unit.
+
+    Also update the record placement argument and requirements.
+    """
     if placement.machine:
         # The unit is placed on a machine.
         if placement.machine == 'new':
-            parent_record_id = 'addMachines-{}'.format(changeset.next_action())
+            parent_record_id = changeset.new_id('addMachines', unit_name)
             options = {}
             if placement.container_type:
                 options = {
                     'containerType': _lxd_to_lxc(placement.container_type)
                 }
-            changeset.send({
+            yield {
                 'id': parent_record_id,
                 'method': 'addMachines',
                 'args': [options],
                 'requires': [],
-            })
+            }
+            parent_arg = changeset.placeholder('addMachines', parent_record_id)
+            parent_requires = [parent_record_id]
         else:
             if changeset.is_legacy_bundle():
                 record['args'][-1] = '0'
-                return record
-            parent_record_id = changeset.machines_added[placement.machine]
-            if placement.container_type:
-                parent_record_id = _handle_container_placement(
-                    changeset, placement, parent_record_id)
+                return
+            parent_arg, parent_requires = _machine_reference(
+                changeset, placement.machine)
     else:
         # The unit is placed to a unit or to a service.
         service = placement.service
         unit_number = placement.unit
         if unit_number is None:
             unit_number = _next_unit_in_service(service, placed_in_services)
-        placement_unit = '{}/{}'.format(service, unit_number)
-        parent_record_id = units[placement_unit]['record']
-        if placement.container_type:
-                parent_record_id = _handle_container_placement(
-                    changeset, placement, parent_record_id)
-    record['requires'].append(parent_record_id)
-    record['args'][-1] = '${}'.format(parent_record_id)
-    return record
+        parent_arg, parent_requires = _unit_reference(
+            changeset, first_units, service, unit_number)
+    if placement.container_type and placement.machine != 'new':
+        container = _container_record(
+            changeset, placement, parent_arg, parent_requires, unit_name)
+        yield container
+        parent_arg = changeset.placeholder('addMachines', container['id'])
+        parent_requires = [container['id']]
+    record['requires'].extend(parent_requires)
+    record['args'][-1] = parent_arg
 
 
 def _next_unit_in_service(service, placed_in_services):
@@ -269,34 +633,1051 @@ def _next_unit_in_service(service, placed_in_services):
     return number
 
 
-def _handle_container_placement(changeset, placement, machine_record_id):
-    container_record_id = 'addMachines-{}'.format(changeset.next_action())
-    options = {
-        'containerType': _lxd_to_lxc(placement.container_type),
-        'parentId': '${}'.format(machine_record_id),
-    }
-    changeset.send({
-        'id': container_record_id,
+def _container_record(
+        changeset, placement, parent_arg, parent_requires, unit_name):
+    """Return the addMachines change creating a container for a unit."""
+    return {
+        'id': changeset.new_id('addMachines', unit_name),
         'method': 'addMachines',
-        'args': [options],
-        'requires': [machine_record_id],
-    })
-    return container_record_id
+        'args': [{
+            'containerType': _lxd_to_lxc(placement.container_type),
+            'parentId': parent_arg,
+        }],
+        'requires': list(parent_requires),
+    }
+
+
+def _service_reference(changeset, service_name):
+    """Return the argument and requirements referring to the given service.
+
+    Services already in the model are referred to by name, new services by
+    the placeholder of their deploy change.
+    """
+    if service_name in changeset.existing_services:
+        return service_name, []
+    record_id = changeset.services_added[service_name]
+    return changeset.placeholder('deploy', record_id), [record_id]
+
+
+def _machine_reference(changeset, machine_name):
+    """Return the argument and requirements referring to the given machine.
+
+    Machines already in the model are referred to by their model id, which
+    defaults to the bundle machine name, new machines by the placeholder of
+    their addMachines change.
+    """
+    existing = changeset.existing_machines.get(machine_name)
+    if existing is not None:
+        return str(existing.get('id', machine_name)), []
+    record_id = changeset.machines_added[machine_name]
+    return changeset.placeholder('addMachines', record_id), [record_id]
+
+
+def _unit_reference(changeset, first_units, service_name, number):
+    """Return the argument and requirements referring to the given unit.
+
+    Units already in the model are referred to by name, new units by the
+    placeholder of their addUnit change.
+    Raise a ValueError if the service does not have the given unit.
+    """
+    _check_units(changeset, service_name, number, number)
+    if number < _num_existing_units(changeset, service_name):
+        return '{}/{}'.format(service_name, number), []
+    record_id = _unit_record_id(changeset, first_units, service_name, number)
+    return changeset.placeholder('addUnit', record_id), [record_id]
+
+
+def _check_units(changeset, service_name, first, last):
+    """Check that the service has all the units from first to last.
+
+    Raise a ValueError referring to the first non-existent unit otherwise.
+    """
+    service = changeset.bundle['services'].get(service_name) or {}
+    num_units = max(
+        service.get('num_units') or 0,
+        _num_existing_units(changeset, service_name))
+    if last >= num_units:
+        msg = 'placement refers to non-existent unit {}/{}'.format(
+            service_name, max(first, num_units))
+        raise ValueError(msg.encode('utf-8'))
+
+
+def _unit_record_id(changeset, first_units, service_name, number):
+    """Return the id of the addUnit change for the given new unit."""
+    if changeset.stable_ids:
+        return 'addUnit-{}/{}'.format(service_name, number)
+    return changeset.make_id('addUnit', (
+        first_units[service_name] + number -
+        _num_existing_units(changeset, service_name)))
+
+
+def _num_existing_units(changeset, service_name):
+    """Return the number of units of the given service already in the model.
+    """
+    existing = changeset.existing_services.get(service_name)
+    if existing is None:
+        return 0
+    return existing.get('num_units', 0)
+
+
+def _annotations_to_set(entity, existing):
+    """Return the annotations to be set on a service or machine.
+
+    Receive the bundle entity and the corresponding entity in the model, or
+    None if the entity is new. Return None if there are no annotations to
+    set, as the existing ones already match.
+    """
+    annotations = entity['annotations']
+    if existing is None:
+        return annotations
+    current = existing.get('annotations') or {}
+    missing = dict(
+        (key, value) for key, value in annotations.items()
+        if key not in current or current[key] != value)
+    return missing or None
+
+
+def _relation_exists(changeset, endpoints):
+    """Report whether a relation between the given endpoints is in the model.
+
+    Endpoints without an interface match any interface.
+    """
+    def match(endpoint, other):
+        return endpoint.name == other.name and (
+            not endpoint.interface or not other.interface or
+            endpoint.interface == other.interface)
+
+    for existing in changeset.existing_relations:
+        if len(existing) != len(endpoints):
+            continue
+        for candidate in (existing, existing[::-1]):
+            if all(map(match, candidate, endpoints)):
+                return True
+    return False
 
 
 def _lxd_to_lxc(container_type):
     return 'lxc' if container_type == 'lxd' else container_type
 
 
-def parse(bundle, handler=handle_services):
+def parse(
+        bundle, handler=handle_services, changeset=None, compact=False,
+        model=None, minimal_requires=False, int_ids=False, stable_ids=False):
     """Return a generator yielding changes required to deploy the given bundle.
 
     The bundle argument is a YAML decoded Python dict.
+    If a change set is provided, it is reset and reused to hold the parser
+    state, otherwise a new one is created.
+    If compact is True, yield Change instances rather than dicts.
+    If minimal_requires is True, requirements already implied by other
+    requirements are omitted: see reduce_requires().
+    If int_ids is True, changes have integer ids, and refer to other changes
+    using Placeholder instances rather than strings: use render() to retrieve
+    the usual string based changes. render() must be called before passing
+    the changes to collapse_units(), expand_units(), collapse_machines() or
+    fuse_changes(), or before calling Change.to_json().
+    If stable_ids is True, change ids are derived from the entities changes
+    act on, so that ids are preserved when the bundle is edited: for
+    instance, a service is deployed by "deploy-wordpress", its units are
+    added by "addUnit-wordpress/0", "addUnit-wordpress/1" and so on, and
+    machines created to host a unit have ids like "addMachines-wordpress/1".
+    Integer and stable ids cannot be used together.
+
+    The optional model describes the entities already present in the model
+    the bundle is deployed to, as a dict with the following keys, all of them
+    optional:
+    - services: a dict mapping service names to dicts with the num_units,
+      expose and annotations keys;
+    - machines: a dict mapping bundle machine ids to dicts describing the
+      existing machines, with the id (the model machine id, defaulting to the
+      bundle one) and annotations keys;
+    - relations: a list of relations, using the bundle format.
+    Only the changes missing from the model are generated, and entities
+    already in the model are referred to by name rather than by placeholder.
+    Note that existing services are not upgraded or reconfigured.
+
+    Note that changes are collected by each handler before being yielded:
+    use stream() to retrieve changes as soon as they are produced.
     """
-    changeset = ChangeSet(bundle)
+    changeset = _prepare_changeset(
+        bundle, changeset, model, int_ids=int_ids, stable_ids=stable_ids,
+        compact=compact)
+    ancestors = {}
     while True:
+        units = changeset if handler is handle_units else None
         handler = handler(changeset)
-        for change in changeset.recv():
+        changes = changeset.recv()
+        if minimal_requires:
+            changes = _reduced_changes(changes, ancestors, units=units)
+        for change in changes:
             yield change
         if handler is None:
             break
+
+
+def stream(
+        bundle, changeset=None, compact=False, model=None,
+        minimal_requires=False, int_ids=False, stable_ids=False):
+    """Return a generator yielding changes as soon as they are produced.
+
+    Changes are the same and in the same order as the ones returned by
+    parse(), but they are never collected: memory usage depends on the number
+    of services and machines in the bundle, not on the number of units.
+    When minimal_requires is True, the units of services hosting units of
+    other services are also tracked, as later units may require them.
+    If a change set is provided, it is reset and reused.
+    If compact is True, yield Change instances rather than dicts.
+    See parse() for a description of the optional model and of the
+    minimal_requires, int_ids and stable_ids flags.
+    """
+    changeset = _prepare_changeset(
+        bundle, changeset, model, int_ids=int_ids, stable_ids=stable_ids)
+    if minimal_requires:
+        changes = _reduced_phases(changeset)
+    else:
+        changes = _changes(changeset)
+    if compact:
+        changes = (Change.from_dict(change) for change in changes)
+    for change in changes:
+        yield change
+
+
+def stream_to(
+        bundle, sink, handler=handle_services, changeset=None, model=None):
+    """Send the changes required to deploy the given bundle to a sink.
+
+    The sink is a callable receiving each change as soon as it is produced.
+    This avoids collecting changes and the overhead of iterating over a
+    generator. If a change set is provided, it is reset and reused.
+    See parse() for a description of the optional model.
+    """
+    changeset = _prepare_changeset(bundle, changeset, model)
+    changeset.sink = sink
+    try:
+        while handler is not None:
+            handler = handler(changeset)
+    finally:
+        changeset.sink = None
+
+
+def validate_and_parse(bundle):
+    """Validate the given bundle and return its changes if it is valid.
+
+    The bundle components are parsed only once, and used both for validation
+    and change set generation.
+
+    Return a tuple (errors, changes). If the bundle is not valid, errors is
+    the list of validation errors and changes is None. Otherwise errors is an
+    empty list and changes is the list of changes as returned by parse().
+    """
+    parse_cache = models.ParseCache()
+    errors = validation.validate(bundle, parse_cache=parse_cache)
+    if errors:
+        return errors, None
+    changeset = ChangeSet(bundle, parse_cache=parse_cache)
+    return [], list(_changes(changeset))
+
+
+# Define a tuple holding the summary of the changes required to deploy a
+# bundle.
+Summary = collections.namedtuple(
+    'Summary', [
+        # A dict mapping change methods to their number of changes.
+        'methods',
+        # A dict mapping container types to the number of new containers,
+        # including containers created in new machines.
+        'containers',
+        # The number of new machines, excluding containers.
+        'new_machines',
+        # The number of bundle machines already present in the model.
+        'existing_machines',
+    ]
+)
+
+
+def summarize(bundle, model=None):
+    """Return a Summary of the changes required to deploy the given bundle.
+
+    The summary is computed without generating the changes: its cost depends
+    on the number of services, machines, relations and placement directives
+    in the bundle, but not on the number of units.
+    See parse() for a description of the optional model.
+    """
+    changeset = ChangeSet(bundle, model=model)
+    methods = collections.Counter()
+    containers = collections.Counter()
+    new_machines = existing_machines = 0
+    # Summarize the services.
+    services = changeset.bundle['services']
+    charms = set()
+    for service_name, service in services.items():
+        existing = changeset.existing_services.get(service_name)
+        if existing is None:
+            charms.add(_charm_id(changeset, service['charm']))
+            methods['deploy'] += 1
+        if service.get('expose') and not (existing or {}).get('expose'):
+            methods['expose'] += 1
+        if 'annotations' in service:
+            if _annotations_to_set(service, existing) is not None:
+                methods['setAnnotations'] += 1
+    methods['addCharm'] = len(charms)
+    # Summarize the machines.
+    for machine_name, machine in changeset.bundle.get('machines', {}).items():
+        existing = changeset.existing_machines.get(str(machine_name))
+        if existing is None:
+            new_machines += 1
+        else:
+            existing_machines += 1
+        if machine and 'annotations' in machine:
+            if _annotations_to_set(machine, existing) is not None:
+                methods['setAnnotations'] += 1
+    # Summarize the relations.
+    for relation in changeset.bundle.get('relations', []):
+        endpoints = [
+            changeset.parse_cache.endpoint(endpoint) for endpoint in relation]
+        if not _relation_exists(changeset, endpoints):
+            methods['addRelation'] += 1
+    # Summarize the units and the machines they are placed on.
+    for service_name, service in services.items():
+        num_units = service.get('num_units')
+        if num_units is None:
+            # This is a subordinate service.
+            continue
+        num_existing_units = _num_existing_units(changeset, service_name)
+        if num_units <= num_existing_units:
+            continue
+        methods['addUnit'] += num_units - num_existing_units
+        placement_directives = service.get('to', [])
+        if not isinstance(placement_directives, (list, tuple)):
+            placement_directives = [placement_directives]
+        # Collect the placement directives of new units, with the number of
+        # units they apply to. In version 4 bundles, the last placement
+        # directive applies to all the remaining units.
+        directives = [
+            (directive, 1) for directive in
+            placement_directives[num_existing_units:num_units]]
+        num_remaining = num_units - max(
+            len(placement_directives), num_existing_units)
+        if (
+            placement_directives and num_remaining > 0 and
+            not changeset.is_legacy_bundle()
+        ):
+            directives.append((placement_directives[-1], num_remaining))
+        for directive, count in directives:
+            new_machine, container_type = _placement_summary(
+                changeset, _parse_placement(changeset, directive))
+            if new_machine:
+                new_machines += count
+            if container_type is not None:
+                containers[container_type] += count
+    methods['addMachines'] = new_machines + sum(containers.values())
+    return Summary(
+        methods=dict((method, count) for method, count in methods.items()
+                     if count),
+        containers=dict(containers),
+        new_machines=new_machines,
+        existing_machines=existing_machines,
+    )
+
+
+def _placement_summary(changeset, placement):
+    """Summarize the machines created to place a unit.
+
+    Receive the unit placement.
+    Return a tuple (new_machine, container_type) where new_machine reports
+    whether a new machine is created, and container_type is the type of the
+    new container, or None if no containers are created.
+    """
+    container_type = None
+    if placement.container_type:
+        container_type = _lxd_to_lxc(placement.container_type)
+    if placement.machine == 'new':
+        return container_type is None, container_type
+    if placement.machine and changeset.is_legacy_bundle():
+        # Legacy bundles can only place units on the bootstrap node.
+        return False, None
+    return False, container_type
+
+
+# Define a tuple holding a page of changes.
+Page = collections.namedtuple('Page', [
+    # The list of changes in the page.
+    'changes',
+    # The offset of the next page, or None if this is the last page.
+    'next_offset',
+])
+
+
+def parse_page(bundle, offset=0, limit=None, model=None):
+    """Return a Page including a slice of the changes for the given bundle.
+
+    The page includes at most limit changes, or all the remaining changes if
+    limit is None, starting from the given offset: pages are consistent with
+    the list of changes returned by parse(). Use the next_offset of a page
+    to retrieve the next one.
+
+    Changes before the offset are skipped cheaply: unit changes are skipped
+    without generating them.
+    See parse() for a description of the optional model.
+    Raise a ValueError if offset or limit are negative.
+    """
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError(b'offset and limit must not be negative')
+    changeset = ChangeSet(bundle, model=model)
+    changes = _changes(changeset, skip=offset)
+    if limit is None:
+        return Page(changes=list(changes), next_offset=None)
+    # Retrieve an additional change to check whether this is the last page.
+    changes = list(itertools.islice(changes, limit + 1))
+    if len(changes) <= limit:
+        return Page(changes=changes, next_offset=None)
+    return Page(changes=changes[:limit], next_offset=offset + limit)
+
+
+def _changes(changeset, skip=0):
+    """Return an iterator over all the changes for the given change set.
+
+    The first skip changes are not included.
+    """
+    phases = [
+        _services_changes,
+        _machines_changes,
+        _relations_changes,
+    ]
+    if not skip:
+        return itertools.chain.from_iterable(
+            phase(changeset) for phase in phases + [_units_changes])
+    return _skipped_changes(changeset, phases, skip)
+
+
+def _reduced_phases(changeset):
+    """Yield the changes for the given change set, with transitively reduced
+    requirements.
+
+    Unit changes are reduced without keeping track of the ancestors of units
+    that no later change can require.
+    """
+    ancestors = {}
+    phases = [
+        _services_changes,
+        _machines_changes,
+        _relations_changes,
+    ]
+    changes = itertools.chain.from_iterable(
+        phase(changeset) for phase in phases)
+    for change in _reduced_changes(changes, ancestors):
+        yield change
+    changes = _units_changes(changeset)
+    for change in _reduced_changes(changes, ancestors, units=changeset):
+        yield change
+
+
+def _skipped_changes(changeset, phases, skip):
+    """Yield the changes for the given change set, except the first skip
+    changes.
+
+    Changes in the given phases do not depend on the number of units, and
+    are always built, while unit changes are skipped cheaply.
+    """
+    changes = itertools.chain.from_iterable(
+        phase(changeset) for phase in phases)
+    for change in changes:
+        if skip:
+            skip -= 1
+            continue
+        yield change
+    for change in _units_changes(changeset, skip=skip):
+        yield change
+
+
+def _prepare_changeset(
+        bundle, changeset, model, int_ids=False, stable_ids=False,
+        compact=False):
+    """Return a change set ready to parse the given bundle.
+
+    If a change set is provided, reset and return it, otherwise create a new
+    one.
+    """
+    if changeset is None:
+        return ChangeSet(
+            bundle, model=model, int_ids=int_ids, stable_ids=stable_ids,
+            compact=compact)
+    changeset.set_ids(int_ids=int_ids, stable_ids=stable_ids)
+    changeset.compact = compact
+    changeset.reset(bundle, model=model)
+    return changeset
+
+
+def render(changes):
+    """Return the given changes with integer ids as the usual change dicts.
+
+    Receive a sequence of changes, either dicts or Change instances, as
+    returned by parse() when using integer ids. In the returned dicts, ids
+    and requirements are strings like "deploy-1", and placeholders are
+    strings like "$deploy-1".
+
+    Raise a ValueError if a change requires an unknown change.
+    """
+    changes = [
+        change.to_dict() if isinstance(change, Change) else change
+        for change in changes]
+    # Requirements may refer to later changes: collect all the methods first.
+    methods = dict((change['id'], change['method']) for change in changes)
+    rendered = []
+    for change in changes:
+        requires = []
+        for required_id in change['requires']:
+            try:
+                method = methods[required_id]
+            except KeyError:
+                msg = 'change {} requires unknown change {}'.format(
+                    change['id'], required_id)
+                raise ValueError(msg.encode('utf-8'))
+            requires.append('{}-{}'.format(method, required_id))
+        rendered.append({
+            'id': '{}-{}'.format(change['method'], change['id']),
+            'method': change['method'],
+            'args': _render_args(change['args']),
+            'requires': requires,
+        })
+    return rendered
+
+
+def _render_args(value):
+    """Return a copy of value with placeholders rendered as strings.
+
+    Lists and dicts are visited recursively.
+    """
+    if isinstance(value, Placeholder):
+        return '{}'.format(value)
+    if isinstance(value, (list, tuple)):
+        return [_render_args(item) for item in value]
+    if isinstance(value, dict):
+        return dict(
+            (key, _render_args(item)) for key, item in value.items())
+    return value
+
+
+class DependencyGraph(object):
+    """The graph of the requirements between changes.
+
+    The graph is built from a sequence of changes, either dicts or Change
+    instances, as returned by parse().
+    """
+
+    def __init__(self, changes):
+        self.changes = list(changes)
+        # Map change ids to their position in the change set.
+        self.positions = {}
+        # Map change ids to the ids of the changes they require.
+        self.requires = {}
+        # Map change ids to the ids of the changes requiring them.
+        self.required_by = {}
+        for position, change in enumerate(self.changes):
+            change_id, requires = _id_and_requires(change)
+            self.positions[change_id] = position
+            self.requires[change_id] = tuple(requires)
+            self.required_by[change_id] = []
+        for change_id, requires in self.requires.items():
+            for required_id in requires:
+                try:
+                    self.required_by[required_id].append(change_id)
+                except KeyError:
+                    msg = 'change {} requires unknown change {}'.format(
+                        change_id, required_id)
+                    raise ValueError(msg.encode('utf-8'))
+        for required_by in self.required_by.values():
+            required_by.sort(key=self.positions.get)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def wave_ids(self):
+        """Return the change ids grouped in topological waves.
+
+        Each wave is a list of ids of changes only requiring changes in
+        previous waves, so that all the changes in a wave can be executed
+        concurrently. Within a wave, ids are in change set order.
+        Raise a ValueError if requirements are circular.
+        """
+        pending = dict(
+            (change_id, len(requires))
+            for change_id, requires in self.requires.items())
+        wave = sorted(
+            (change_id for change_id, count in pending.items() if not count),
+            key=self.positions.get)
+        waves, num_visited = [], 0
+        while wave:
+            waves.append(wave)
+            num_visited += len(wave)
+            next_wave = []
+            for change_id in wave:
+                for dependent_id in self.required_by[change_id]:
+                    pending[dependent_id] -= 1
+                    if not pending[dependent_id]:
+                        next_wave.append(dependent_id)
+            next_wave.sort(key=self.positions.get)
+            wave = next_wave
+        if num_visited != len(self.changes):
+            raise ValueError(b'change set requirements are circular')
+        return waves
+
+    def waves(self):
+        """Return the changes grouped in topological waves.
+
+        See wave_ids() for a description of waves.
+        """
+        return [
+            [self.changes[self.positions[change_id]] for change_id in wave]
+            for wave in self.wave_ids()
+        ]
+
+
+def dependency_graph(changes):
+    """Return the dependency graph of the given changes."""
+    return DependencyGraph(changes)
+
+
+def waves(changes):
+    """Return the given changes grouped in topological waves.
+
+    Each wave is a list of changes only requiring changes in previous waves,
+    so that all the changes in a wave can be executed concurrently.
+    Raise a ValueError if requirements are circular or refer to unknown
+    changes.
+    """
+    return DependencyGraph(changes).waves()
+
+
+# Define a tuple holding the dependency graph of a change set in compressed
+# sparse row format. Changes are identified by their position in the change
+# set, and the positions of the changes required by the change at position i
+# are indices[offsets[i]:offsets[i + 1]].
+DependencyArrays = collections.namedtuple(
+    'DependencyArrays', [
+        # The list of change ids, in change set order.
+        'ids',
+        # The list of change methods, indexed by method code.
+        'methods',
+        # The method code of each change.
+        'method_codes',
+        # The start of each change requirements in indices, plus the total
+        # number of requirements.
+        'offsets',
+        # The positions of the required changes.
+        'indices',
+    ]
+)
+
+
+def dependency_arrays(changes, use_numpy=False):
+    """Return the dependency graph of the given changes as DependencyArrays.
+
+    Receive a sequence of changes, either dicts or Change instances, as
+    returned by parse(). Method codes, offsets and indices are returned as
+    array.array instances or, if use_numpy is True, as NumPy arrays sharing
+    the same memory. Using NumPy requires it to be installed.
+
+    Raise a ValueError if a change requires an unknown change.
+    """
+    changes = list(changes)
+    ids, methods, codes = [], [], {}
+    # Array type codes must be native strings.
+    method_codes = array.array(str('H'))
+    positions = {}
+    for position, change in enumerate(changes):
+        if isinstance(change, Change):
+            change_id, method = change.id, change.method
+        else:
+            change_id, method = change['id'], change['method']
+        code = codes.get(method)
+        if code is None:
+            code = codes[method] = len(methods)
+            methods.append(method)
+        ids.append(change_id)
+        method_codes.append(code)
+        positions[change_id] = position
+    offsets = array.array(str('l'), [0])
+    indices = array.array(str('l'))
+    for change in changes:
+        change_id, requires = _id_and_requires(change)
+        for required_id in requires:
+            try:
+                indices.append(positions[required_id])
+            except KeyError:
+                msg = 'change {} requires unknown change {}'.format(
+                    change_id, required_id)
+                raise ValueError(msg.encode('utf-8'))
+        offsets.append(len(indices))
+    if use_numpy:
+        import numpy
+        method_codes, offsets, indices = [
+            numpy.frombuffer(values, dtype=values.typecode)
+            for values in (method_codes, offsets, indices)]
+    return DependencyArrays(
+        ids=ids, methods=methods, method_codes=method_codes, offsets=offsets,
+        indices=indices)
+
+
+def reduce_requires(changes):
+    """Return the given changes with transitively reduced requirements.
+
+    Receive a sequence of changes, either dicts or Change instances, as
+    returned by parse(). A requirement is omitted if the change also requires
+    another change that, directly or indirectly, depends on it: for instance
+    a unit placed in a container does not need to require its service if the
+    container already requires another unit of the same service. The
+    resulting changes can be executed in the same order, but note that their
+    arguments may still refer to changes that are no longer required.
+
+    Return a list of changes, in the original order, of the same type of the
+    given ones. The given changes are not modified.
+    Raise a ValueError if the change requirements are not valid.
+    """
+    graph = dependency_graph(changes)
+    ancestors, requires = {}, {}
+    for wave in graph.wave_ids():
+        for change_id in wave:
+            requires[change_id] = _reduce(
+                change_id, graph.requires[change_id], ancestors)
+    return [
+        _with_requires(change, requires[_id_and_requires(change)[0]])
+        for change in graph.changes]
+
+
+def _reduced_changes(changes, ancestors, units=None):
+    """Yield the given changes with transitively reduced requirements.
+
+    Changes are processed in order: requirements on changes not yet seen are
+    always kept, so that the reduction is safe even if a change requires
+    changes coming later in the sequence. The given ancestors dict is updated
+    as described in _reduce().
+
+    If the changes are the unit changes of a change set, that change set can
+    be passed as units: in this case the ancestors of changes that no later
+    change can require are discarded. Machines created to place a unit are
+    only required by the next change, and units are only required if their
+    service hosts other units.
+    """
+    hosts = () if units is None else _host_service_args(units)
+    machine_id = None
+    for change in changes:
+        change_id, change_requires = _id_and_requires(change)
+        requires = _reduce(change_id, change_requires, ancestors)
+        if len(requires) != len(change_requires):
+            change = _with_requires(change, requires)
+        if units is not None:
+            if machine_id is not None:
+                del ancestors[machine_id]
+            machine_id = None
+            if isinstance(change, Change):
+                method, args = change.method, change.args
+            else:
+                method, args = change['method'], change['args']
+            if method == 'addMachines':
+                machine_id = change_id
+            elif args[0] not in hosts:
+                del ancestors[change_id]
+        yield change
+
+
+def _host_service_args(changeset):
+    """Return the arguments referring to services hosting other units.
+
+    These are the services used in unit placement directives, referred to
+    as in the addUnit changes of their units.
+    """
+    services = changeset.bundle['services']
+    hosts = set()
+    for service in services.values():
+        placement_directives = service.get('to', [])
+        if not isinstance(placement_directives, (list, tuple)):
+            placement_directives = [placement_directives]
+        for placement_directive in placement_directives:
+            placement = _parse_placement(changeset, placement_directive)
+            if placement.service in services:
+                hosts.add(
+                    _service_reference(changeset, placement.service)[0])
+    return hosts
+
+
+def _reduce(change_id, requires, ancestors):
+    """Return the given requirements not implied by other requirements.
+
+    The ancestors argument maps change ids to the set of all the changes they
+    directly or indirectly require: it must already include the required
+    changes, and it is updated to include the given change.
+    """
+    implied = set()
+    for required_id in requires:
+        implied.update(ancestors.get(required_id, ()))
+    ancestors[change_id] = implied.union(requires)
+    return [i for i in requires if i not in implied]
+
+
+def _with_requires(change, requires):
+    """Return a copy of the given change with the given requirements."""
+    if isinstance(change, Change):
+        return Change(change.id, change.method, change.args, requires)
+    return dict(change, requires=list(requires))
+
+
+def _id_and_requires(change):
+    """Return the id and requirements of a change dict or Change instance."""
+    if isinstance(change, Change):
+        return change.id, change.requires
+    return change['id'], change['requires']
+
+
+def collapse_units(changes):
+    """Return the given change dicts, collapsing runs of similar unit changes.
+
+    Consecutive addUnit changes with the same service, placement and
+    requirements, not required by any other change, are replaced by a single
+    addUnits change, whose arguments are the service, the placement and the
+    number of units. The addUnits change id is derived from the id of the
+    first collapsed unit. Use expand_units() to retrieve the original
+    changes.
+    Raise a ValueError if changes have integer ids.
+    """
+    changes = _string_id_changes(changes, 'collapse_units')
+    required = set()
+    for change in changes:
+        required.update(change['requires'])
+    collapsed, run = [], []
+
+    def flush():
+        if len(run) == 1:
+            collapsed.append(run[0])
+        elif run:
+            first = run[0]
+            collapsed.append({
+                'id': 'addUnits-{}'.format(_split_id(first['id'])[1]),
+                'method': 'addUnits',
+                'args': first['args'] + [len(run)],
+                'requires': first['requires'],
+            })
+        del run[:]
+
+    for change in changes:
+        number = _split_id(change['id'])[1]
+        if (
+            change['method'] != 'addUnit' or
+            change['id'] in required or
+            number is None
+        ):
+            flush()
+            collapsed.append(change)
+            continue
+        if run:
+            last = run[-1]
+            if not (
+                change['args'] == last['args'] and
+                change['requires'] == last['requires'] and
+                number == _split_id(last['id'])[1] + 1
+            ):
+                flush()
+        run.append(change)
+    flush()
+    return collapsed
+
+
+def expand_units(changes):
+    """Return the given change dicts, expanding addUnits changes.
+
+    Each addUnits change, as returned by collapse_units(), is replaced by the
+    corresponding addUnit changes.
+    Raise a ValueError if changes have integer ids.
+    """
+    expanded = []
+    for change in _string_id_changes(changes, 'expand_units'):
+        if change['method'] != 'addUnits':
+            expanded.append(change)
+            continue
+        service, placement, count = change['args']
+        number = _split_id(change['id'])[1]
+        for i in range(count):
+            expanded.append({
+                'id': 'addUnit-{}'.format(number + i),
+                'method': 'addUnit',
+                'args': [service, placement],
+                'requires': list(change['requires']),
+            })
+    return expanded
+
+
+def collapse_machines(changes):
+    """Return the given change dicts, batching identical machine changes.
+
+    All the addMachines changes with the same arguments and without
+    requirements, for instance the ones created for "new" or "lxd:new"
+    placements, are replaced by a single addMachinesBatch change, whose
+    arguments are the machine options and the number of machines. The batch
+    is placed where its first machine was.
+
+    Changes referring to a batched machine are updated to require the batch
+    change and to refer to the machine slot within the batch, using
+    placeholders like "$addMachinesBatch-2#1" (the second machine created by
+    the addMachinesBatch-2 change). The "#" separator cannot be included in
+    change ids, so that slots are not confused with stable ids like
+    "addMachinesBatch-wordpress/0".
+    Raise a ValueError if changes have integer ids.
+    """
+    changes = _string_id_changes(changes, 'collapse_machines')
+    groups = collections.OrderedDict()
+    for change in changes:
+        if change['method'] == 'addMachines' and not change['requires']:
+            key = json.dumps(change['args'], sort_keys=True)
+            groups.setdefault(key, []).append(change)
+    # Map the ids of batched machine changes to the corresponding batch id.
+    batch_ids = {}
+    # Map the ids of the first machine in each batch to the batch change.
+    batches = {}
+    # Map the placeholders of batched machines to their slot placeholders.
+    placeholders = {}
+    for machines in groups.values():
+        if len(machines) < 2:
+            continue
+        first_id = machines[0]['id']
+        batch_id = 'addMachinesBatch' + first_id[len('addMachines'):]
+        batches[first_id] = {
+            'id': batch_id,
+            'method': 'addMachinesBatch',
+            'args': [machines[0]['args'][0], len(machines)],
+            'requires': [],
+        }
+        for slot, machine in enumerate(machines):
+            batch_ids[machine['id']] = batch_id
+            placeholders['${}'.format(machine['id'])] = '${}#{}'.format(
+                batch_id, slot)
+    collapsed = []
+    for change in changes:
+        if change['id'] in batch_ids:
+            batch = batches.get(change['id'])
+            if batch is not None:
+                collapsed.append(batch)
+            continue
+        if any(i in batch_ids for i in change['requires']):
+            requires = []
+            for required_id in change['requires']:
+                required_id = batch_ids.get(required_id, required_id)
+                if required_id not in requires:
+                    requires.append(required_id)
+            change = dict(
+                change,
+                args=_replace_placeholders(change['args'], placeholders),
+                requires=requires)
+        collapsed.append(change)
+    return collapsed
+
+
+def fuse_changes(changes, supported=('expose', 'setAnnotations')):
+    """Return the given change dicts, folding follow-up calls into parents.
+
+    The supported argument lists the follow-up methods the consumer is able
+    to execute as part of their parent change: expose changes only requiring
+    the corresponding deploy change are removed, and an "expose" key set to
+    True is added to the deploy change. Similarly, setAnnotations changes
+    only requiring the corresponding deploy or addMachines change are
+    removed, and their annotations are stored in the "annotations" key of the
+    parent change. Requirements on removed changes are replaced by
+    requirements on their parents.
+    Raise a ValueError if changes have integer ids.
+    """
+    changes = _string_id_changes(changes, 'fuse_changes')
+    parent_methods = {
+        'expose': ('deploy',),
+        'setAnnotations': ('deploy', 'addMachines'),
+    }
+    fused = []
+    # Map change ids to their position in the fused list.
+    positions = {}
+    # Map the ids of removed changes to the ids of their parents.
+    parents = {}
+    for change in changes:
+        method = change['method']
+        requires = change['requires']
+        if method in supported and len(requires) == 1:
+            parent_id = requires[0]
+            position = positions.get(parent_id)
+            if (
+                position is not None and
+                change['args'][0] == '${}'.format(parent_id) and
+                fused[position]['method'] in parent_methods.get(method, ())
+            ):
+                parent = fused[position]
+                if method == 'expose':
+                    parent = dict(parent, expose=True)
+                else:
+                    parent = dict(parent, annotations=change['args'][2])
+                fused[position] = parent
+                parents[change['id']] = parent_id
+                continue
+        if any(i in parents for i in requires):
+            requires = []
+            for required_id in change['requires']:
+                required_id = parents.get(required_id, required_id)
+                if required_id not in requires:
+                    requires.append(required_id)
+            change = dict(change, requires=requires)
+        positions[change['id']] = len(fused)
+        fused.append(change)
+    return fused
+
+
+def _string_id_changes(changes, name):
+    """Return the given change dicts as a list.
+
+    Use the given function name to describe possible errors.
+    Raise a ValueError if a change has an integer id: such changes must be
+    converted with render() first.
+    """
+    changes = list(changes)
+    for change in changes:
+        if isinstance(change['id'], int):
+            msg = '{} requires string change ids: use render()'.format(name)
+            raise ValueError(msg.encode('utf-8'))
+    return changes
+
+
+def _replace_placeholders(value, placeholders):
+    """Return a copy of value replacing placeholders as described in the given
+    mapping. Lists and dicts are visited recursively.
+    """
+    if isinstance(value, list):
+        return [_replace_placeholders(i, placeholders) for i in value]
+    if isinstance(value, dict):
+        return dict(
+            (key, _replace_placeholders(item, placeholders))
+            for key, item in value.items())
+    try:
+        return placeholders.get(value, value)
+    except TypeError:
+        # The value is not hashable.
+        return value
+
+
+def _split_id(change_id):
+    """Split the given change id into its prefix and number.
+
+    The number is None if the id does not end with an integer.
+    """
+    prefix, _, number = change_id.rpartition('-')
+    try:
+        return prefix, int(number)
+    except ValueError:
+        return change_id, None
+
+
+def parse_concurrently(bundles, max_workers=None, handler=handle_services):
+    """Return the changes required to deploy each one of the given bundles.
+
+    Bundles are parsed concurrently by a pool of at most max_workers threads.
+    Return a list including, for each bundle in the given order, the list of
+    its changes, exactly as returned by parse().
+    """
+    def parse_list(bundle):
+        return list(parse(bundle, handler=handler))
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(parse_list, bundles))
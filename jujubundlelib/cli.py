@@ -13,10 +13,7 @@ import sys
 import yaml
 
 import jujubundlelib
-from jujubundlelib import (
-    changeset,
-    validation,
-)
+from jujubundlelib import changeset
 
 
 # Retrieve the application version.
@@ -44,14 +41,14 @@ def get_changeset(args):
     except Exception:
         return 'error: the provided bundle is not a valid YAML'
 
-    # Validate the bundle object.
-    errors = validation.validate(bundle)
+    # Validate the bundle object and generate its changeset.
+    errors, changes = changeset.validate_and_parse(bundle)
     if errors:
         return '\n'.join(errors)
 
     # Dump the changeset to stdout.
     print('[')
-    for num, change in enumerate(changeset.parse(bundle)):
+    for num, change in enumerate(changes):
         if num:
             print(',')
         print(json.dumps(change))
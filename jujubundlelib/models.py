@@ -5,6 +5,8 @@ from __future__ import unicode_literals
 
 from collections import namedtuple
 
+from jujubundlelib import references
+
 
 VALID_CONTAINERS = (
     'lxc',
@@ -27,6 +29,75 @@ UnitPlacement = namedtuple(
 Relation = namedtuple('Relation', ['name', 'interface'])
 
 
+def parse_endpoint(endpoint):
+    """Return a Relation given a relation endpoint string.
+
+    Endpoints are service names optionally followed by a colon and the
+    interface name. Malformed endpoints are returned as service names.
+    """
+    try:
+        name, interface = endpoint.split(':')
+    except ValueError:
+        return Relation(endpoint, '')
+    return Relation(name, interface)
+
+
+class ParseCache(object):
+    """Memoize the parsing of the components of a bundle.
+
+    A single instance can be shared by the bundle validation and the change
+    set generation, so that placement directives, relation endpoints and
+    charm URLs are parsed only once. ValueErrors raised while parsing are
+    memoized as well.
+    """
+
+    def __init__(self):
+        self._placements = {}
+        self._endpoints = {}
+        self._references = {}
+
+    def placement(self, placement_str, legacy):
+        """Return a UnitPlacement given a placement string.
+
+        Use the version 3 syntax if legacy is True, version 4 otherwise.
+        Raise a ValueError if the placement is not valid.
+        """
+        parse = parse_v3_unit_placement if legacy else parse_v4_unit_placement
+        return _memoize(
+            self._placements, (placement_str, legacy), parse, placement_str)
+
+    def endpoint(self, endpoint):
+        """Return a Relation given a relation endpoint string."""
+        return _memoize(self._endpoints, endpoint, parse_endpoint, endpoint)
+
+    def reference(self, url):
+        """Return a charm or bundle Reference given its URL.
+
+        Raise a ValueError if the URL is not valid.
+        """
+        return _memoize(
+            self._references, url, references.Reference.from_string, url)
+
+
+def _memoize(results, key, func, *args):
+    """Return the result of calling func with args, or raise its ValueError.
+
+    Results and errors are stored in the given results dict with the given
+    key, so that func is called at most once.
+    """
+    try:
+        result = results[key]
+    except KeyError:
+        try:
+            result = func(*args)
+        except ValueError as err:
+            result = err
+        results[key] = result
+    if isinstance(result, ValueError):
+        raise result
+    return result
+
+
 def parse_v3_unit_placement(placement_str):
     """Return a UnitPlacement for bundles version 3, given a placement string.
 
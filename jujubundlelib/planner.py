@@ -0,0 +1,158 @@
+# Copyright 2015 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+from collections import namedtuple
+import heapq
+
+from jujubundlelib import changeset
+
+
+# Define the default latency model, mapping change methods to their
+# estimated execution time in seconds.
+DEFAULT_LATENCIES = {
+    'addCharm': 10,
+    'addMachines': 120,
+    'addRelation': 2,
+    'addUnit': 30,
+    'deploy': 5,
+    'expose': 1,
+    'setAnnotations': 1,
+}
+
+
+# Define a tuple holding the estimated execution of a change set.
+Plan = namedtuple(
+    'Plan', [
+        # The ids of the changes in the longest chain of requirements.
+        'critical_path',
+        # The time required to execute the critical path changes.
+        'critical_path_duration',
+        # The time required to execute all the changes, starting each change
+        # as soon as its requirements are satisfied and a slot is available.
+        'makespan',
+        # A list of WaveStats, one for each topological wave.
+        'waves',
+    ]
+)
+
+# Define a tuple holding the estimated execution of a single wave, when waves
+# are executed one after the other.
+WaveStats = namedtuple('WaveStats', ['ids', 'duration', 'utilization'])
+
+
+def plan(changes, latencies=None, concurrency=None):
+    """Estimate the execution of the given changes.
+
+    Receive a sequence of changes as returned by changeset.parse(), a dict
+    mapping change methods to their latency (defaulting to
+    DEFAULT_LATENCIES) and the maximum number of changes that can be
+    executed at the same time (or None for no limit).
+
+    Return a Plan.
+    Raise a ValueError if a latency is not defined for a change method, or
+    if the change requirements are not valid.
+    """
+    if latencies is None:
+        latencies = DEFAULT_LATENCIES
+    if concurrency is not None and concurrency < 1:
+        raise ValueError(b'concurrency must be a positive number')
+    graph = changeset.dependency_graph(changes)
+    wave_ids = graph.wave_ids()
+    durations = _get_durations(graph, latencies)
+    # Compute, for each change, the duration of the longest chain of
+    # requirements starting from it, and the next change in that chain.
+    tails, successors = {}, {}
+    for wave in reversed(wave_ids):
+        for change_id in wave:
+            successor = None
+            for dependent_id in graph.required_by[change_id]:
+                if successor is None or tails[dependent_id] > tails[successor]:
+                    successor = dependent_id
+            tail = tails[successor] if successor is not None else 0
+            tails[change_id] = durations[change_id] + tail
+            successors[change_id] = successor
+    critical_path = []
+    if wave_ids:
+        change_id = max(wave_ids[0], key=tails.get)
+        while change_id is not None:
+            critical_path.append(change_id)
+            change_id = successors[change_id]
+    return Plan(
+        critical_path=critical_path,
+        critical_path_duration=tails[critical_path[0]] if critical_path else 0,
+        makespan=_get_makespan(graph, durations, tails, concurrency),
+        waves=[_get_wave_stats(wave, durations, concurrency)
+               for wave in wave_ids],
+    )
+
+
+def _get_durations(graph, latencies):
+    """Return a dict mapping change ids to their duration.
+
+    Raise a ValueError if a latency is not defined for a change method.
+    """
+    durations = {}
+    for change in graph.changes:
+        if isinstance(change, changeset.Change):
+            change_id, method = change.id, change.method
+        else:
+            change_id, method = change['id'], change['method']
+        try:
+            durations[change_id] = latencies[method]
+        except KeyError:
+            msg = 'no latency defined for method {}'.format(method)
+            raise ValueError(msg.encode('utf-8'))
+    return durations
+
+
+def _get_makespan(graph, durations, tails, concurrency):
+    """Simulate the execution of the changes in the given graph.
+
+    Changes are started as soon as their requirements are satisfied and
+    fewer than concurrency changes are running, giving precedence to changes
+    starting the longest chains of requirements.
+    Return the time required to execute all the changes.
+    """
+    limit = len(graph) if concurrency is None else concurrency
+    pending = dict(
+        (change_id, len(requires))
+        for change_id, requires in graph.requires.items())
+    ready = [
+        (-tails[change_id], graph.positions[change_id], change_id)
+        for change_id, count in pending.items() if not count]
+    heapq.heapify(ready)
+    running, now = [], 0
+    while ready or running:
+        while ready and len(running) < limit:
+            _, position, change_id = heapq.heappop(ready)
+            heapq.heappush(
+                running, (now + durations[change_id], position, change_id))
+        now, _, change_id = heapq.heappop(running)
+        for dependent_id in graph.required_by[change_id]:
+            pending[dependent_id] -= 1
+            if not pending[dependent_id]:
+                heapq.heappush(ready, (
+                    -tails[dependent_id], graph.positions[dependent_id],
+                    dependent_id))
+    return now
+
+
+def _get_wave_stats(wave, durations, concurrency):
+    """Return the WaveStats for the given wave of change ids.
+
+    The changes in the wave are assigned to the least busy of the available
+    slots, longest changes first.
+    """
+    slots = len(wave) if concurrency is None else concurrency
+    loads = [0] * min(slots, len(wave))
+    for duration in sorted((durations[i] for i in wave), reverse=True):
+        heapq.heapreplace(loads, loads[0] + duration)
+    duration = max(loads)
+    busy = sum(durations[i] for i in wave)
+    utilization = busy / float(duration * slots) if duration else 0.0
+    return WaveStats(ids=wave, duration=duration, utilization=utilization)
@@ -50,6 +50,16 @@ class BundleFileTestsMixin(object):
         return bundle_file.name
 
 
+def make_change(change_id, *requires):
+    """Return a change dict with the given id and requirements."""
+    return {
+        'id': change_id,
+        'method': change_id.split('-')[0],
+        'args': [],
+        'requires': list(requires),
+    }
+
+
 def mock_print():
     """Mock the builtin print function."""
     if pyutils.PY3:
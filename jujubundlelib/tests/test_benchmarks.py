@@ -0,0 +1,499 @@
+# Copyright 2015 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+from __future__ import (
+    print_function,
+    unicode_literals,
+)
+
+import copy
+import gc
+import os
+import timeit
+import unittest
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no support for tracing memory allocations.
+    tracemalloc = None
+
+from jujubundlelib import (
+    changeset,
+    models,
+    references,
+    validation,
+)
+from jujubundlelib.typeutils import (
+    isdict,
+    isstring,
+)
+
+
+# Define the name of the environment variable used to run the benchmarks.
+BENCHMARKS_ENV_VAR = 'JUJU_BUNDLELIB_BENCHMARKS'
+
+
+skip_if_benchmarks_disabled = unittest.skipUnless(
+    os.getenv(BENCHMARKS_ENV_VAR) == '1',
+    'to run benchmarks, set {} to "1"'.format(BENCHMARKS_ENV_VAR))
+
+
+def make_bundle(prefix='', num_services=10, num_units=3):
+    """Return a v4 bundle with the given number of services and units.
+
+    Use the given prefix to generate unique service names, so that bundles
+    generated with different prefixes do not share any state.
+    """
+    services = {}
+    for i in range(num_services):
+        services['{}service-{}'.format(prefix, i)] = {
+            'charm': 'cs:trusty/django-{}'.format(i % 5),
+            'num_units': num_units,
+            'expose': bool(i % 2),
+            'annotations': {'gui-x': i, 'gui-y': i},
+        }
+    names = sorted(services)
+    return {
+        'services': services,
+        'machines': {},
+        'relations': [[a, b] for a, b in zip(names, names[1:])],
+    }
+
+
+def make_placement_bundle(num_services=50, num_units=100):
+    """Return a v4 bundle whose units are mostly placed in containers."""
+    services = {'base': {'charm': 'cs:trusty/base-1', 'num_units': num_units}}
+    for i in range(num_services):
+        services['service-{}'.format(i)] = {
+            'charm': 'cs:trusty/django-42',
+            'num_units': num_units,
+            'to': ['lxc:base', 'kvm:new', 'lxd:base/{}'.format(i)],
+        }
+    return {'services': services, 'machines': {}}
+
+
+def make_broken_bundle(num_services=5000):
+    """Return a bundle whose services are all invalid in several ways."""
+    services = {}
+    for i in range(num_services):
+        services['service-{}'.format(i)] = {
+            'charm': 'local:trusty/django-{}'.format(i),
+            'num_units': -1,
+            'constraints': 'bad-{}=wolf'.format(i) * 10,
+            'annotations': [i],
+            'to': ['lxc:no-such-{}'.format(i)],
+        }
+    return {
+        'services': services,
+        'machines': dict((i, {'series': 'bad wolf'}) for i in range(100)),
+        'relations': [['service-0', 'no-such']] * num_services,
+    }
+
+
+def make_fields_bundle(num_services=5000, num_machines=1000):
+    """Return a v4 bundle whose services and machines define many fields."""
+    services = {}
+    for i in range(num_services):
+        services['service-{}'.format(i)] = {
+            'charm': 'cs:trusty/django-42',
+            'num_units': 1,
+            'expose': bool(i % 2),
+            'constraints': 'cores=4 mem=8G arch=amd64 root-disk=100G',
+            'storage': {'data': 'ebs,10G'},
+            'options': {'debug': True},
+            'annotations': {'gui-x': '1', 'gui-y': '2'},
+            'to': [str(i % num_machines)],
+        }
+    machines = dict((i, {
+        'series': 'trusty',
+        'constraints': 'mem=4G,cores=2',
+        'annotations': {'gui-x': '1'},
+    }) for i in range(num_machines))
+    return {'services': services, 'machines': machines}
+
+
+def handle_with_reference_units(cs):
+    """Run the change set handlers, using reference_handle_units for units.
+    """
+    handler = changeset.handle_services
+    while handler is not changeset.handle_units:
+        handler = handler(cs)
+    return reference_handle_units
+
+
+def reference_handle_units(cs):
+    """Populate the change set with addUnit changes.
+
+    This is the previous implementation of changeset.handle_units, which
+    builds all the records up front and deep copies the placed ones. It is
+    used as a reference to measure the current implementation.
+    """
+    units, records = {}, {}
+    for service_name, service in sorted(cs.bundle['services'].items()):
+        for i in range(service.get('num_units', 0)):
+            record_id = 'addUnit-{}'.format(cs.next_action())
+            records[record_id] = {
+                'id': record_id,
+                'method': 'addUnit',
+                'args': ['${}'.format(cs.services_added[service_name]), None],
+                'requires': [cs.services_added[service_name]],
+            }
+            units['{}/{}'.format(service_name, i)] = record_id
+    for service_name, service in sorted(cs.bundle['services'].items()):
+        num_units = service.get('num_units')
+        if num_units is None:
+            continue
+        directives = service.get('to', [])
+        if not isinstance(directives, (list, tuple)):
+            directives = [directives]
+        if directives:
+            directives += directives[-1:] * (num_units - len(directives))
+        placed_in_services = {}
+        for i in range(num_units):
+            record = records[units['{}/{}'.format(service_name, i)]]
+            if i < len(directives):
+                record = _reference_unit_placement(
+                    cs, units, record, directives[i], placed_in_services)
+            cs.send(record)
+
+
+def _reference_unit_placement(cs, units, record, directive, placed):
+    """Return a copy of the given record placed as per the given directive."""
+    record = copy.deepcopy(record)
+    placement = models.parse_v4_unit_placement(directive)
+    if placement.machine:
+        if placement.machine == 'new':
+            parent_id = 'addMachines-{}'.format(cs.next_action())
+            options = {}
+            if placement.container_type:
+                options = {'containerType': _lxd_to_lxc(placement)}
+            cs.send({
+                'id': parent_id,
+                'method': 'addMachines',
+                'args': [options],
+                'requires': [],
+            })
+        else:
+            parent_id = cs.machines_added[placement.machine]
+            if placement.container_type:
+                parent_id = _reference_container(cs, placement, parent_id)
+    else:
+        number = placement.unit
+        if number is None:
+            current = placed.get(placement.service)
+            number = placed[placement.service] = (
+                0 if current is None else current + 1)
+        parent_id = units['{}/{}'.format(placement.service, number)]
+        if placement.container_type:
+            parent_id = _reference_container(cs, placement, parent_id)
+    record['requires'].append(parent_id)
+    record['args'][-1] = '${}'.format(parent_id)
+    return record
+
+
+def _reference_container(cs, placement, parent_id):
+    """Send a container change and return its id."""
+    container_id = 'addMachines-{}'.format(cs.next_action())
+    cs.send({
+        'id': container_id,
+        'method': 'addMachines',
+        'args': [{
+            'containerType': _lxd_to_lxc(placement),
+            'parentId': '${}'.format(parent_id),
+        }],
+        'requires': [parent_id],
+    })
+    return container_id
+
+
+def _lxd_to_lxc(placement):
+    """Return the container type of the given placement, lxd being lxc."""
+    if placement.container_type == 'lxd':
+        return 'lxc'
+    return placement.container_type
+
+
+def reference_service_fields(service_name, service, add_error):
+    """Validate service fields using the hand-written rules.
+
+    This is the previous implementation of the checks now compiled from the
+    validation rule table, used as a reference to measure the compiled ones.
+    """
+    parts = ('services', service_name)
+    if service.get('expose') not in (True, False, None):
+        add_error(validation.BundleError(
+            'expose-invalid', parts + ('expose',), service=service_name))
+    _reference_constraints(
+        service.get('constraints'), parts + ('constraints',), add_error)
+    for field in ('storage', 'options'):
+        value = service.get(field)
+        if value is not None and not isdict(value):
+            add_error(validation.BundleError(
+                '{}-invalid'.format(field), parts + (field,),
+                service=service_name, **{field: value}))
+    _reference_annotations(
+        service.get('annotations'), parts + ('annotations',), add_error)
+
+
+def reference_machine_fields(machine_id, machine, add_error):
+    """Validate machine fields using the hand-written rules.
+
+    See reference_service_fields().
+    """
+    parts = ('machines', machine_id)
+    _reference_constraints(
+        machine.get('constraints'), parts + ('constraints',), add_error)
+    series = machine.get('series')
+    if series is not None:
+        code = None
+        if not isstring(series):
+            code = 'series-not-string'
+        elif series == 'bundle':
+            code = 'series-bundle'
+        elif not references.valid_series(series):
+            code = 'series-invalid'
+        if code is not None:
+            add_error(validation.BundleError(
+                code, parts + ('series',), series=series))
+    _reference_annotations(
+        machine.get('annotations'), parts + ('annotations',), add_error)
+
+
+def _reference_constraints(constraints, parts, add_error):
+    """Validate constraints by splitting them into key=value pairs."""
+    if constraints is None:
+        return
+    if not isstring(constraints):
+        add_error(validation.BundleError(
+            'constraints-invalid', parts, constraints=constraints))
+        return
+    sep = ',' if ',' in constraints else None
+    for constraint in constraints.split(sep):
+        try:
+            key, value = constraint.split('=')
+        except (TypeError, ValueError):
+            add_error(validation.BundleError(
+                'constraints-invalid', parts, constraints=constraints))
+            return
+        if key not in validation._CONSTRAINTS:
+            add_error(validation.BundleError(
+                'constraints-invalid', parts, constraints=constraints))
+
+
+def _reference_annotations(annotations, parts, add_error):
+    """Check that annotations are a dict with string keys."""
+    if annotations is None:
+        return
+    if not isdict(annotations):
+        add_error(validation.BundleError(
+            'annotations-invalid', parts, annotations=annotations))
+    elif not all(map(isstring, annotations)):
+        add_error(validation.BundleError(
+            'annotations-keys-invalid', parts, annotations=annotations))
+
+
+def best_time(func, number=5, repeat=3):
+    """Return the best time in seconds taken by a single call to func."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+@skip_if_benchmarks_disabled
+class TestParseSpeed(unittest.TestCase):
+
+    def test_placement_heavy_bundle(self):
+        bundle = make_placement_bundle()
+        changes = list(changeset.parse(bundle))
+        reference_changes = list(changeset.parse(
+            bundle, handler=handle_with_reference_units))
+        self.assertEqual(reference_changes, changes)
+        elapsed = best_time(lambda: list(changeset.parse(bundle)))
+        reference = best_time(lambda: list(changeset.parse(
+            bundle, handler=handle_with_reference_units)))
+        print(
+            '\nplacement heavy bundle: {} changes in {:.1f} ms, '
+            'deep copying records {:.1f} ms'.format(
+                len(changes), elapsed * 1000, reference * 1000))
+        self.assertLess(elapsed, reference)
+
+
+@skip_if_benchmarks_disabled
+@unittest.skipIf(tracemalloc is None, 'tracemalloc is not available')
+class TestParseSoak(unittest.TestCase):
+
+    iterations = 5000
+
+    def get_traced_memory(self):
+        """Return the memory currently allocated, in bytes."""
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    def soak(self, parse):
+        """Parse many different bundles with the given callable.
+
+        Return the memory growth between the first and the last bundles.
+        """
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        baseline = None
+        for i in range(self.iterations):
+            list(parse(make_bundle(prefix='{}-'.format(i))))
+            if i == self.iterations // 10:
+                # Let caches and interned strings settle before measuring.
+                baseline = self.get_traced_memory()
+        return self.get_traced_memory() - baseline
+
+    def test_fresh_changesets(self):
+        growth = self.soak(changeset.parse)
+        print('\nfresh change sets: memory growth {} bytes'.format(growth))
+        self.assertLess(growth, 64 * 1024)
+
+    def test_pooled_changeset(self):
+        cs = changeset.ChangeSet({'services': {}})
+        growth = self.soak(
+            lambda bundle: changeset.parse(bundle, changeset=cs))
+        print('\npooled change set: memory growth {} bytes'.format(growth))
+        self.assertLess(growth, 64 * 1024)
+
+
+@skip_if_benchmarks_disabled
+@unittest.skipIf(tracemalloc is None, 'tracemalloc is not available')
+class TestStreamMemory(unittest.TestCase):
+
+    def get_peak_memory(self, func):
+        """Return the peak memory allocated while calling func, in bytes."""
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def consume(self, changes):
+        """Iterate over the given changes without storing them."""
+        for change in changes:
+            pass
+
+    def test_units_do_not_affect_peak_memory(self):
+        bundle = make_placement_bundle(num_services=10, num_units=10000)
+        parse_peak = self.get_peak_memory(
+            lambda: self.consume(changeset.parse(bundle)))
+        stream_peak = self.get_peak_memory(
+            lambda: self.consume(changeset.stream(bundle)))
+        print('\npeak memory: parse {} bytes, stream {} bytes'.format(
+            parse_peak, stream_peak))
+        self.assertLess(stream_peak, 64 * 1024)
+
+    def test_minimal_requires(self):
+        bundle = make_placement_bundle(num_services=10, num_units=10000)
+        for service in bundle['services'].values():
+            service['to'] = ['lxd:new', 'new']
+        stream_peak = self.get_peak_memory(
+            lambda: self.consume(
+                changeset.stream(bundle, minimal_requires=True)))
+        print('\npeak memory: stream with minimal requires {} bytes'.format(
+            stream_peak))
+        self.assertLess(stream_peak, 64 * 1024)
+
+    def test_compact_changes(self):
+        bundle = make_placement_bundle(num_services=10, num_units=10000)
+        dicts_peak = self.get_peak_memory(
+            lambda: list(changeset.stream(bundle)))
+        compact_peak = self.get_peak_memory(
+            lambda: list(changeset.stream(bundle, compact=True)))
+        print('\nchanges memory: dicts {} bytes, compact {} bytes'.format(
+            dicts_peak, compact_peak))
+        self.assertLess(compact_peak, dicts_peak)
+
+    def test_compact_parse(self):
+        bundle = make_placement_bundle(num_services=10, num_units=10000)
+        dicts_peak = self.get_peak_memory(
+            lambda: list(changeset.parse(bundle)))
+        compact_peak = self.get_peak_memory(
+            lambda: list(changeset.parse(bundle, compact=True)))
+        print('\nparsed memory: dicts {} bytes, compact {} bytes'.format(
+            dicts_peak, compact_peak))
+        self.assertLess(compact_peak, dicts_peak)
+
+    def test_int_ids(self):
+        bundle = make_placement_bundle(num_services=10, num_units=10000)
+        strings_peak = self.get_peak_memory(
+            lambda: list(changeset.stream(bundle, compact=True)))
+        ints_peak = self.get_peak_memory(
+            lambda: list(changeset.stream(bundle, compact=True, int_ids=True)))
+        print('\nchanges memory: string ids {} bytes, int ids {} bytes'.format(
+            strings_peak, ints_peak))
+        self.assertLess(ints_peak, strings_peak)
+
+
+@skip_if_benchmarks_disabled
+class TestValidationSpeed(unittest.TestCase):
+
+    def test_broken_bundle(self):
+        bundle = make_broken_bundle()
+        all_errors = best_time(lambda: validation.validate(bundle), number=1)
+        capped = best_time(lambda: validation.validate(bundle, max_errors=10))
+        fail_fast = best_time(
+            lambda: validation.validate(bundle, fail_fast=True))
+        print(
+            '\nbroken bundle validation: all errors {:.1f} ms, '
+            '10 errors {:.3f} ms, fail fast {:.3f} ms'
+            ''.format(all_errors * 1000, capped * 1000, fail_fast * 1000))
+        self.assertLess(fail_fast, all_errors)
+
+    def test_incremental(self):
+        bundle = make_bundle(num_services=5000)
+        validator = validation.BundleValidator(bundle)
+        service = bundle['services']['service-42']
+
+        def edit():
+            service['num_units'] += 1
+            validator.update(bundle, [('services', 'service-42')])
+            return validator.errors(structured=True)
+
+        full = best_time(lambda: validation.validate(bundle), number=1)
+        incremental = best_time(edit)
+        print(
+            '\nsingle service edit: full validation {:.1f} ms, '
+            'incremental {:.3f} ms'.format(full * 1000, incremental * 1000))
+        self.assertLess(incremental, full)
+
+    def test_processes(self):
+        bundle = make_placement_bundle(num_services=20000, num_units=3)
+        serial = best_time(lambda: validation.validate(bundle), number=1)
+        results = ['serial {:.1f} ms'.format(serial * 1000)]
+        for processes in (1, 2, 4, 8):
+            elapsed = best_time(
+                lambda: validation.validate(bundle, processes=processes),
+                number=1)
+            results.append('{} processes {:.1f} ms'.format(
+                processes, elapsed * 1000))
+        print('\nlarge bundle validation: {}'.format(', '.join(results)))
+
+    def test_fields_bundle(self):
+        bundle = make_fields_bundle()
+        services = list(bundle['services'].items())
+        machines = list(bundle['machines'].items())
+
+        def validate_fields(service_fields, machine_fields):
+            errors = []
+            for service_name, service in services:
+                service_fields(service_name, service, errors.append)
+            for machine_id, machine in machines:
+                machine_fields(machine_id, machine, errors.append)
+            return errors
+
+        compiled_fields = (
+            validation._validate_service_fields,
+            validation._validate_machine_fields)
+        reference_fields = (reference_service_fields, reference_machine_fields)
+        self.assertEqual(
+            validate_fields(*reference_fields),
+            validate_fields(*compiled_fields))
+        compiled = best_time(lambda: validate_fields(*compiled_fields))
+        reference = best_time(lambda: validate_fields(*reference_fields))
+        print(
+            '\nfields bundle validation: compiled rules {:.1f} ms, '
+            'hand-written rules {:.1f} ms'.format(
+                compiled * 1000, reference * 1000))
+        self.assertLess(compiled, reference)
@@ -0,0 +1,143 @@
+# Copyright 2015 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+from __future__ import unicode_literals
+
+import datetime
+import json
+import unittest
+
+from jujubundlelib import (
+    cache,
+    changeset,
+    validation,
+)
+
+
+def _make_bundle(name='django', num_units=1):
+    """Return a valid bundle with a single service."""
+    return {
+        'services': {
+            name: {
+                'charm': 'cs:trusty/django-42',
+                'num_units': num_units,
+                'options': {'debug': True},
+            },
+        },
+    }
+
+
+class TestBundleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.BundleCache()
+
+    def test_parse(self):
+        bundle = _make_bundle()
+        expected = list(changeset.parse(bundle))
+        self.assertEqual(expected, self.cache.parse(bundle))
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(expected, self.cache.parse(_make_bundle()))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_validate(self):
+        bundle = {'services': {'django': {}}}
+        expected = validation.validate(bundle)
+        self.assertEqual(expected, self.cache.validate(bundle))
+        self.assertEqual(expected, self.cache.validate(bundle))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_validate_and_parse_stored_separately(self):
+        bundle = _make_bundle()
+        self.assertEqual([], self.cache.validate(bundle))
+        self.cache.parse(bundle)
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+        self.assertEqual(2, len(self.cache))
+
+    def test_copy_on_read(self):
+        bundle = _make_bundle()
+        changes = self.cache.parse(bundle)
+        changes[1]['args'][2]['debug'] = False
+        changes.append('bad wolf')
+        self.assertEqual(
+            list(changeset.parse(bundle)), self.cache.parse(bundle))
+        errors = self.cache.validate({})
+        errors.append('bad wolf')
+        self.assertEqual(validation.validate({}), self.cache.validate({}))
+
+    def test_non_json_options(self):
+        bundle = _make_bundle()
+        bundle['services']['django']['options'] = {
+            'start': datetime.date(2015, 6, 1),
+            42: ('bad', 'wolf'),
+        }
+        expected = list(changeset.parse(bundle))
+        self.assertEqual(expected, self.cache.parse(bundle))
+        changes = self.cache.parse(bundle)
+        self.assertEqual(expected, changes)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        options = changes[1]['args'][2]
+        self.assertEqual(datetime.date(2015, 6, 1), options['start'])
+        self.assertEqual(('bad', 'wolf'), options[42])
+
+    def test_max_entries(self):
+        lru = cache.BundleCache(max_entries=2)
+        lru.parse(_make_bundle('a'))
+        lru.parse(_make_bundle('b'))
+        # Use the first bundle, so that the second one is evicted.
+        lru.parse(_make_bundle('a'))
+        lru.parse(_make_bundle('c'))
+        self.assertEqual(2, len(lru))
+        self.assertEqual((1, 3), (lru.hits, lru.misses))
+        lru.parse(_make_bundle('a'))
+        self.assertEqual((2, 3), (lru.hits, lru.misses))
+        lru.parse(_make_bundle('b'))
+        self.assertEqual((2, 4), (lru.hits, lru.misses))
+
+    def test_max_bytes(self):
+        size = len(json.dumps(
+            list(changeset.parse(_make_bundle('a')))))
+        lru = cache.BundleCache(max_bytes=size * 2)
+        lru.parse(_make_bundle('a'))
+        lru.parse(_make_bundle('b'))
+        self.assertEqual(size * 2, lru.size)
+        lru.parse(_make_bundle('c'))
+        self.assertEqual(2, len(lru))
+        self.assertEqual(size * 2, lru.size)
+        # Results larger than the cache are not stored.
+        lru.parse(_make_bundle('d', num_units=10))
+        self.assertEqual(2, len(lru))
+
+    def test_clear(self):
+        self.cache.parse(_make_bundle())
+        self.cache.parse(_make_bundle())
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual((0, 0, 0), (
+            self.cache.hits, self.cache.misses, self.cache.size))
+
+
+class TestBundleHash(unittest.TestCase):
+
+    def test_key_ordering(self):
+        bundle1 = {'services': {'a': {'charm': 'a'}, 'b': {'charm': 'b'}}}
+        bundle2 = {'services': {'b': {'charm': 'b'}, 'a': {'charm': 'a'}}}
+        self.assertEqual(
+            cache.bundle_hash(bundle1), cache.bundle_hash(bundle2))
+
+    def test_different_bundles(self):
+        bundles = [
+            {'machines': {0: {}}},
+            {'machines': {'0': {}}},
+            {'machines': {'0': None}},
+            {'machines': {0: {}}, 'relations': []},
+            {'relations': [['a', 'b']]},
+            {'relations': [['b', 'a']]},
+            {'relations': ['a:b']},
+        ]
+        hashes = set(cache.bundle_hash(bundle) for bundle in bundles)
+        self.assertEqual(len(bundles), len(hashes))
+
+    def test_mixed_keys(self):
+        bundle = {'machines': {0: {}, '1': {}}}
+        self.assertEqual(64, len(cache.bundle_hash(bundle)))
@@ -3,9 +3,23 @@
 
 from __future__ import unicode_literals
 
+import collections
+import copy
+import itertools
+import json
 import unittest
 
-from jujubundlelib import changeset
+import mock
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from jujubundlelib import (
+    changeset,
+    models,
+)
+from jujubundlelib.tests import helpers
 
 
 class TestChangeSet(unittest.TestCase):
@@ -24,11 +38,114 @@ class TestChangeSet(unittest.TestCase):
         self.assertEqual(['foo', 'bar'], self.cs.recv())
         self.assertEqual([], self.cs.recv())
 
+    def test_send_to_sink(self):
+        changes = []
+        cs = changeset.ChangeSet({'services': {}}, sink=changes.append)
+        cs.send('foo')
+        cs.send('bar')
+        self.assertEqual(['foo', 'bar'], changes)
+        self.assertEqual([], cs.recv())
+
     def test_is_legacy_bundle(self):
         self.assertFalse(self.cs.is_legacy_bundle())
         cs = changeset.ChangeSet({'services': {}})
         self.assertTrue(cs.is_legacy_bundle())
 
+    def test_next_actions(self):
+        self.assertEqual(0, self.cs.next_action())
+        self.assertEqual(1, self.cs.next_actions(3))
+        self.assertEqual(4, self.cs.next_actions(0))
+        self.assertEqual(4, self.cs.next_action())
+
+    def test_state_not_shared(self):
+        cs = changeset.ChangeSet({'services': {}})
+        cs.services_added['django'] = 'deploy-1'
+        cs.machines_added['0'] = 'addMachines-0'
+        self.assertEqual({}, self.cs.services_added)
+        self.assertEqual({}, self.cs.machines_added)
+
+    def test_reset(self):
+        self.cs.send('foo')
+        self.cs.next_action()
+        self.cs.services_added['django'] = 'deploy-1'
+        self.cs.machines_added['0'] = 'addMachines-0'
+        bundle = {'services': {}}
+        self.cs.reset(bundle)
+        self.assertIs(bundle, self.cs.bundle)
+        self.assertEqual([], self.cs.recv())
+        self.assertEqual(0, self.cs.next_action())
+        self.assertEqual({}, self.cs.services_added)
+        self.assertEqual({}, self.cs.machines_added)
+
+
+_bundle = {
+    'services': {
+        'wordpress': {
+            'charm': 'cs:trusty/wordpress-0',
+            'num_units': 2,
+            'expose': True,
+            'annotations': {'gui-x': 10},
+        },
+        'mysql': {
+            'charm': 'cs:trusty/mysql-47',
+            'num_units': 3,
+            'to': ['lxc:wordpress/1', 'new', 'kvm:0'],
+        },
+        'haproxy': {
+            'charm': 'cs:trusty/haproxy-1',
+            'num_units': 3,
+            'to': ['lxd:new'],
+        },
+    },
+    'machines': {0: {'annotations': {'foo': 'bar'}}},
+    'relations': [['wordpress:db', 'mysql:db'], ['haproxy', 'wordpress']],
+}
+
+
+class TestChange(unittest.TestCase):
+
+    change_dict = {
+        'id': 'deploy-1',
+        'method': 'deploy',
+        'args': ['$addCharm-0', 'django', {'debug': True}, '', {}],
+        'requires': ['addCharm-0'],
+    }
+
+    def test_from_dict(self):
+        change = changeset.Change.from_dict(self.change_dict)
+        self.assertEqual('deploy-1', change.id)
+        self.assertEqual('deploy', change.method)
+        self.assertEqual(
+            ('$addCharm-0', 'django', {'debug': True}, '', {}), change.args)
+        self.assertEqual(('addCharm-0',), change.requires)
+
+    def test_to_dict(self):
+        change = changeset.Change.from_dict(self.change_dict)
+        self.assertEqual(self.change_dict, change.to_dict())
+
+    def test_to_json(self):
+        change = changeset.Change.from_dict(self.change_dict)
+        self.assertEqual(self.change_dict, json.loads(change.to_json()))
+
+    def test_shared_methods(self):
+        method = ''.join(['dep', 'loy'])
+        change1 = changeset.Change('deploy-1', method, [], [])
+        change2 = changeset.Change('deploy-2', 'deploy', [], [])
+        self.assertIs(change1.method, change2.method)
+
+    def test_slots(self):
+        change = changeset.Change.from_dict(self.change_dict)
+        with self.assertRaises(AttributeError):
+            change.foo = 'bar'
+
+    def test_equality(self):
+        change1 = changeset.Change.from_dict(self.change_dict)
+        change2 = changeset.Change.from_dict(self.change_dict)
+        change3 = changeset.Change('deploy-2', 'deploy', [], [])
+        self.assertEqual(change1, change2)
+        self.assertNotEqual(change1, change3)
+        self.assertNotEqual(change1, self.change_dict)
+
 
 class TestParse(unittest.TestCase):
 
@@ -66,6 +183,1331 @@ class TestParse(unittest.TestCase):
         bundle = {'services': {}}
         self.assertEqual([], list(changeset.parse(bundle)))
 
+    def test_parse_compact(self):
+        changes = list(changeset.parse(_bundle, compact=True))
+        self.assertTrue(changes)
+        for change in changes:
+            self.assertIsInstance(change, changeset.Change)
+        self.assertEqual(
+            list(changeset.parse(_bundle)),
+            [change.to_dict() for change in changes])
+
+    def test_parse_reusing_changeset(self):
+        cs = changeset.ChangeSet({'services': {}})
+        bundles = [
+            {'services': {'django': {'charm': 'cs:trusty/django-42'}}},
+            {'services': {'mysql': {'charm': 'cs:trusty/mysql-47'}}},
+        ]
+        for bundle in bundles:
+            changes = list(changeset.parse(bundle, changeset=cs))
+            self.assertEqual(list(changeset.parse(bundle)), changes)
+            self.assertIs(bundle, cs.bundle)
+        self.assertEqual(['mysql'], list(cs.services_added))
+
+
+class TestStream(unittest.TestCase):
+
+    def test_stream(self):
+        expected = list(changeset.parse(_bundle))
+        self.assertEqual(expected, list(changeset.stream(_bundle)))
+
+    def test_stream_legacy(self):
+        bundle = {
+            'services': {
+                'wordpress': {
+                    'charm': 'cs:utopic/wordpress-0',
+                    'num_units': 1,
+                },
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 3,
+                    'to': ['lxc:wordpress', '0'],
+                },
+            },
+        }
+        expected = list(changeset.parse(bundle))
+        self.assertEqual(expected, list(changeset.stream(bundle)))
+
+    def test_stream_compact(self):
+        changes = list(changeset.stream(_bundle, compact=True))
+        self.assertEqual(list(changeset.parse(_bundle, compact=True)), changes)
+
+    def test_changes_are_not_collected(self):
+        bundle = {
+            'services': {
+                'django': {'charm': 'cs:trusty/django-42', 'num_units': 10**9},
+            },
+        }
+        changes = list(itertools.islice(changeset.stream(bundle), 3))
+        self.assertEqual(['addCharm-0', 'deploy-1', 'addUnit-2'],
+                         [change['id'] for change in changes])
+
+    def test_reusing_changeset(self):
+        cs = changeset.ChangeSet({'services': {}})
+        changes = list(changeset.stream(_bundle, changeset=cs))
+        self.assertEqual(list(changeset.parse(_bundle)), changes)
+        self.assertIs(_bundle, cs.bundle)
+
+
+class TestIntIds(unittest.TestCase):
+
+    def test_parse(self):
+        bundle = {
+            'services': {
+                'django': {'charm': 'cs:trusty/django-42', 'num_units': 1},
+                'mysql': {'charm': 'cs:trusty/mysql-47'},
+            },
+            'relations': [['django:db', 'mysql']],
+        }
+        self.assertEqual([
+            {
+                'id': 0,
+                'method': 'addCharm',
+                'args': ['cs:trusty/django-42'],
+                'requires': [],
+            },
+            {
+                'id': 1,
+                'method': 'deploy',
+                'args': [
+                    changeset.Placeholder('addCharm', 0), 'django', {}, '',
+                    {}],
+                'requires': [0],
+            },
+            {
+                'id': 2,
+                'method': 'addCharm',
+                'args': ['cs:trusty/mysql-47'],
+                'requires': [],
+            },
+            {
+                'id': 3,
+                'method': 'deploy',
+                'args': [
+                    changeset.Placeholder('addCharm', 2), 'mysql', {}, '',
+                    {}],
+                'requires': [2],
+            },
+            {
+                'id': 4,
+                'method': 'addRelation',
+                'args': [
+                    changeset.Placeholder('deploy', 1, 'db'),
+                    changeset.Placeholder('deploy', 3),
+                ],
+                'requires': [1, 3],
+            },
+            {
+                'id': 5,
+                'method': 'addUnit',
+                'args': [changeset.Placeholder('deploy', 1), None],
+                'requires': [1],
+            },
+        ], list(changeset.parse(bundle, int_ids=True)))
+
+    def test_render(self):
+        changes = changeset.parse(_bundle, int_ids=True)
+        self.assertEqual(
+            list(changeset.parse(_bundle)), changeset.render(changes))
+
+    def test_render_compact(self):
+        changes = changeset.stream(_bundle, int_ids=True, compact=True)
+        self.assertEqual(
+            list(changeset.parse(_bundle)), changeset.render(changes))
+
+    def test_render_unknown_requirement(self):
+        changes = [{'id': 1, 'method': 'deploy', 'args': [], 'requires': [0]}]
+        with self.assertRaises(ValueError) as ctx:
+            changeset.render(changes)
+        self.assertEqual(
+            b'change 1 requires unknown change 0', ctx.exception.args[0])
+
+    def test_reused_changeset(self):
+        cs = changeset.ChangeSet({'services': {}})
+        changes = list(changeset.parse(_bundle, changeset=cs, int_ids=True))
+        self.assertEqual(0, changes[0]['id'])
+        changes = list(changeset.parse(_bundle, changeset=cs))
+        self.assertEqual('addCharm-0', changes[0]['id'])
+
+    def test_placeholder(self):
+        placeholder = changeset.Placeholder('deploy', 1, 'db')
+        self.assertEqual('$deploy-1:db', '{}'.format(placeholder))
+        self.assertEqual('<Placeholder: $deploy-1:db>', repr(placeholder))
+        self.assertEqual(placeholder, changeset.Placeholder('deploy', 1, 'db'))
+        self.assertNotEqual(placeholder, changeset.Placeholder('deploy', 1))
+        self.assertEqual('$deploy-1', '{}'.format(
+            changeset.Placeholder('deploy', 1)))
+
+    def test_post_processing_requires_render(self):
+        changes = list(changeset.parse(_bundle, int_ids=True))
+        funcs = (
+            changeset.collapse_units,
+            changeset.expand_units,
+            changeset.collapse_machines,
+            changeset.fuse_changes,
+        )
+        for func in funcs:
+            with self.assertRaises(ValueError) as ctx:
+                func(changes)
+            msg = '{} requires string change ids: use render()'.format(
+                func.__name__)
+            self.assertEqual(msg.encode('utf-8'), ctx.exception.args[0])
+            self.assertEqual(
+                func(changeset.parse(_bundle)),
+                func(changeset.render(changes)))
+
+    def test_to_json_requires_render(self):
+        changes = changeset.parse(_bundle, int_ids=True, compact=True)
+        with self.assertRaises(ValueError) as ctx:
+            next(changes).to_json()
+        self.assertEqual(
+            b'changes with integer ids cannot be encoded: use render()',
+            ctx.exception.args[0])
+
+
+class TestStableIds(unittest.TestCase):
+
+    def test_ids(self):
+        changes = list(changeset.parse(_bundle, stable_ids=True))
+        self.assertEqual([
+            'addCharm-cs/trusty/haproxy-1',
+            'deploy-haproxy',
+            'addCharm-cs/trusty/mysql-47',
+            'deploy-mysql',
+            'addCharm-cs/trusty/wordpress-0',
+            'deploy-wordpress',
+            'expose-wordpress',
+            'setAnnotations-wordpress',
+            'addMachines-0',
+            'setAnnotations-0',
+            'addRelation-wordpress:db,mysql:db',
+            'addRelation-haproxy,wordpress',
+            'addMachines-haproxy/0',
+            'addUnit-haproxy/0',
+            'addMachines-haproxy/1',
+            'addUnit-haproxy/1',
+            'addMachines-haproxy/2',
+            'addUnit-haproxy/2',
+            'addMachines-mysql/0',
+            'addUnit-mysql/0',
+            'addMachines-mysql/1',
+            'addUnit-mysql/1',
+            'addMachines-mysql/2',
+            'addUnit-mysql/2',
+            'addUnit-wordpress/0',
+            'addUnit-wordpress/1',
+        ], [change['id'] for change in changes])
+        self.assertEqual({
+            'id': 'addMachines-mysql/0',
+            'method': 'addMachines',
+            'args': [{
+                'containerType': 'lxc',
+                'parentId': '$addUnit-wordpress/1',
+            }],
+            'requires': ['addUnit-wordpress/1'],
+        }, changes[18])
+        self.assertEqual(
+            ['$deploy-wordpress:db', '$deploy-mysql:db'], changes[10]['args'])
+
+    def test_same_changes(self):
+        # Apart from ids, changes are the same generated with sequential ids.
+        changes = list(changeset.parse(_bundle))
+        stable_changes = list(changeset.parse(_bundle, stable_ids=True))
+        mapping = dict(
+            (change['id'], stable_change['id'])
+            for change, stable_change in zip(changes, stable_changes))
+        for change, stable_change in zip(changes, stable_changes):
+            self.assertEqual(change['method'], stable_change['method'])
+            self.assertEqual(
+                [mapping[i] for i in change['requires']],
+                stable_change['requires'])
+
+    def test_edited_bundle(self):
+        original = set(
+            change['id']
+            for change in changeset.parse(_bundle, stable_ids=True))
+        bundle = copy.deepcopy(_bundle)
+        bundle['services']['apache'] = {
+            'charm': 'cs:trusty/apache2-1',
+            'num_units': 1,
+        }
+        bundle['services']['mysql']['num_units'] = 4
+        edited = set(
+            change['id']
+            for change in changeset.parse(bundle, stable_ids=True))
+        self.assertEqual(set(), original - edited)
+        self.assertEqual(set([
+            'addCharm-cs/trusty/apache2-1',
+            'deploy-apache',
+            'addUnit-apache/0',
+            'addMachines-mysql/3',
+            'addUnit-mysql/3',
+        ]), edited - original)
+
+    def test_existing_units(self):
+        model = {'services': {'mysql': {'num_units': 2}}}
+        changes = changeset.parse(_bundle, model=model, stable_ids=True)
+        self.assertIn(
+            'addUnit-mysql/2', [change['id'] for change in changes])
+
+    def test_int_ids(self):
+        with self.assertRaises(ValueError) as ctx:
+            list(changeset.parse(_bundle, int_ids=True, stable_ids=True))
+        self.assertEqual(
+            b'integer ids and stable ids are mutually exclusive',
+            ctx.exception.args[0])
+
+    def test_repeated_relations(self):
+        bundle = copy.deepcopy(_bundle)
+        bundle['relations'] *= 3
+        changes = list(changeset.parse(bundle, stable_ids=True))
+        ids = [change['id'] for change in changes]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual([
+            'addRelation-wordpress:db,mysql:db',
+            'addRelation-haproxy,wordpress',
+            'addRelation-wordpress:db,mysql:db#1',
+            'addRelation-haproxy,wordpress#1',
+            'addRelation-wordpress:db,mysql:db#2',
+            'addRelation-haproxy,wordpress#2',
+        ], [i for i in ids if i.startswith('addRelation-')])
+        # Unique ids allow building the dependency graph.
+        changeset.dependency_graph(changes)
+
+    def test_collapse_machines(self):
+        bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 2,
+                    'to': ['new'],
+                },
+            },
+            'machines': {},
+        }
+        changes = changeset.collapse_machines(
+            changeset.parse(bundle, stable_ids=True))
+        self.assertEqual(
+            ['$deploy-django', '$addMachinesBatch-django/0#1'],
+            changes[-1]['args'])
+        self.assertEqual(
+            ['deploy-django', 'addMachinesBatch-django/0'],
+            changes[-1]['requires'])
+
+
+class TestStreamTo(unittest.TestCase):
+
+    def test_stream_to(self):
+        changes = []
+        changeset.stream_to(_bundle, changes.append)
+        self.assertEqual(list(changeset.parse(_bundle)), changes)
+
+    def test_handler(self):
+        def handler(cs):
+            cs.send('foo')
+            cs.send('bar')
+        changes = []
+        changeset.stream_to(_bundle, changes.append, handler=handler)
+        self.assertEqual(['foo', 'bar'], changes)
+
+    def test_reusing_changeset(self):
+        cs = changeset.ChangeSet({'services': {}})
+        changes = []
+        changeset.stream_to(_bundle, changes.append, changeset=cs)
+        self.assertEqual(list(changeset.parse(_bundle)), changes)
+        # The sink is only used while parsing.
+        self.assertIsNone(cs.sink)
+
+
+class TestDependencyGraph(unittest.TestCase):
+
+    changes = [
+        helpers.make_change('addCharm-0'),
+        helpers.make_change('deploy-1', 'addCharm-0'),
+        helpers.make_change('addMachines-2'),
+        helpers.make_change('addRelation-3', 'deploy-1', 'deploy-5'),
+        helpers.make_change('addCharm-4'),
+        helpers.make_change('deploy-5', 'addCharm-4'),
+        helpers.make_change('addUnit-6', 'deploy-1', 'addMachines-7'),
+        helpers.make_change('addMachines-7', 'addUnit-8'),
+        helpers.make_change('addUnit-8', 'deploy-5'),
+    ]
+
+    def test_graph(self):
+        graph = changeset.dependency_graph(self.changes)
+        self.assertEqual(9, len(graph))
+        self.assertEqual(('deploy-1', 'deploy-5'),
+                         graph.requires['addRelation-3'])
+        self.assertEqual(['addRelation-3', 'addUnit-8'],
+                         graph.required_by['deploy-5'])
+        self.assertEqual([], graph.required_by['addUnit-6'])
+
+    def test_wave_ids(self):
+        graph = changeset.dependency_graph(self.changes)
+        self.assertEqual([
+            ['addCharm-0', 'addMachines-2', 'addCharm-4'],
+            ['deploy-1', 'deploy-5'],
+            ['addRelation-3', 'addUnit-8'],
+            ['addMachines-7'],
+            ['addUnit-6'],
+        ], graph.wave_ids())
+
+    def test_waves(self):
+        waves = changeset.waves(self.changes)
+        self.assertEqual(
+            [[self.changes[0], self.changes[2], self.changes[4]],
+             [self.changes[1], self.changes[5]],
+             [self.changes[3], self.changes[8]],
+             [self.changes[7]],
+             [self.changes[6]]],
+            waves)
+
+    def test_waves_bundle(self):
+        changes = list(changeset.parse(_bundle))
+        done = set()
+        waves = changeset.waves(changes)
+        for wave in waves:
+            for change in wave:
+                self.assertTrue(done.issuperset(change['requires']))
+            done.update(change['id'] for change in wave)
+        self.assertEqual(len(changes), len(done))
+
+    def test_waves_compact(self):
+        changes = list(changeset.parse(_bundle))
+        compact_changes = list(changeset.parse(_bundle, compact=True))
+        self.assertEqual(
+            changeset.dependency_graph(changes).wave_ids(),
+            changeset.dependency_graph(compact_changes).wave_ids())
+
+    def test_no_changes(self):
+        self.assertEqual([], changeset.waves([]))
+
+    def test_circular_requirements(self):
+        changes = [
+            helpers.make_change('addUnit-0', 'addMachines-1'),
+            helpers.make_change('addMachines-1', 'addUnit-0'),
+        ]
+        with self.assertRaises(ValueError) as ctx:
+            changeset.waves(changes)
+        self.assertEqual(
+            b'change set requirements are circular', ctx.exception.args[0])
+
+    def test_unknown_requirement(self):
+        with self.assertRaises(ValueError) as ctx:
+            changeset.dependency_graph(
+                [helpers.make_change('deploy-1', 'bad-0')])
+        self.assertEqual(
+            b'change deploy-1 requires unknown change bad-0',
+            ctx.exception.args[0])
+
+
+class TestDependencyArrays(unittest.TestCase):
+
+    changes = TestDependencyGraph.changes
+
+    def test_arrays(self):
+        arrays = changeset.dependency_arrays(self.changes)
+        self.assertEqual(
+            [change['id'] for change in self.changes], arrays.ids)
+        self.assertEqual(
+            ['addCharm', 'deploy', 'addMachines', 'addRelation', 'addUnit'],
+            arrays.methods)
+        self.assertEqual(
+            [0, 1, 2, 3, 0, 1, 4, 2, 4], arrays.method_codes.tolist())
+        self.assertEqual(
+            [0, 0, 1, 1, 3, 3, 4, 6, 7, 8], arrays.offsets.tolist())
+        self.assertEqual([0, 1, 5, 4, 1, 7, 8, 5], arrays.indices.tolist())
+
+    def test_requirements(self):
+        changes = list(changeset.parse(_bundle))
+        arrays = changeset.dependency_arrays(changes)
+        for position, change in enumerate(changes):
+            start, end = arrays.offsets[position:position + 2]
+            self.assertEqual(
+                change['requires'],
+                [arrays.ids[i] for i in arrays.indices[start:end]])
+            self.assertEqual(
+                change['method'],
+                arrays.methods[arrays.method_codes[position]])
+
+    def test_compact(self):
+        self.assertEqual(
+            changeset.dependency_arrays(changeset.parse(_bundle)),
+            changeset.dependency_arrays(
+                changeset.parse(_bundle, compact=True)))
+
+    def test_no_changes(self):
+        arrays = changeset.dependency_arrays([])
+        self.assertEqual([], arrays.ids)
+        self.assertEqual([0], arrays.offsets.tolist())
+        self.assertEqual([], arrays.indices.tolist())
+
+    def test_unknown_requirement(self):
+        with self.assertRaises(ValueError) as ctx:
+            changeset.dependency_arrays(
+                [helpers.make_change('deploy-1', 'bad-0')])
+        self.assertEqual(
+            b'change deploy-1 requires unknown change bad-0',
+            ctx.exception.args[0])
+
+    @unittest.skipIf(numpy is None, 'NumPy is not available')
+    def test_numpy(self):
+        arrays = changeset.dependency_arrays(self.changes, use_numpy=True)
+        self.assertIsInstance(arrays.indices, numpy.ndarray)
+        self.assertEqual([0, 1, 5, 4, 1, 7, 8, 5], arrays.indices.tolist())
+        # Compute the number of requirements of each change.
+        self.assertEqual(
+            [0, 1, 0, 2, 0, 1, 2, 1, 1],
+            numpy.diff(arrays.offsets).tolist())
+
+
+class TestReduceRequires(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'django': {
+                'charm': 'cs:trusty/django-42',
+                'num_units': 2,
+                'to': ['lxc:mysql/0', 'django/0'],
+            },
+            'mysql': {
+                'charm': 'cs:trusty/mysql-47',
+                'num_units': 1,
+            },
+        },
+        'machines': {},
+    }
+
+    def test_reduce(self):
+        changes = [
+            helpers.make_change('addCharm-0'),
+            helpers.make_change('deploy-1', 'addCharm-0'),
+            helpers.make_change('addUnit-2', 'deploy-1', 'addCharm-0'),
+            helpers.make_change('addUnit-3', 'addUnit-2', 'deploy-1'),
+        ]
+        reduced = changeset.reduce_requires(changes)
+        self.assertEqual(
+            [[], ['addCharm-0'], ['deploy-1'], ['addUnit-2']],
+            [change['requires'] for change in reduced])
+        # The original changes are not modified.
+        self.assertEqual(['addUnit-2', 'deploy-1'], changes[3]['requires'])
+
+    def test_reduce_bundle(self):
+        changes = list(changeset.parse(self.bundle))
+        reduced = changeset.reduce_requires(changes)
+        self.assertEqual(
+            [change['id'] for change in changes],
+            [change['id'] for change in reduced])
+        requires = dict(
+            (change['id'], change['requires']) for change in reduced)
+        # The second django unit is placed alongside the first one, which
+        # already requires the django service.
+        self.assertEqual(['deploy-1', 'addMachines-7'], requires['addUnit-4'])
+        self.assertEqual(['addUnit-4'], requires['addUnit-5'])
+        self.assertEqual(
+            changeset.dependency_graph(changes).wave_ids(),
+            changeset.dependency_graph(reduced).wave_ids())
+
+    def test_reduce_compact(self):
+        changes = changeset.parse(self.bundle, compact=True)
+        reduced = changeset.reduce_requires(changes)
+        self.assertIsInstance(reduced[0], changeset.Change)
+        self.assertEqual(
+            changeset.reduce_requires(changeset.parse(self.bundle)),
+            [change.to_dict() for change in reduced])
+
+    def test_parse_minimal_requires(self):
+        expected = changeset.reduce_requires(changeset.parse(self.bundle))
+        self.assertEqual(
+            expected,
+            list(changeset.parse(self.bundle, minimal_requires=True)))
+        self.assertEqual(
+            expected,
+            list(changeset.stream(self.bundle, minimal_requires=True)))
+
+    def test_stream_minimal_requires_hosts(self):
+        # Units are only tracked while later units can be placed on them.
+        bundles = [_bundle, TestParsePage.bundle, TestParseWithModel.bundle]
+        for bundle in bundles:
+            for kwargs in ({}, {'int_ids': True}, {'stable_ids': True}):
+                expected = changeset.reduce_requires(
+                    changeset.parse(bundle, **kwargs))
+                self.assertEqual(expected, list(changeset.stream(
+                    bundle, minimal_requires=True, **kwargs)))
+                self.assertEqual(expected, list(changeset.parse(
+                    bundle, minimal_requires=True, **kwargs)))
+
+    def test_invalid_requirements(self):
+        with self.assertRaises(ValueError) as ctx:
+            changeset.reduce_requires(
+                [helpers.make_change('deploy-1', 'bad-0')])
+        self.assertEqual(
+            b'change deploy-1 requires unknown change bad-0',
+            ctx.exception.args[0])
+
+
+class TestParseWithModel(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'haproxy': {
+                'charm': 'cs:trusty/haproxy-1',
+                'num_units': 1,
+                'to': 'lxc:wordpress',
+            },
+            'mysql': {
+                'charm': 'cs:trusty/mysql-47',
+                'num_units': 2,
+                'to': ['lxc:wordpress/0', '1'],
+            },
+            'wordpress': {
+                'charm': 'cs:trusty/wordpress-0',
+                'num_units': 2,
+                'expose': True,
+                'annotations': {'gui-x': 10, 'gui-y': 20},
+                'to': ['0'],
+            },
+        },
+        'machines': {0: {'annotations': {'foo': 'bar'}}, 1: {}},
+        'relations': [
+            ['mysql:db', 'wordpress:db'],
+            ['wordpress:cache', 'mysql:cache'],
+        ],
+    }
+    model = {
+        'services': {
+            'mysql': {'num_units': 1},
+            'wordpress': {
+                'num_units': 1,
+                'expose': True,
+                'annotations': {'gui-x': 10, 'gui-y': 0},
+            },
+        },
+        'machines': {'0': {'id': '5'}},
+        'relations': [['wordpress:db', 'mysql']],
+    }
+
+    def test_missing_changes(self):
+        self.assertEqual([
+            {
+                'id': 'addCharm-0',
+                'method': 'addCharm',
+                'args': ['cs:trusty/haproxy-1'],
+                'requires': [],
+            },
+            {
+                'id': 'deploy-1',
+                'method': 'deploy',
+                'args': ['$addCharm-0', 'haproxy', {}, '', {}],
+                'requires': ['addCharm-0'],
+            },
+            {
+                'id': 'setAnnotations-2',
+                'method': 'setAnnotations',
+                'args': ['wordpress', 'service', {'gui-y': 20}],
+                'requires': [],
+            },
+            {
+                'id': 'setAnnotations-3',
+                'method': 'setAnnotations',
+                'args': ['5', 'machine', {'foo': 'bar'}],
+                'requires': [],
+            },
+            {
+                'id': 'addMachines-4',
+                'method': 'addMachines',
+                'args': [{'constraints': '', 'series': ''}],
+                'requires': [],
+            },
+            {
+                'id': 'addRelation-5',
+                'method': 'addRelation',
+                'args': ['wordpress:cache', 'mysql:cache'],
+                'requires': [],
+            },
+            {
+                'id': 'addMachines-9',
+                'method': 'addMachines',
+                'args': [{'containerType': 'lxc', 'parentId': 'wordpress/0'}],
+                'requires': [],
+            },
+            {
+                'id': 'addUnit-6',
+                'method': 'addUnit',
+                'args': ['$deploy-1', '$addMachines-9'],
+                'requires': ['deploy-1', 'addMachines-9'],
+            },
+            {
+                'id': 'addUnit-7',
+                'method': 'addUnit',
+                'args': ['mysql', '$addMachines-4'],
+                'requires': ['addMachines-4'],
+            },
+            {
+                'id': 'addUnit-8',
+                'method': 'addUnit',
+                'args': ['wordpress', '5'],
+                'requires': [],
+            },
+        ], list(changeset.parse(self.bundle, model=self.model)))
+
+    def test_stream(self):
+        self.assertEqual(
+            list(changeset.parse(self.bundle, model=self.model)),
+            list(changeset.stream(self.bundle, model=self.model)))
+
+    def test_empty_model(self):
+        self.assertEqual(
+            list(changeset.parse(_bundle)),
+            list(changeset.parse(_bundle, model={})))
+
+    def test_deployed_bundle(self):
+        model = {
+            'services': {
+                'wordpress': {
+                    'num_units': 2,
+                    'expose': True,
+                    'annotations': {'gui-x': 10},
+                },
+                'mysql': {'num_units': 3},
+                'haproxy': {'num_units': 5},
+            },
+            'machines': {0: {'annotations': {'foo': 'bar', 'bad': 'wolf'}}},
+            'relations': [
+                ['mysql:db', 'wordpress:db'],
+                ['haproxy:website', 'wordpress:website'],
+            ],
+        }
+        self.assertEqual([], list(changeset.parse(_bundle, model=model)))
+
+    def test_reusing_changeset(self):
+        cs = changeset.ChangeSet({'services': {}}, model=self.model)
+        changes = list(changeset.parse(_bundle, changeset=cs))
+        # The model is discarded when the change set is reset.
+        self.assertEqual(list(changeset.parse(_bundle)), changes)
+
+
+class TestValidateAndParse(unittest.TestCase):
+
+    def test_valid_bundle(self):
+        errors, changes = changeset.validate_and_parse(_bundle)
+        self.assertEqual([], errors)
+        self.assertEqual(list(changeset.parse(_bundle)), changes)
+
+    def test_invalid_bundle(self):
+        errors, changes = changeset.validate_and_parse(
+            {'services': {'django': {}}})
+        self.assertEqual(['no charm specified for service django'], errors)
+        self.assertIsNone(changes)
+
+    def test_placements_parsed_once(self):
+        parse = models.parse_v4_unit_placement
+        path = 'jujubundlelib.models.parse_v4_unit_placement'
+        with mock.patch(path, side_effect=parse) as mock_parse:
+            changeset.validate_and_parse(_bundle)
+        self.assertEqual(
+            ['kvm:0', 'lxc:wordpress/1', 'lxd:new', 'new'],
+            sorted(call[0][0] for call in mock_parse.call_args_list))
+
+
+class TestCollapseUnits(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'django': {
+                'charm': 'cs:trusty/django-42',
+                'num_units': 3,
+                'to': ['lxc:new', '0'],
+            },
+            'haproxy': {
+                'charm': 'cs:trusty/haproxy-1',
+                'num_units': 2,
+                'to': 'lxc:mysql',
+            },
+            'mysql': {'charm': 'cs:trusty/mysql-47', 'num_units': 4},
+        },
+        'machines': {0: {}},
+    }
+
+    def test_collapse(self):
+        changes = changeset.collapse_units(changeset.parse(self.bundle))
+        self.assertEqual([
+            'addCharm-0', 'deploy-1', 'addCharm-2', 'deploy-3', 'addCharm-4',
+            'deploy-5', 'addMachines-6', 'addMachines-16', 'addUnit-7',
+            'addUnits-8', 'addMachines-17', 'addUnit-10', 'addMachines-18',
+            'addUnit-11', 'addUnit-12', 'addUnit-13', 'addUnits-14',
+        ], [change['id'] for change in changes])
+        self.assertEqual([
+            {
+                'id': 'addUnits-8',
+                'method': 'addUnits',
+                'args': ['$deploy-1', '$addMachines-6', 2],
+                'requires': ['deploy-1', 'addMachines-6'],
+            },
+            {
+                'id': 'addUnits-14',
+                'method': 'addUnits',
+                'args': ['$deploy-5', None, 2],
+                'requires': ['deploy-5'],
+            },
+        ], [change for change in changes if change['method'] == 'addUnits'])
+
+    def test_expand(self):
+        changes = list(changeset.parse(self.bundle))
+        self.assertEqual(
+            changes,
+            changeset.expand_units(changeset.collapse_units(changes)))
+
+    def test_no_units(self):
+        changes = list(changeset.parse({'services': {}}))
+        self.assertEqual([], changeset.collapse_units(changes))
+
+    def test_large_scale_out(self):
+        bundle = {
+            'services': {
+                'django': {'charm': 'cs:trusty/django-42', 'num_units': 2000},
+            },
+        }
+        changes = list(changeset.parse(bundle))
+        collapsed = changeset.collapse_units(changes)
+        self.assertEqual([{
+            'id': 'addUnits-2',
+            'method': 'addUnits',
+            'args': ['$deploy-1', None, 2000],
+            'requires': ['deploy-1'],
+        }], collapsed[2:])
+        self.assertEqual(changes, changeset.expand_units(collapsed))
+
+
+class TestCollapseMachines(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'django': {
+                'charm': 'cs:trusty/django-42',
+                'num_units': 3,
+                'to': ['lxd:new'],
+            },
+            'mysql': {
+                'charm': 'cs:trusty/mysql-47',
+                'num_units': 2,
+                'to': ['new', 'lxc:django/1'],
+            },
+        },
+        'machines': {},
+    }
+
+    def test_collapse(self):
+        changes = changeset.collapse_machines(changeset.parse(self.bundle))
+        self.assertEqual([
+            {
+                'id': 'addCharm-0',
+                'method': 'addCharm',
+                'args': ['cs:trusty/django-42'],
+                'requires': [],
+            },
+            {
+                'id': 'deploy-1',
+                'method': 'deploy',
+                'args': ['$addCharm-0', 'django', {}, '', {}],
+                'requires': ['addCharm-0'],
+            },
+            {
+                'id': 'addCharm-2',
+                'method': 'addCharm',
+                'args': ['cs:trusty/mysql-47'],
+                'requires': [],
+            },
+            {
+                'id': 'deploy-3',
+                'method': 'deploy',
+                'args': ['$addCharm-2', 'mysql', {}, '', {}],
+                'requires': ['addCharm-2'],
+            },
+            {
+                'id': 'addMachinesBatch-9',
+                'method': 'addMachinesBatch',
+                'args': [{'containerType': 'lxc'}, 3],
+                'requires': [],
+            },
+            {
+                'id': 'addUnit-4',
+                'method': 'addUnit',
+                'args': ['$deploy-1', '$addMachinesBatch-9#0'],
+                'requires': ['deploy-1', 'addMachinesBatch-9'],
+            },
+            {
+                'id': 'addUnit-5',
+                'method': 'addUnit',
+                'args': ['$deploy-1', '$addMachinesBatch-9#1'],
+                'requires': ['deploy-1', 'addMachinesBatch-9'],
+            },
+            {
+                'id': 'addUnit-6',
+                'method': 'addUnit',
+                'args': ['$deploy-1', '$addMachinesBatch-9#2'],
+                'requires': ['deploy-1', 'addMachinesBatch-9'],
+            },
+            {
+                'id': 'addMachines-12',
+                'method': 'addMachines',
+                'args': [{}],
+                'requires': [],
+            },
+            {
+                'id': 'addUnit-7',
+                'method': 'addUnit',
+                'args': ['$deploy-3', '$addMachines-12'],
+                'requires': ['deploy-3', 'addMachines-12'],
+            },
+            {
+                'id': 'addMachines-13',
+                'method': 'addMachines',
+                'args': [{'containerType': 'lxc', 'parentId': '$addUnit-5'}],
+                'requires': ['addUnit-5'],
+            },
+            {
+                'id': 'addUnit-8',
+                'method': 'addUnit',
+                'args': ['$deploy-3', '$addMachines-13'],
+                'requires': ['deploy-3', 'addMachines-13'],
+            },
+        ], changes)
+
+    def test_nested_placeholders(self):
+        changes = [
+            helpers.make_change('addMachines-0'),
+            helpers.make_change('addMachines-1'),
+            helpers.make_change('addMachines-2', 'addMachines-1'),
+        ]
+        changes[0]['args'] = changes[1]['args'] = [{}]
+        changes[2]['args'] = [{'parentId': '$addMachines-1'}]
+        collapsed = changeset.collapse_machines(changes)
+        self.assertEqual([
+            {
+                'id': 'addMachinesBatch-0',
+                'method': 'addMachinesBatch',
+                'args': [{}, 2],
+                'requires': [],
+            },
+            {
+                'id': 'addMachines-2',
+                'method': 'addMachines',
+                'args': [{'parentId': '$addMachinesBatch-0#1'}],
+                'requires': ['addMachinesBatch-0'],
+            },
+        ], collapsed)
+        # The original changes are not modified.
+        self.assertEqual([{'parentId': '$addMachines-1'}], changes[2]['args'])
+
+    def test_no_batches(self):
+        bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 2,
+                    'to': ['new', 'lxc:new'],
+                },
+            },
+            'machines': {},
+        }
+        changes = list(changeset.parse(bundle))
+        self.assertEqual(changes, changeset.collapse_machines(changes))
+
+
+class TestFuseChanges(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'django': {
+                'charm': 'cs:trusty/django-42',
+                'num_units': 1,
+                'expose': True,
+                'annotations': {'gui-x': '10'},
+                'to': ['1'],
+            },
+        },
+        'machines': {
+            '1': {'annotations': {'foo': 'bar'}},
+        },
+    }
+
+    def test_fuse(self):
+        changes = list(changeset.parse(self.bundle))
+        self.assertEqual(7, len(changes))
+        self.assertEqual([
+            {
+                'id': 'addCharm-0',
+                'method': 'addCharm',
+                'args': ['cs:trusty/django-42'],
+                'requires': [],
+            },
+            {
+                'id': 'deploy-1',
+                'method': 'deploy',
+                'args': ['$addCharm-0', 'django', {}, '', {}],
+                'requires': ['addCharm-0'],
+                'expose': True,
+                'annotations': {'gui-x': '10'},
+            },
+            {
+                'id': 'addMachines-4',
+                'method': 'addMachines',
+                'args': [{'series': '', 'constraints': ''}],
+                'requires': [],
+                'annotations': {'foo': 'bar'},
+            },
+            {
+                'id': 'addUnit-6',
+                'method': 'addUnit',
+                'args': ['$deploy-1', '$addMachines-4'],
+                'requires': ['deploy-1', 'addMachines-4'],
+            },
+        ], changeset.fuse_changes(changes))
+        # The original changes are not modified.
+        self.assertEqual(changes, list(changeset.parse(self.bundle)))
+
+    def test_supported_methods(self):
+        changes = changeset.fuse_changes(
+            changeset.parse(self.bundle), supported=['expose'])
+        self.assertEqual([
+            'addCharm-0',
+            'deploy-1',
+            'setAnnotations-3',
+            'addMachines-4',
+            'setAnnotations-5',
+            'addUnit-6',
+        ], [change['id'] for change in changes])
+        self.assertTrue(changes[1]['expose'])
+
+    def test_requirements_rewritten(self):
+        changes = [
+            helpers.make_change('deploy-0'),
+            helpers.make_change('expose-1', 'deploy-0'),
+            helpers.make_change('addUnit-2', 'deploy-0', 'expose-1'),
+        ]
+        changes[1]['args'] = ['$deploy-0']
+        self.assertEqual([
+            {
+                'id': 'deploy-0',
+                'method': 'deploy',
+                'args': [],
+                'requires': [],
+                'expose': True,
+            },
+            {
+                'id': 'addUnit-2',
+                'method': 'addUnit',
+                'args': [],
+                'requires': ['deploy-0'],
+            },
+        ], changeset.fuse_changes(changes))
+
+    def test_existing_entities(self):
+        # Changes on entities already in the model have no parent.
+        model = {
+            'services': {'django': {'num_units': 1}},
+            'machines': {'1': {}},
+        }
+        changes = list(changeset.parse(self.bundle, model=model))
+        self.assertEqual(
+            ['expose-0', 'setAnnotations-1', 'setAnnotations-2'],
+            [change['id'] for change in changes])
+        self.assertEqual(changes, changeset.fuse_changes(changes))
+
+
+class TestSummarize(unittest.TestCase):
+
+    def get_summary(self, bundle, model=None):
+        """Return the summary computed from the bundle changes."""
+        changes = list(changeset.parse(bundle, model=model))
+        methods = collections.Counter(change['method'] for change in changes)
+        containers = collections.Counter(
+            change['args'][0]['containerType'] for change in changes
+            if change['method'] == 'addMachines' and
+            'containerType' in change['args'][0])
+        existing_machines = len(
+            set(str(i) for i in bundle.get('machines', {})) &
+            set(str(i) for i in (model or {}).get('machines', {})))
+        return changeset.Summary(
+            methods=dict(methods),
+            containers=dict(containers),
+            new_machines=(
+                methods['addMachines'] - sum(containers.values())),
+            existing_machines=existing_machines,
+        )
+
+    def assert_summary(self, bundle, model=None):
+        self.assertEqual(
+            self.get_summary(bundle, model=model),
+            changeset.summarize(bundle, model=model))
+
+    def test_summary(self):
+        self.assertEqual(
+            changeset.Summary(
+                methods={
+                    'addCharm': 3,
+                    'deploy': 3,
+                    'expose': 1,
+                    'setAnnotations': 2,
+                    'addMachines': 7,
+                    'addRelation': 2,
+                    'addUnit': 8,
+                },
+                containers={'lxc': 4, 'kvm': 1},
+                new_machines=2,
+                existing_machines=0),
+            changeset.summarize(_bundle))
+
+    def test_bundles(self):
+        bundles = [
+            _bundle,
+            TestCollapseMachines.bundle,
+            TestFuseChanges.bundle,
+            TestReduceRequires.bundle,
+            {'services': {}},
+        ]
+        for bundle in bundles:
+            self.assert_summary(bundle)
+
+    def test_legacy_bundle(self):
+        self.assert_summary({
+            'services': {
+                'wordpress': {
+                    'charm': 'cs:utopic/wordpress-0',
+                    'num_units': 1,
+                },
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 3,
+                    'to': ['lxc:wordpress', '0'],
+                },
+            },
+        })
+
+    def test_model(self):
+        self.assert_summary(
+            _bundle, model=TestParseWithModel.model)
+        self.assert_summary(
+            _bundle, model={'services': {'mysql': {'num_units': 5}}})
+
+    def test_units_are_not_generated(self):
+        bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 10**9,
+                    'to': ['lxd:new'],
+                },
+            },
+            'machines': {},
+        }
+        summary = changeset.summarize(bundle)
+        self.assertEqual(10**9, summary.methods['addUnit'])
+        self.assertEqual({'lxc': 10**9}, summary.containers)
+
+
+class TestParsePage(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'django': {
+                'charm': 'cs:trusty/django-42',
+                'num_units': 5,
+                'to': ['new', 'lxd:new'],
+            },
+            'haproxy': {
+                'charm': 'cs:trusty/haproxy-1',
+                'num_units': 5,
+                'to': ['lxc:django'],
+            },
+            'mysql': {
+                'charm': 'cs:trusty/mysql-47',
+                'num_units': 6,
+                'to': ['0', 'django'],
+            },
+            'rsyslog': {'charm': 'cs:trusty/rsyslog-1'},
+        },
+        'machines': {0: {}},
+        'relations': [['django', 'mysql']],
+    }
+
+    def assert_pages(self, bundle, model=None):
+        expected = list(changeset.parse(bundle, model=model))
+        for offset in range(len(expected) + 2):
+            for limit in range(1, 4):
+                page = changeset.parse_page(
+                    bundle, offset=offset, limit=limit, model=model)
+                self.assertEqual(
+                    expected[offset:offset + limit], page.changes,
+                    'offset {}, limit {}'.format(offset, limit))
+                next_offset = offset + limit
+                if next_offset >= len(expected):
+                    next_offset = None
+                self.assertEqual(next_offset, page.next_offset)
+
+    def test_pages(self):
+        self.assert_pages(self.bundle)
+
+    def test_bundles(self):
+        bundles = [
+            _bundle,
+            TestCollapseMachines.bundle,
+            TestReduceRequires.bundle,
+            {'services': {}},
+        ]
+        for bundle in bundles:
+            self.assert_pages(bundle)
+
+    def test_model(self):
+        self.assert_pages(_bundle, model=TestParseWithModel.model)
+        model = {'services': {'django': {'num_units': 3}}}
+        self.assert_pages(self.bundle, model=model)
+
+    def test_legacy_bundle(self):
+        self.assert_pages({
+            'services': {
+                'wordpress': {
+                    'charm': 'cs:utopic/wordpress-0',
+                    'num_units': 1,
+                },
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 3,
+                    'to': ['lxc:wordpress', '0'],
+                },
+            },
+        })
+
+    def test_iterate_pages(self):
+        changes, offset = [], 0
+        while offset is not None:
+            page = changeset.parse_page(self.bundle, offset=offset, limit=7)
+            changes.extend(page.changes)
+            offset = page.next_offset
+        self.assertEqual(list(changeset.parse(self.bundle)), changes)
+
+    def test_no_limit(self):
+        page = changeset.parse_page(self.bundle, offset=10)
+        self.assertEqual(list(changeset.parse(self.bundle))[10:], page.changes)
+        self.assertIsNone(page.next_offset)
+
+    def test_skip_units(self):
+        bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 10**9,
+                    'to': ['lxd:new'],
+                },
+            },
+            'machines': {},
+        }
+        page = changeset.parse_page(bundle, offset=2 * 10**9, limit=10)
+        self.assertEqual([
+            {
+                'id': 'addMachines-2000000001',
+                'method': 'addMachines',
+                'args': [{'containerType': 'lxc'}],
+                'requires': [],
+            },
+            {
+                'id': 'addUnit-1000000001',
+                'method': 'addUnit',
+                'args': ['$deploy-1', '$addMachines-2000000001'],
+                'requires': ['deploy-1', 'addMachines-2000000001'],
+            },
+        ], page.changes)
+        self.assertIsNone(page.next_offset)
+
+    def test_skip_placement_directives(self):
+        bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 4,
+                    'to': ['new', 'lxd:new', '0', 'lxd:0'],
+                },
+            },
+            'machines': {0: {}},
+        }
+        self.assert_pages(bundle)
+        with mock.patch(
+                'jujubundlelib.changeset._unit_placement_changes',
+                wraps=changeset._unit_placement_changes) as mock_placement:
+            page = changeset.parse_page(bundle, offset=9, limit=10)
+        # Only the last unit is built.
+        self.assertEqual(1, mock_placement.call_count)
+        self.assertEqual(['addUnit-6'], [c['id'] for c in page.changes])
+
+    def test_skip_placement_unit_out_of_range(self):
+        bundle = {
+            'services': {
+                'svc1': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 3,
+                    'to': ['svc2'],
+                },
+                'svc2': {
+                    'charm': 'cs:trusty/mysql-47',
+                    'num_units': 1,
+                },
+            },
+            'machines': {},
+        }
+        for offset in (0, 7):
+            with self.assertRaises(ValueError) as ctx:
+                changeset.parse_page(bundle, offset=offset, limit=10)
+            self.assertEqual(
+                b'placement refers to non-existent unit svc2/1',
+                ctx.exception.args[0])
+
+    def test_invalid_arguments(self):
+        for kwargs in ({'offset': -1}, {'limit': -1}):
+            with self.assertRaises(ValueError) as ctx:
+                changeset.parse_page(self.bundle, **kwargs)
+            self.assertEqual(
+                b'offset and limit must not be negative',
+                ctx.exception.args[0])
+
+
+class TestParseConcurrently(unittest.TestCase):
+
+    def make_bundle(self, index):
+        """Return a bundle whose content depends on the given index."""
+        services = {}
+        for i in range(index % 7 + 1):
+            services['service-{}-{}'.format(index, i)] = {
+                'charm': 'cs:trusty/django-{}'.format((index + i) % 3),
+                'num_units': (index + i) % 4,
+                'expose': bool(i % 2),
+                'to': [['lxc:new'], ['new'], ['0']][i % 3],
+            }
+        names = sorted(services)
+        return {
+            'services': services,
+            'machines': {0: {'series': 'trusty'}},
+            'relations': [[a, b] for a, b in zip(names, names[1:])],
+        }
+
+    def test_parse_concurrently(self):
+        bundles = [self.make_bundle(i) for i in range(2000)]
+        expected = [list(changeset.parse(bundle)) for bundle in bundles]
+        changes = changeset.parse_concurrently(bundles, max_workers=8)
+        self.assertEqual(expected, changes)
+
+    def test_same_bundle(self):
+        bundle = self.make_bundle(42)
+        original = copy.deepcopy(bundle)
+        changes = changeset.parse_concurrently([bundle] * 100, max_workers=8)
+        expected = list(changeset.parse(original))
+        self.assertEqual([expected] * 100, changes)
+        # The bundle has not been mutated.
+        self.assertEqual(original, bundle)
+
+    def test_no_bundles(self):
+        self.assertEqual([], changeset.parse_concurrently([]))
+
 
 class TestHandleServices(unittest.TestCase):
 
@@ -180,6 +1622,38 @@ class TestHandleServices(unittest.TestCase):
             ],
             cs.recv())
 
+    def test_equivalent_charm_urls(self):
+        cs = changeset.ChangeSet({
+            'services': {
+                'mysql-a': {'charm': 'cs:trusty/mysql-47'},
+                'mysql-b': {'charm': 'trusty/mysql-47'},
+                'mysql-c': {'charm': 'cs:trusty/mysql-47 '},
+                'mysql-d': {'charm': 'cs:trusty/mysql-48'},
+            }
+        })
+        changeset.handle_services(cs)
+        changes = cs.recv()
+        self.assertEqual(
+            ['addCharm-0', 'deploy-1', 'deploy-2', 'deploy-3', 'addCharm-4',
+             'deploy-5'],
+            [change['id'] for change in changes])
+        # The first URL is used to add the charm.
+        self.assertEqual(['cs:trusty/mysql-47'], changes[0]['args'])
+        self.assertEqual(['addCharm-0'], changes[3]['requires'])
+
+    def test_local_charms(self):
+        cs = changeset.ChangeSet({
+            'services': {
+                'django': {'charm': './charms/django'},
+                'haproxy': {'charm': './charms/django'},
+                'mysql': {'charm': '/charms/mysql'},
+            }
+        })
+        changeset.handle_services(cs)
+        self.assertEqual(
+            ['addCharm-0', 'deploy-1', 'deploy-2', 'addCharm-3', 'deploy-4'],
+            [change['id'] for change in cs.recv()])
+
     def test_no_services(self):
         cs = changeset.ChangeSet({'services': {}})
         changeset.handle_services(cs)
@@ -375,6 +1849,43 @@ class TestHandleUnits(unittest.TestCase):
         changeset.handle_units(cs)
         self.assertEqual([], cs.recv())
 
+    def test_placement_unit_out_of_range(self):
+        bundle = {
+            'services': {
+                'svc1': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 3,
+                    'to': ['kvm:svc2/0', 'svc2'],
+                },
+                'svc2': {'charm': 'cs:trusty/mysql-47', 'num_units': 1},
+            },
+            'machines': {},
+        }
+        for kwargs in ({}, {'int_ids': True}, {'stable_ids': True}):
+            with self.assertRaises(ValueError) as ctx:
+                list(changeset.parse(bundle, **kwargs))
+            self.assertEqual(
+                b'placement refers to non-existent unit svc2/1',
+                ctx.exception.args[0])
+
+    def test_placement_on_subordinate_service(self):
+        bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 1,
+                    'to': ['logger'],
+                },
+                'logger': {'charm': 'cs:trusty/logger-1'},
+            },
+            'machines': {},
+        }
+        with self.assertRaises(ValueError) as ctx:
+            list(changeset.parse(bundle))
+        self.assertEqual(
+            b'placement refers to non-existent unit logger/0',
+            ctx.exception.args[0])
+
     def test_unit_in_new_machine(self):
         cs = changeset.ChangeSet({
             'services': {
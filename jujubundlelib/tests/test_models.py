@@ -5,6 +5,8 @@ from __future__ import unicode_literals
 
 import unittest
 
+import mock
+
 from jujubundlelib import models
 from jujubundlelib.tests import helpers
 
@@ -135,3 +137,73 @@ class TestParseV4UnitPlacement(
         for test in tests:
             with self.assert_value_error(test['error'], test['about']):
                 models.parse_v4_unit_placement(test['placement'])
+
+
+class TestParseEndpoint(unittest.TestCase):
+
+    def test_service(self):
+        self.assertEqual(
+            models.Relation('mysql', ''), models.parse_endpoint('mysql'))
+
+    def test_service_and_interface(self):
+        self.assertEqual(
+            models.Relation('mysql', 'db'), models.parse_endpoint('mysql:db'))
+
+    def test_malformed(self):
+        self.assertEqual(
+            models.Relation('mysql:db:bad', ''),
+            models.parse_endpoint('mysql:db:bad'))
+
+
+class TestParseCache(helpers.ValueErrorTestsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.cache = models.ParseCache()
+
+    def test_placement(self):
+        self.assertEqual(
+            models.UnitPlacement('lxc', '', 'mysql', 1),
+            self.cache.placement('lxc:mysql/1', False))
+        self.assertEqual(
+            models.UnitPlacement('lxc', '', 'mysql', 1),
+            self.cache.placement('lxc:mysql=1', True))
+
+    def test_placement_legacy(self):
+        # The same placement is parsed differently for legacy bundles.
+        self.assertEqual(
+            models.UnitPlacement('', '', 'mysql=1', None),
+            self.cache.placement('mysql=1', False))
+        self.assertEqual(
+            models.UnitPlacement('', '', 'mysql', 1),
+            self.cache.placement('mysql=1', True))
+
+    def test_placement_memoized(self):
+        path = 'jujubundlelib.models.parse_v4_unit_placement'
+        with mock.patch(path) as mock_parse:
+            placement1 = self.cache.placement('new', False)
+            placement2 = self.cache.placement('new', False)
+        mock_parse.assert_called_once_with('new')
+        self.assertIs(placement1, placement2)
+
+    def test_placement_error(self):
+        path = 'jujubundlelib.models.parse_v4_unit_placement'
+        with mock.patch(path, side_effect=ValueError(b'bad wolf')):
+            with self.assert_value_error(b'bad wolf'):
+                self.cache.placement('bad', False)
+        # The error is memoized.
+        with self.assert_value_error(b'bad wolf'):
+            self.cache.placement('bad', False)
+
+    def test_endpoint(self):
+        endpoint = self.cache.endpoint('mysql:db')
+        self.assertEqual(models.Relation('mysql', 'db'), endpoint)
+        self.assertIs(endpoint, self.cache.endpoint('mysql:db'))
+
+    def test_reference(self):
+        reference = self.cache.reference('cs:trusty/mysql-47')
+        self.assertEqual('cs:trusty/mysql-47', reference.id())
+        self.assertIs(reference, self.cache.reference('cs:trusty/mysql-47'))
+
+    def test_reference_error(self):
+        with self.assertRaises(ValueError):
+            self.cache.reference('bad:wolf')
@@ -0,0 +1,110 @@
+# Copyright 2015 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+from __future__ import unicode_literals
+
+import unittest
+
+from jujubundlelib import (
+    changeset,
+    planner,
+)
+from jujubundlelib.tests import helpers
+
+
+class TestPlan(unittest.TestCase):
+
+    latencies = {
+        'addCharm': 1,
+        'addMachines': 10,
+        'addUnit': 5,
+        'deploy': 2,
+        'expose': 1,
+    }
+    changes = [
+        helpers.make_change('addCharm-0'),
+        helpers.make_change('deploy-1', 'addCharm-0'),
+        helpers.make_change('expose-2', 'deploy-1'),
+        helpers.make_change('addMachines-3'),
+        helpers.make_change('addMachines-4'),
+        helpers.make_change('addUnit-5', 'deploy-1', 'addMachines-3'),
+        helpers.make_change('addUnit-6', 'deploy-1', 'addMachines-4'),
+    ]
+
+    def test_unlimited_concurrency(self):
+        plan = planner.plan(self.changes, latencies=self.latencies)
+        self.assertEqual(['addMachines-3', 'addUnit-5'], plan.critical_path)
+        self.assertEqual(15, plan.critical_path_duration)
+        self.assertEqual(15, plan.makespan)
+        self.assertEqual([
+            planner.WaveStats(
+                ids=['addCharm-0', 'addMachines-3', 'addMachines-4'],
+                duration=10, utilization=0.7),
+            planner.WaveStats(ids=['deploy-1'], duration=2, utilization=1.0),
+            planner.WaveStats(
+                ids=['expose-2', 'addUnit-5', 'addUnit-6'],
+                duration=5, utilization=0.7333333333333333),
+        ], plan.waves)
+
+    def test_limited_concurrency(self):
+        plan = planner.plan(
+            self.changes, latencies=self.latencies, concurrency=1)
+        self.assertEqual(15, plan.critical_path_duration)
+        # All the changes are executed serially.
+        self.assertEqual(34, plan.makespan)
+        self.assertEqual(
+            [21, 2, 11], [wave.duration for wave in plan.waves])
+        self.assertEqual(
+            [1.0, 1.0, 1.0], [wave.utilization for wave in plan.waves])
+
+    def test_critical_path_precedence(self):
+        # With two slots, changes starting longer chains are executed first.
+        plan = planner.plan(
+            self.changes, latencies=self.latencies, concurrency=2)
+        self.assertEqual(19, plan.makespan)
+        self.assertEqual(
+            [11, 2, 6], [wave.duration for wave in plan.waves])
+
+    def test_bundle(self):
+        bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 2,
+                    'to': ['lxc:new'],
+                },
+            },
+            'machines': {},
+        }
+        plan = planner.plan(changeset.parse(bundle))
+        latencies = planner.DEFAULT_LATENCIES
+        expected_duration = latencies['addMachines'] + latencies['addUnit']
+        self.assertEqual(expected_duration, plan.critical_path_duration)
+        self.assertEqual(expected_duration, plan.makespan)
+        self.assertEqual(
+            ['addMachines', 'addUnit'],
+            [i.split('-')[0] for i in plan.critical_path])
+
+    def test_compact_changes(self):
+        changes = [changeset.Change.from_dict(c) for c in self.changes]
+        plan = planner.plan(changes, latencies=self.latencies)
+        self.assertEqual(15, plan.makespan)
+
+    def test_no_changes(self):
+        self.assertEqual(
+            planner.Plan(
+                critical_path=[], critical_path_duration=0, makespan=0,
+                waves=[]),
+            planner.plan([]))
+
+    def test_missing_latency(self):
+        with self.assertRaises(ValueError) as ctx:
+            planner.plan(self.changes, latencies={'addCharm': 1})
+        self.assertEqual(
+            b'no latency defined for method deploy', ctx.exception.args[0])
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError) as ctx:
+            planner.plan(self.changes, concurrency=0)
+        self.assertEqual(
+            b'concurrency must be a positive number', ctx.exception.args[0])
@@ -3,7 +3,11 @@
 
 from __future__ import unicode_literals
 
+from concurrent import futures
 import pprint
+import unittest
+
+import mock
 
 from jujubundlelib import validation
 
@@ -823,3 +827,320 @@ def _make_bundle_validation_check(about):
     inner.description = about
 
     return inner
+
+
+class TestValidateMaxErrors(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'django': {'num_units': 1},
+            'mysql': {'charm': 'cs:trusty/mysql-47', 'num_units': -1},
+            'rails': {'charm': 42},
+        },
+        'machines': {'1': {'constraints': 'bad wolf'}},
+    }
+
+    def test_all_errors(self):
+        self.assertEqual(5, len(validation.validate(self.bundle)))
+
+    def test_max_errors(self):
+        errors = validation.validate(self.bundle)
+        for max_errors in range(1, len(errors) + 2):
+            capped_errors = validation.validate(
+                self.bundle, max_errors=max_errors)
+            self.assertEqual(errors[:max_errors], capped_errors)
+
+    def test_fail_fast(self):
+        errors = validation.validate(self.bundle, fail_fast=True)
+        self.assertEqual(validation.validate(self.bundle)[:1], errors)
+
+    def test_fail_fast_valid_bundle(self):
+        bundle = {
+            'services': {
+                'django': {'charm': 'cs:trusty/django-42', 'num_units': 1},
+            },
+        }
+        self.assertEqual([], validation.validate(bundle, fail_fast=True))
+
+    def test_sections(self):
+        errors = validation.validate({'services': 42}, max_errors=1)
+        self.assertEqual(
+            ['services spec does not appear to be well-formed'], errors)
+
+    def test_invalid_max_errors(self):
+        with self.assertRaises(ValueError) as ctx:
+            validation.validate(self.bundle, max_errors=0)
+        self.assertEqual(
+            b'max_errors must be a positive number', ctx.exception.args[0])
+
+
+class TestStructuredErrors(unittest.TestCase):
+
+    bundle = {
+        'services': {
+            'django': {
+                'charm': 'cs:trusty/django-42',
+                'num_units': 1,
+                'to': ['1', '42'],
+                'constraints': 'bad-wolf',
+            },
+            'haproxy': {'charm': 'cs:haproxy'},
+        },
+        'machines': {1: {'series': 'bad wolf'}},
+        'relations': [['django', 'no-such']],
+    }
+
+    def test_structured(self):
+        errors = validation.validate(self.bundle, structured=True)
+        self.assertEqual([
+            ('constraints-invalid', '/services/django/constraints'),
+            ('endpoint-service-missing', '/relations/0/1'),
+            ('placement-machine-missing', '/services/django/to/1'),
+            ('placements-too-many', '/services/django/to'),
+            ('series-invalid', '/machines/1/series'),
+        ], sorted((error.code, error.path) for error in errors))
+
+    def test_strings(self):
+        errors = validation.validate(self.bundle, structured=True)
+        self.assertEqual(
+            ['{}'.format(error) for error in errors],
+            validation.validate(self.bundle))
+
+    def test_values(self):
+        errors = validation.validate(
+            {'services': {'django': {'charm': 'local:django'}}},
+            structured=True)
+        self.assertEqual(1, len(errors))
+        error = errors[0]
+        self.assertEqual('charm-local', error.code)
+        self.assertEqual(('services', 'django', 'charm'), error.parts)
+        self.assertEqual('django', error.values['service'])
+        self.assertEqual('local:django', '{}'.format(error.values['charm']))
+
+    def test_label(self):
+        error = validation.BundleError(
+            'series-invalid', ('machines', 1, 'series'), series='bad')
+        self.assertEqual(
+            'machine 1 has invalid series bad', '{}'.format(error))
+        error = validation.BundleError(
+            'series-invalid', ('series',), series='bad')
+        self.assertEqual('bundle has invalid series bad', '{}'.format(error))
+
+    def test_path_escaping(self):
+        error = validation.BundleError(
+            'charm-empty', ('services', 'a/b~c', 'charm'), service='a/b~c')
+        self.assertEqual('/services/a~1b~0c/charm', error.path)
+        error = validation.BundleError('bundle-malformed', ())
+        self.assertEqual('', error.path)
+
+    def test_equality(self):
+        error = validation.BundleError('charm-empty', ('a',), service='a')
+        self.assertEqual(
+            error, validation.BundleError('charm-empty', ('a',), service='a'))
+        self.assertNotEqual(
+            error, validation.BundleError('charm-empty', ('b',), service='a'))
+        self.assertEqual(
+            '<BundleError charm-empty: empty charm specified for service a>',
+            repr(error))
+
+
+class TestBundleValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.bundle = {
+            'services': {
+                'django': {
+                    'charm': 'cs:trusty/django-42',
+                    'num_units': 2,
+                    'to': ['1', 'lxc:haproxy/1'],
+                },
+                'haproxy': {'charm': 'cs:trusty/haproxy-1', 'num_units': 1},
+                'mysql': {'charm': 'cs:trusty/mysql-1', 'num_units': 1},
+            },
+            'machines': {'1': {'series': 'trusty'}, '2': {}},
+            'relations': [['django', 'mysql'], ['django', 'haproxy']],
+        }
+        self.validator = validation.BundleValidator(self.bundle)
+
+    def assert_errors(self, changed):
+        """Update the validator and check errors against validate()."""
+        self.validator.update(self.bundle, changed)
+        expected = validation.validate(self.bundle, structured=True)
+        errors = self.validator.errors(structured=True)
+        self.assertEqual(
+            sorted(expected, key=repr), sorted(errors, key=repr))
+        return errors
+
+    def test_errors(self):
+        self.assertEqual([
+            'placement lxc:haproxy/1 specifies a unit greater than the units '
+            'in service haproxy',
+            'machine 2 not referred to by a placement directive',
+        ], self.validator.errors())
+
+    def test_referenced_service_changed(self):
+        self.bundle['services']['haproxy']['num_units'] = 2
+        errors = self.assert_errors([('services', 'haproxy', 'num_units')])
+        self.assertEqual(['machine-unused'], [e.code for e in errors])
+
+    def test_service_removed(self):
+        del self.bundle['services']['mysql']
+        errors = self.assert_errors([('services', 'mysql')])
+        self.assertIn('endpoint-service-missing', [e.code for e in errors])
+
+    def test_service_added(self):
+        self.bundle['services']['wordpress'] = {
+            'charm': 'cs:trusty/wordpress-1', 'num_units': 1, 'to': ['2']}
+        self.bundle['relations'].append(['wordpress', 'mysql'])
+        self.assert_errors([('services', 'wordpress'), ('relations',)])
+
+    def test_machine_changed(self):
+        self.bundle['machines']['1']['series'] = 'precise'
+        errors = self.assert_errors([('machines', '1', 'series')])
+        self.assertIn('placement-series-mismatch', [e.code for e in errors])
+
+    def test_machine_removed(self):
+        del self.bundle['machines']['1']
+        errors = self.assert_errors([('machines', '1')])
+        self.assertIn('placement-machine-missing', [e.code for e in errors])
+
+    def test_relation_changed(self):
+        self.bundle['relations'][1] = ['django', 'no-such']
+        errors = self.assert_errors([('relations', 1)])
+        self.assertEqual('/relations/1/1', errors[-1].path)
+
+    def test_series_changed(self):
+        self.bundle['series'] = 'bad wolf'
+        self.assert_errors([('series',)])
+
+    def test_sections_changed(self):
+        self.bundle['machines'] = 42
+        self.assert_errors([('machines',)])
+        self.bundle['machines'] = {}
+        self.assert_errors([('machines',)])
+
+    def test_only_affected_entities(self):
+        self.bundle['services']['haproxy']['num_units'] = 2
+        with mock.patch(
+            'jujubundlelib.validation._validate_service',
+            wraps=validation._validate_service,
+        ) as mock_validate_service:
+            self.validator.update(self.bundle, [('services', 'haproxy')])
+        self.assertEqual(
+            ['django', 'haproxy'],
+            sorted(c[0][0] for c in mock_validate_service.call_args_list))
+
+
+class TestValidateProcesses(unittest.TestCase):
+
+    bundle = {
+        'services': dict(('service-{}'.format(i), {
+            'charm': 'cs:trusty/django-42' if i % 3 else 'local:django',
+            'num_units': 1,
+            'to': ['lxc:service-{}/{}'.format(i + 1, i % 2)],
+        }) for i in range(20)),
+        'machines': {1: {}, 2: {'series': 'bad wolf'}},
+        'relations': [['service-0', 'no-such']],
+    }
+
+    def test_same_errors(self):
+        expected = validation.validate(self.bundle, structured=True)
+        for processes in (1, 3, 30):
+            errors = validation.validate(
+                self.bundle, structured=True, processes=processes)
+            self.assertEqual(expected, errors)
+
+    def test_max_errors(self):
+        errors = validation.validate(self.bundle, max_errors=5, processes=2)
+        self.assertEqual(
+            validation.validate(self.bundle, max_errors=5), errors)
+
+    def test_legacy_bundle(self):
+        bundle = {'services': {
+            'django': {'charm': 'cs:trusty/django-42', 'num_units': 1},
+            'haproxy': {'charm': 'cs:haproxy', 'to': 'django=0'},
+        }}
+        self.assertEqual(
+            validation.validate(bundle),
+            validation.validate(bundle, processes=2))
+
+    def test_fail_fast_cancels_shards(self):
+        submitted = []
+
+        def submit(func, *args):
+            # Only run the first shard, leaving the others pending.
+            future = futures.Future()
+            if not submitted:
+                future.set_result(func(*args))
+            submitted.append(future)
+            return future
+
+        with mock.patch(
+                'jujubundlelib.validation.futures.ProcessPoolExecutor'
+        ) as mock_executor:
+            executor = mock_executor.return_value.__enter__.return_value
+            executor.submit.side_effect = submit
+            errors = validation.validate(
+                self.bundle, fail_fast=True, processes=4)
+        self.assertEqual(1, len(errors))
+        self.assertEqual(4, len(submitted))
+        self.assertEqual(
+            [False, True, True, True],
+            [future.cancelled() for future in submitted])
+
+    def test_invalid_processes(self):
+        with self.assertRaises(ValueError) as ctx:
+            validation.validate(self.bundle, processes=0)
+        self.assertEqual(
+            b'processes must be a positive number', ctx.exception.args[0])
+
+
+class TestFieldRules(unittest.TestCase):
+
+    def validate_service(self, **fields):
+        """Return the structured errors for a service with the given fields."""
+        errors = []
+        validation._validate_service_fields('django', fields, errors.append)
+        return errors
+
+    def test_valid(self):
+        self.assertEqual([], self.validate_service(
+            expose=False,
+            constraints=' cores=4  mem=8G\tarch=amd64 ',
+            storage={},
+            options={'debug': True},
+            annotations={'gui-x': 1},
+        ))
+        self.assertEqual([], self.validate_service(
+            constraints='cores=4,mem=8 G,spaces=a b'))
+
+    def test_constraints(self):
+        for constraints in (
+            'bad-wolf', 'mem=1=2', 'mem=1 bad=1 cpu=1', 'mem=1,', ' mem=1,x=1',
+        ):
+            errors = self.validate_service(constraints=constraints)
+            self.assertEqual([validation.BundleError(
+                'constraints-invalid', ('services', 'django', 'constraints'),
+                service='django', constraints=constraints,
+            )], errors, constraints)
+
+    def test_unhashable_choice(self):
+        errors = self.validate_service(expose=[True])
+        self.assertEqual(['expose-invalid'], [e.code for e in errors])
+
+    def test_rules_order(self):
+        errors = self.validate_service(
+            annotations={1: 'a'}, options=[], storage=42, expose='yes')
+        self.assertEqual([
+            'expose-invalid',
+            'storage-invalid',
+            'options-invalid',
+            'annotations-keys-invalid',
+        ], [e.code for e in errors])
+
+    def test_machine_series(self):
+        errors = []
+        validation._validate_machine_fields(1, {'series': 42}, errors.append)
+        self.assertEqual(
+            ['machine 1 series must be a string, found 42'],
+            ['{}'.format(e) for e in errors])
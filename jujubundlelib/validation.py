@@ -6,6 +6,10 @@ from __future__ import (
     unicode_literals,
 )
 
+import collections
+from concurrent import futures
+import re
+
 import jujubundlelib.models as models
 import jujubundlelib.pyutils as pyutils
 import jujubundlelib.references as references
@@ -33,33 +37,575 @@ _CONSTRAINTS = (
     'tags',
 )
 
+# Map error codes to the templates used to render error messages. Templates
+# can refer to the error values and to the label of the entity the error is
+# about, for instance "service django", "machine 1" or "bundle".
+MESSAGES = {
+    'bundle-malformed': 'bundle does not appear to be a bundle',
+    'services-missing': 'bundle does not define any services',
+    'services-malformed': 'services spec does not appear to be well-formed',
+    'machines-ids-invalid': 'machines spec identifiers must be digits',
+    'machines-malformed': 'machines spec does not appear to be well-formed',
+    'relations-malformed': 'relations spec does not appear to be well-formed',
+    'series-not-string': '{label} series must be a string, found {series}',
+    'series-bundle': '{label} series must specify a charm series',
+    'series-invalid': '{label} has invalid series {series}',
+    'service-name-invalid': 'service name {service} must be a string',
+    'expose-invalid': 'invalid expose value for service {service}',
+    'charm-missing': 'no charm specified for service {service}',
+    'charm-invalid': 'invalid charm specified for service {service}: {charm}',
+    'charm-empty': 'empty charm specified for service {service}',
+    'charm-local': 'local charms not allowed for service {service}: {charm}',
+    'charm-bundle': (
+        'bundle cannot be used as charm for service {service}: {charm}'),
+    'num-units-invalid': 'num_units for service {service} must be a digit',
+    'num-units-negative': (
+        'num_units {num_units} for service {service} must be a positive '
+        'digit'),
+    'constraints-invalid': '{label} has invalid constraints {constraints}',
+    'storage-invalid': (
+        'service {service} has invalid storage constraints {storage}'),
+    'options-invalid': 'service {service} has malformed options',
+    'annotations-invalid': '{label} has invalid annotations {annotations}',
+    'annotations-keys-invalid': (
+        '{label} has invalid annotations: keys must be strings'),
+    'placements-too-many': 'too many units placed for service {service}',
+    'placement-not-string': (
+        'invalid placement {placement}: placement must be a string'),
+    'placement-invalid': '{reason}',
+    'placement-service-missing': (
+        'placement {placement} refers to non-existent service {service}'),
+    'placement-unit-missing': (
+        'placement {placement} specifies a unit greater than the units in '
+        'service {service}'),
+    'placement-machine-missing': (
+        'placement {placement} refers to a non-existent machine {machine}'),
+    'placement-series-mismatch': (
+        'charm {charm} cannot be deployed to machine with different series '
+        '{series}'),
+    'machine-unused': (
+        'machine {machine} not referred to by a placement directive'),
+    'machine-id-invalid': (
+        'machine {machine} has an invalid id, must be positive digit'),
+    'machine-malformed': 'machine {machine} does not appear to be well-formed',
+    'relation-malformed': 'relation {relation} is malformed',
+    'endpoint-malformed': (
+        'relation {relation} has malformed endpoint {endpoint}'),
+    'endpoint-service-missing': (
+        'relation {relation} endpoint {endpoint} refers to a non-existent '
+        'service {service}'),
+}
+
+
+@pyutils.string_class
+class BundleError(object):
+    """A bundle validation error.
+
+    Errors are described by a code (see MESSAGES), the path of the offending
+    bundle component as a tuple of keys and indexes, and a dict of the
+    offending values. The human readable message is only rendered when the
+    error is converted to a string.
+    """
+
+    __slots__ = ('code', 'parts', 'values')
+
+    def __init__(self, code, parts, **values):
+        self.code = code
+        self.parts = parts
+        self.values = values
+
+    @property
+    def path(self):
+        """Return the JSON pointer to the offending bundle component."""
+        return ''.join(
+            '/' + '{}'.format(part).replace('~', '~0').replace('/', '~1')
+            for part in self.parts)
+
+    def __str__(self):
+        template = MESSAGES[self.code]
+        values = self.values
+        if '{label}' in template:
+            values = dict(values, label=self._label())
+        if 'relation' in values and islist(values['relation']):
+            values = dict(values, relation=' -> '.join(
+                '{}'.format(i) for i in values['relation']))
+        return template.format(**values)
+
+    def _label(self):
+        """Return the label of the entity this error is about."""
+        if len(self.parts) > 1:
+            if self.parts[0] == 'services':
+                return 'service {}'.format(self.parts[1])
+            if self.parts[0] == 'machines':
+                return 'machine {}'.format(self.parts[1])
+        return 'bundle'
+
+    def __repr__(self):
+        return '<BundleError {}: {}>'.format(self.code, self)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, self.__class__) and
+            self.code == other.code and
+            self.parts == other.parts and
+            self.values == other.values
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+
+# Define the declarative rules for the fields of services and machines, as a
+# dict mapping bundle sections to sequences of (field, kind, argument) tuples.
+# Rules are compiled into specialized validation functions at import time by
+# the compilers in _RULE_COMPILERS, keyed by rule kind. Fields are validated
+# in order, and only when present and not None.
+_FIELD_RULES = {
+    'services': (
+        ('expose', 'choice', (True, False)),
+        ('constraints', 'constraints', _CONSTRAINTS),
+        ('storage', 'mapping', None),
+        ('options', 'mapping', None),
+        ('annotations', 'annotations', None),
+    ),
+    'machines': (
+        ('constraints', 'constraints', _CONSTRAINTS),
+        ('series', 'series', None),
+        ('annotations', 'annotations', None),
+    ),
+}
+
+# Map bundle sections to the names of the entities they include.
+_ENTITIES = {'services': 'service', 'machines': 'machine'}
+
+
+def _compile_choice(field, choices):
+    """Return a check ensuring that a value is one of the given choices."""
+    choices = frozenset(choices)
+    code = '{}-invalid'.format(field)
+
+    def check(value):
+        try:
+            if value in choices:
+                return None
+        except TypeError:
+            # The value is not hashable.
+            pass
+        return code
+    return check
+
+
+def _compile_mapping(field, argument):
+    """Return a check ensuring that a value is a dict."""
+    code = '{}-invalid'.format(field)
+
+    def check(value):
+        if type(value) is not dict and not isdict(value):
+            return code
+    return check
+
+
+def _compile_constraints(field, keys):
+    """Return a check ensuring that a value is a valid constraints string.
+
+    Constraints are key=value pairs, with keys included in the given ones,
+    separated by commas or, if no commas are present, by spaces.
+    """
+    code = '{}-invalid'.format(field)
+    key = '(?:{})'.format('|'.join(
+        re.escape(k) for k in sorted(keys, key=len, reverse=True)))
+    match_commas = re.compile(
+        r'{key}=[^=,]*(?:,{key}=[^=,]*)*\Z'.format(key=key), re.UNICODE).match
+    match_spaces = re.compile(
+        r'\s*(?:{key}=[^=\s]*(?:\s+{key}=[^=\s]*)*)?\s*\Z'.format(key=key),
+        re.UNICODE).match
+
+    def check(value):
+        if not isstring(value):
+            return code
+        match = match_commas if ',' in value else match_spaces
+        if match(value) is None:
+            return code
+    return check
+
+
+def _compile_annotations(field, argument):
+    """Return a check ensuring that a value is a dict with string keys."""
+    code = '{}-invalid'.format(field)
+    keys_code = '{}-keys-invalid'.format(field)
+
+    def check(value):
+        if type(value) is not dict and not isdict(value):
+            return code
+        if not all(map(isstring, value)):
+            return keys_code
+    return check
+
+
+def _compile_series(field, argument):
+    """Return a check ensuring that a value is a valid charm series."""
+    return _series_error
+
+
+def _series_error(series):
+    """Return the error code for the given series, or None if it is valid."""
+    if not isstring(series):
+        return 'series-not-string'
+    if series == 'bundle':
+        return 'series-bundle'
+    if not references.valid_series(series):
+        return 'series-invalid'
+
+
+_RULE_COMPILERS = {
+    'annotations': _compile_annotations,
+    'choice': _compile_choice,
+    'constraints': _compile_constraints,
+    'mapping': _compile_mapping,
+    'series': _compile_series,
+}
+
+
+def _compile_field_rules(section):
+    """Return a function validating fields as described by _FIELD_RULES.
+
+    The returned function receives the name and the data of an entity in the
+    given bundle section, and the add_error callable used to register
+    validation errors. Error values include the entity name and the field.
+    """
+    entity = _ENTITIES[section]
+    checks = tuple(
+        (field, _RULE_COMPILERS[kind](field, argument))
+        for field, kind, argument in _FIELD_RULES[section])
+
+    def validate_fields(name, data, add_error):
+        get = data.get
+        for field, check in checks:
+            value = get(field)
+            if value is None:
+                continue
+            code = check(value)
+            if code is not None:
+                values = {entity: name, field: value}
+                add_error(BundleError(code, (section, name, field), **values))
+    return validate_fields
 
-def validate(bundle):
+
+_validate_service_fields = _compile_field_rules('services')
+_validate_machine_fields = _compile_field_rules('machines')
+
+
+class _TooManyErrors(Exception):
+    """Raised when the maximum number of validation errors is reached."""
+
+
+def validate(
+        bundle, parse_cache=None, max_errors=None, fail_fast=False,
+        structured=False, processes=None):
     """Validate a bundle object and all of its components.
 
     The bundle must be passed as a YAML decoded object.
+    A models.ParseCache can be provided in order to reuse the parsed bundle
+    components later, for instance when generating the change set.
+
+    If max_errors is not None, the validation process stops as soon as the
+    given number of errors is found. Passing fail_fast as True is the same as
+    passing max_errors as 1, and it is useful when only checking whether the
+    bundle is valid.
+
+    If processes is not None, services are split into shards validated by a
+    pool of the given number of processes, which is only worthwhile for very
+    large bundles. In this case, the results are the same but the parse cache
+    is not populated with the services charm URLs and placements.
 
     Return a list of bundle errors, or an empty list if the bundle is valid.
+    Errors are strings, or BundleError instances if structured is True.
+    Raise a ValueError if max_errors or processes are not positive numbers.
     """
+    if processes is not None and processes < 1:
+        raise ValueError(b'processes must be a positive number')
+    if fail_fast:
+        max_errors = 1
+    if parse_cache is None:
+        parse_cache = models.ParseCache()
     errors = []
     add_error = errors.append
+    if max_errors is not None:
+        if max_errors < 1:
+            raise ValueError(b'max_errors must be a positive number')
+        add_error = _make_add_error(errors, max_errors)
+    try:
+        _validate(bundle, errors, add_error, parse_cache, processes)
+    except _TooManyErrors:
+        pass
+    if structured:
+        return errors
+    # Return all the collected errors.
+    return ['{}'.format(error) for error in errors]
+
+
+def _validate(bundle, errors, add_error, parse_cache, processes=None):
+    """Validate a bundle, registering errors with the given add_error.
 
+    The given errors list is used to check whether errors were registered.
+    If processes is not None, services are validated by a process pool.
+    """
     # Check that the bundle sections are well formed.
     series, services, machines, relations = _validate_sections(
         bundle, add_error)
     # If there are errors already, there is no point in proceeding with the
     # validation process.
     if errors:
-        return errors
+        return
 
     # Validate each individual section.
-    _validate_series(series, 'bundle', add_error)
-    _validate_services(services, machines, add_error)
+    _validate_series(series, ('series',), add_error)
+    if processes is None:
+        _validate_services(services, machines, add_error, parse_cache)
+    else:
+        _validate_services_in_processes(
+            services, machines, add_error, processes)
     _validate_machines(machines, add_error)
-    _validate_relations(relations, services, add_error)
+    _validate_relations(relations, services, add_error, parse_cache)
 
-    # Return all the collected errors.
-    return errors
+
+def _make_add_error(errors, max_errors):
+    """Return an add_error callable storing errors in the given list.
+
+    The callable raises _TooManyErrors when max_errors errors are stored.
+    """
+    def add_error(error):
+        errors.append(error)
+        if len(errors) >= max_errors:
+            raise _TooManyErrors()
+    return add_error
+
+
+class BundleValidator(object):
+    """Incrementally validate a bundle while it is being edited.
+
+    The validator stores the errors of each service, machine and relation of
+    the bundle, together with the references between them: placement
+    directives referring to services and machines, and relation endpoints
+    referring to services. When the bundle is updated, only the entities
+    affected by the changed keys are validated again, and only the entities
+    with errors are visited when collecting the errors.
+
+    Errors are returned as in validate(), with unused machines sorted by id.
+    """
+
+    def __init__(self, bundle, parse_cache=None):
+        if parse_cache is None:
+            parse_cache = models.ParseCache()
+        self._parse_cache = parse_cache
+        self.reset(bundle)
+
+    def reset(self, bundle):
+        """Validate the whole given bundle, discarding all stored results."""
+        self._section_errors = []
+        self._series_errors = []
+        # Map entities to their errors. Only entities with errors are stored.
+        self._service_errors = {}
+        self._machine_errors = {}
+        self._relation_errors = {}
+        # Record the order in which services are found, so that errors can be
+        # sorted without walking all the services.
+        self._service_order = {}
+        # Map service names to the service names and machine ids referred to
+        # by their placement directives, and the other way around.
+        self._placements = {}
+        self._service_refs = collections.defaultdict(set)
+        self._machine_refs = collections.defaultdict(set)
+        self._unused_machines = set()
+        # Store the service names referred to by each relation, and map
+        # service names to the indexes of the relations referring to them.
+        self._relation_services = []
+        self._relation_refs = collections.defaultdict(set)
+        series, services, machines, relations = _validate_sections(
+            bundle, self._section_errors.append)
+        if self._section_errors:
+            return
+        self._services = services
+        self._machines = machines
+        self._validate_series(series)
+        for service_name in services:
+            self._validate_service(service_name)
+        for machine_id in machines or ():
+            self._validate_machine(machine_id)
+        self._validate_relations(relations)
+
+    def update(self, bundle, changed):
+        """Validate again the changed parts of the given bundle.
+
+        The bundle is the edited version of the last validated bundle, and
+        changed is an iterable of paths, as tuples of keys, to the bundle
+        components which have been added, modified or removed since then,
+        for instance [('services', 'django'), ('machines', '1', 'series')].
+        Services, machines and relations are identified by the first two keys
+        of each path, using the keys found in the bundle. Changes to other
+        top level sections cause the whole bundle to be validated again.
+        """
+        services = bundle.get('services', {}) if isdict(bundle) else None
+        machines = bundle.get('machines') if isdict(bundle) else None
+        relations = bundle.get('relations') if isdict(bundle) else None
+        if (
+            self._section_errors or
+            not services or
+            not isdict(services) or
+            (machines is None) != (self._machines is None) or
+            (machines is not None and not isdict(machines)) or
+            (relations is not None and not islist(relations))
+        ):
+            return self.reset(bundle)
+        self._services = services
+        relations = relations or []
+        service_names, machine_ids, relation_indexes = set(), set(), set()
+        all_relations = len(relations) != len(self._relation_services)
+        for path in changed:
+            section, key = path[0], path[1] if len(path) > 1 else None
+            if section == 'series':
+                self._validate_series(bundle.get('series'))
+            elif section == 'services' and key is not None:
+                service_names.add(key)
+                service_names.update(self._service_refs.get(key, ()))
+                relation_indexes.update(self._relation_refs.get(key, ()))
+            elif section == 'machines' and key is not None and (
+                    machines is not None):
+                try:
+                    machine_id = int(key)
+                except (TypeError, ValueError):
+                    return self.reset(bundle)
+                if key in machines:
+                    self._machines[machine_id] = machines[key]
+                else:
+                    self._machines.pop(machine_id, None)
+                machine_ids.add(machine_id)
+                service_names.update(self._machine_refs.get(machine_id, ()))
+            elif section == 'relations':
+                if key is None:
+                    all_relations = True
+                else:
+                    relation_indexes.add(key)
+            else:
+                return self.reset(bundle)
+        for service_name in service_names:
+            self._validate_service(service_name)
+        for machine_id in machine_ids:
+            self._validate_machine(machine_id)
+        if all_relations:
+            # The relations have been replaced, added or removed.
+            self._validate_relations(relations)
+        else:
+            for index in relation_indexes:
+                self._validate_relation(relations, index)
+
+    def errors(self, structured=False):
+        """Return the errors found in the current bundle.
+
+        Errors are strings, or BundleError instances if structured is True.
+        """
+        errors = list(self._section_errors)
+        if not errors:
+            errors.extend(self._series_errors)
+            for service_name in sorted(
+                    self._service_errors, key=self._service_order.get):
+                errors.extend(self._service_errors[service_name])
+            errors.extend(
+                _unused_machine_error(machine_id)
+                for machine_id in sorted(self._unused_machines))
+            for machine_id in sorted(self._machine_errors):
+                errors.extend(self._machine_errors[machine_id])
+            for index in sorted(self._relation_errors):
+                errors.extend(self._relation_errors[index])
+        if structured:
+            return errors
+        return ['{}'.format(error) for error in errors]
+
+    def _validate_series(self, series):
+        """Validate the bundle series."""
+        self._series_errors = []
+        _validate_series(series, ('series',), self._series_errors.append)
+
+    def _validate_service(self, service_name):
+        """Validate the given service and store its placement references."""
+        service_names, machine_ids = self._placements.pop(
+            service_name, ((), ()))
+        for name in service_names:
+            self._service_refs[name].discard(service_name)
+        for machine_id in machine_ids:
+            self._machine_refs[machine_id].discard(service_name)
+            self._check_unused_machine(machine_id)
+        self._service_errors.pop(service_name, None)
+        if service_name not in self._services:
+            # The service has been removed.
+            return
+        self._service_order.setdefault(service_name, len(self._service_order))
+        service = self._services[service_name]
+        errors = []
+        _validate_service(
+            service_name, service, self._services, self._machines,
+            errors.append, self._parse_cache)
+        if errors:
+            self._service_errors[service_name] = errors
+        service_names, machine_ids = self._placements[service_name] = (
+            _placement_references(
+                service.get('to', []), self._machines is None,
+                self._parse_cache))
+        for name in service_names:
+            self._service_refs[name].add(service_name)
+        for machine_id in machine_ids:
+            self._machine_refs[machine_id].add(service_name)
+            self._check_unused_machine(machine_id)
+
+    def _validate_machine(self, machine_id):
+        """Validate the machine with the given integer id."""
+        self._machine_errors.pop(machine_id, None)
+        self._check_unused_machine(machine_id)
+        if machine_id not in self._machines:
+            # The machine has been removed.
+            return
+        errors = []
+        _validate_machine(
+            machine_id, self._machines[machine_id], errors.append)
+        if errors:
+            self._machine_errors[machine_id] = errors
+
+    def _check_unused_machine(self, machine_id):
+        """Record whether the given machine is unused by placements."""
+        if machine_id in self._machines and (
+                not self._machine_refs.get(machine_id)):
+            self._unused_machines.add(machine_id)
+        else:
+            self._unused_machines.discard(machine_id)
+
+    def _validate_relations(self, relations):
+        """Validate all the given relations."""
+        relations = relations or []
+        self._relation_errors = {}
+        self._relation_services = [set() for _ in relations]
+        self._relation_refs.clear()
+        for index in range(len(relations)):
+            self._validate_relation(relations, index)
+
+    def _validate_relation(self, relations, index):
+        """Validate the relation at the given index in the given relations."""
+        for name in self._relation_services[index]:
+            self._relation_refs[name].discard(index)
+        relation = relations[index]
+        errors = []
+        _validate_relation(
+            index, relation, self._services, errors.append, self._parse_cache)
+        if errors:
+            self._relation_errors[index] = errors
+        else:
+            self._relation_errors.pop(index, None)
+        names = self._relation_services[index] = set()
+        if islist(relation):
+            names.update(
+                self._parse_cache.endpoint(endpoint).name
+                for endpoint in relation if isstring(endpoint))
+        for name in names:
+            self._relation_refs[name].add(index)
 
 
 def _validate_sections(bundle, add_error):
@@ -75,14 +621,14 @@ def _validate_sections(bundle, add_error):
     """
     # Check that the bundle itself is well formed.
     if not isdict(bundle):
-        add_error('bundle does not appear to be a bundle')
+        add_error(BundleError('bundle-malformed', ()))
         return None, None, None, None
     # Validate the services section.
     services = bundle.get('services', {})
     if not services:
-        add_error('bundle does not define any services')
+        add_error(BundleError('services-missing', ('services',)))
     elif not isdict(services):
-        add_error('services spec does not appear to be well-formed')
+        add_error(BundleError('services-malformed', ('services',)))
     # Validate the machines section.
     machines = bundle.get('machines')
     if machines is not None:
@@ -90,118 +636,230 @@ def _validate_sections(bundle, add_error):
             try:
                 machines = dict((int(k), v) for k, v in machines.items())
             except (TypeError, ValueError):
-                add_error('machines spec identifiers must be digits')
+                add_error(BundleError('machines-ids-invalid', ('machines',)))
         else:
-            add_error('machines spec does not appear to be well-formed')
+            add_error(BundleError('machines-malformed', ('machines',)))
     # Validate the relations section.
     relations = bundle.get('relations')
     if (relations is not None) and (not islist(relations)):
-        add_error('relations spec does not appear to be well-formed')
+        add_error(BundleError('relations-malformed', ('relations',)))
     return bundle.get('series'), services, machines, relations
 
 
-def _validate_series(series, label, add_error):
+def _validate_series(series, parts, add_error):
     """Check that the given series is valid.
 
-    Use the given label (e.g. "machine X" or just "bundle") to describe
+    Use the given path parts (e.g. ('machines', 1, 'series')) to describe
     possible errors.
     Use the given add_error callable to register validation error.
     """
     if series is None:
         return
-    if not isstring(series):
-        add_error('{} series must be a string, found {}'.format(label, series))
-        return
-    if series == 'bundle':
-        add_error('{} series must specify a charm series'.format(label))
-        return
-    if not references.valid_series(series):
-        add_error('{} has invalid series {}'.format(label, series))
+    code = _series_error(series)
+    if code is not None:
+        add_error(BundleError(code, parts, series=series))
 
 
-def _validate_services(services, machines, add_error):
+def _validate_services(services, machines, add_error, parse_cache):
     """Validate each service within the bundle.
 
     Receive the services and machines sections of the bundle.
-    Use the given add_error callable to register validation error.
+    Use the given add_error callable to register validation error, and the
+    given parse cache to parse charm URLs and placements.
+    """
+    machine_ids = set()
+    for service_name, service in services.items():
+        machine_ids.update(_validate_service(
+            service_name, service, services, machines, add_error,
+            parse_cache))
+    _validate_unused_machines(machines, machine_ids, add_error)
+
+
+def _validate_services_in_processes(services, machines, add_error, processes):
+    """Validate each service within the bundle using a process pool.
+
+    Services are split into one contiguous shard for each of the given number
+    of processes. Shards are validated against an index of the services, so
+    that workers do not receive the whole services section, and their errors
+    are registered in the same order as in _validate_services. When too many
+    errors are found, shards not yet being validated are cancelled.
     """
+    items = list(services.items())
+    size = max(1, -(-len(items) // processes))
+    shards = [items[i:i + size] for i in range(0, len(items), size)]
+    index = _services_index(services)
     machine_ids = set()
+    with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        results = [
+            executor.submit(_validate_services_shard, shard, index, machines)
+            for shard in shards]
+        try:
+            for result in results:
+                errors, ids = result.result()
+                for error in errors:
+                    add_error(error)
+                machine_ids.update(ids)
+        except _TooManyErrors:
+            # Do not wait for shards not yet started when leaving the pool.
+            for result in results:
+                result.cancel()
+            raise
+    _validate_unused_machines(machines, machine_ids, add_error)
+
 
+def _services_index(services):
+    """Return the services data required to validate placement directives.
+
+    The index maps service names to dicts only including the number of units.
+    """
+    index = {}
     for service_name, service in services.items():
-        if not isstring(service_name):
-            add_error('service name {} must be a string'.format(service_name))
-        if service.get('expose') not in (True, False, None):
-            add_error(
-                'invalid expose value for service {}'.format(service_name))
-        # Validate and retrieve the service charm URL and number of units.
-        charm = _validate_charm(service.get('charm'), service_name, add_error)
-        num_units = _validate_num_units(
-            service.get('num_units'), service_name, add_error)
-        # Validate service constraints and storage constraints.
-        label = 'service {}'.format(service_name)
-        _validate_constraints(service.get('constraints'), label, add_error)
-        _validate_storage(service.get('storage'), service_name, add_error)
-        # Validate service options and annotations.
-        _validate_options(service.get('options'), service_name, add_error)
-        _validate_annotations(service.get('annotations'), label, add_error)
-        # Retrieve and validate the service units placement.
-        placements = service.get('to', [])
-        if not islist(placements):
-            placements = [placements]
-        if (num_units is not None) and (len(placements) > num_units):
-            add_error(
-                'too many units placed for service {}'.format(service_name))
-        for placement in placements:
-            machine_id = _validate_placement(
-                placement, services, machines, charm, add_error)
-            machine_ids.add(machine_id)
+        if 'num_units' in service:
+            index[service_name] = {'num_units': service['num_units']}
+        else:
+            index[service_name] = {}
+    return index
 
-    if machines is not None:
-        # Notify unused machines.
-        unused = set(machines).difference(machine_ids)
-        for machine_id in unused:
-            add_error(
-                'machine {} not referred to by a placement directive'
-                ''.format(machine_id))
 
+def _validate_services_shard(items, services, machines):
+    """Validate the given (service name, service) pairs.
+
+    Receive the services index and the machines section of the bundle.
+    This is run in worker processes. Return the list of errors and the set of
+    machine ids the services units are placed on.
+    """
+    errors = []
+    machine_ids = set()
+    parse_cache = models.ParseCache()
+    for service_name, service in items:
+        machine_ids.update(_validate_service(
+            service_name, service, services, machines, errors.append,
+            parse_cache))
+    return errors, machine_ids
+
+
+def _validate_unused_machines(machines, machine_ids, add_error):
+    """Notify machines not included in the given placement machine ids.
+
+    Use the given add_error callable to register validation error.
+    """
+    if machines is None:
+        return
+    unused = set(machines).difference(machine_ids)
+    for machine_id in unused:
+        add_error(_unused_machine_error(machine_id))
+
+
+def _validate_service(
+        service_name, service, services, machines, add_error, parse_cache):
+    """Validate a single service.
+
+    Receive the service name and data, and the services and machines sections
+    of the bundle.
+    Use the given add_error callable to register validation error, and the
+    given parse cache to parse charm URLs and placements.
 
-def _validate_charm(url, service_name, add_error):
+    Return the set of machine ids the service units are placed on.
+    """
+    parts = ('services', service_name)
+    if not isstring(service_name):
+        add_error(BundleError(
+            'service-name-invalid', parts, service=service_name))
+    # Validate and retrieve the service charm URL and number of units.
+    charm = _validate_charm(
+        service.get('charm'), service_name, add_error, parse_cache)
+    num_units = _validate_num_units(
+        service.get('num_units'), service_name, add_error)
+    # Validate service exposure, constraints, storage, options and
+    # annotations.
+    _validate_service_fields(service_name, service, add_error)
+    # Retrieve and validate the service units placement.
+    placements = service.get('to', [])
+    if islist(placements):
+        placement_parts = [parts + ('to', i) for i in range(len(placements))]
+    else:
+        placements = [placements]
+        placement_parts = [parts + ('to',)]
+    if (num_units is not None) and (len(placements) > num_units):
+        add_error(BundleError(
+            'placements-too-many', parts + ('to',), service=service_name))
+    machine_ids = set()
+    for placement, placement_path in zip(placements, placement_parts):
+        machine_id = _validate_placement(
+            placement, services, machines, charm, add_error, parse_cache,
+            placement_path)
+        machine_ids.add(machine_id)
+    return machine_ids
+
+
+def _placement_references(placements, legacy, parse_cache):
+    """Return the services and machines referred to by the given placements.
+
+    Return a set of service names and a set of integer machine ids. Invalid
+    placement directives are ignored.
+    """
+    if not islist(placements):
+        placements = [placements]
+    service_names, machine_ids = set(), set()
+    for placement in placements:
+        if not isstring(placement):
+            continue
+        try:
+            unit_placement = parse_cache.placement(placement, legacy)
+        except ValueError:
+            continue
+        if unit_placement.service:
+            service_names.add(unit_placement.service)
+        elif (
+            unit_placement.machine and
+            not legacy and
+            (unit_placement.machine != 'new')
+        ):
+            machine_ids.add(int(unit_placement.machine))
+    return service_names, machine_ids
+
+
+def _unused_machine_error(machine_id):
+    """Return the error for a machine not used by any placement directive."""
+    return BundleError(
+        'machine-unused', ('machines', machine_id), machine=machine_id)
+
+
+def _validate_charm(url, service_name, add_error, parse_cache):
     """Validate the given charm URL.
 
     Use the given service name to describe possible errors.
-    Use the given add_error callable to register validation error.
+    Use the given add_error callable to register validation error, and the
+    given parse cache to parse the URL.
 
     If the URL is valid, return the corresponding charm reference object.
     Return None otherwise.
     """
+    parts = ('services', service_name, 'charm')
     if url is None:
-        add_error('no charm specified for service {}'.format(service_name))
+        add_error(BundleError('charm-missing', parts, service=service_name))
         return None
     if not isstring(url):
-        add_error(
-            'invalid charm specified for service {}: {}'
-            ''.format(service_name, url))
+        add_error(BundleError(
+            'charm-invalid', parts, service=service_name, charm=url))
         return None
     if not url.strip():
-        add_error('empty charm specified for service {}'.format(service_name))
+        add_error(BundleError('charm-empty', parts, service=service_name))
         return None
     try:
-        charm = references.Reference.from_string(url)
+        charm = parse_cache.reference(url)
     except ValueError as e:
         msg = pyutils.exception_string(e)
-        add_error(
-            'invalid charm specified for service {}: {}'
-            ''.format(service_name, msg))
+        add_error(BundleError(
+            'charm-invalid', parts, service=service_name, charm=msg))
         return None
     if charm.is_local():
-        add_error(
-            'local charms not allowed for service {}: {}'
-            ''.format(service_name, charm))
+        add_error(BundleError(
+            'charm-local', parts, service=service_name, charm=charm))
         return None
     if charm.is_bundle():
-        add_error(
-            'bundle cannot be used as charm for service {}: {}'
-            ''.format(service_name, charm))
+        add_error(BundleError(
+            'charm-bundle', parts, service=service_name, charm=charm))
         return None
     return charm
 
@@ -218,92 +876,31 @@ def _validate_num_units(num_units, service_name, add_error):
     if num_units is None:
         # This should be a subordinate charm.
         return 0
+    parts = ('services', service_name, 'num_units')
     try:
         num_units = int(num_units)
     except (TypeError, ValueError):
-        add_error(
-            'num_units for service {} must be a digit'.format(service_name))
+        add_error(BundleError(
+            'num-units-invalid', parts, service=service_name,
+            num_units=num_units))
         return
     if num_units < 0:
-        add_error(
-            'num_units {} for service {} must be a positive digit'
-            ''.format(num_units, service_name))
+        add_error(BundleError(
+            'num-units-negative', parts, service=service_name,
+            num_units=num_units))
         return
     return num_units
 
 
-def _validate_constraints(constraints, label, add_error):
-    """Validate the given service or machine constraints.
-
-    Use the given label (e.g. "machine X" or "service Y") to describe
-    possible errors.
-    Use the given add_error callable to register validation error.
-    """
-    if constraints is None:
-        return
-    msg = '{} has invalid constraints {}'.format(label, constraints)
-    if not isstring(constraints):
-        add_error(msg)
-        return
-    sep = ',' if ',' in constraints else None
-    for constraint in constraints.split(sep):
-        try:
-            key, value = constraint.split('=')
-        except (TypeError, ValueError):
-            add_error(msg)
-            return
-        if key not in _CONSTRAINTS:
-            add_error(msg)
-
-
-def _validate_storage(storage, service_name, add_error):
-    """Lazily validate the storage constraints, ensuring that they are a dict.
-
-    Use the given add_error callable to register validation error.
-    """
-    if storage is None:
-        return
-    if not isdict(storage):
-        msg = 'service {} has invalid storage constraints {}'.format(
-            service_name, storage)
-        add_error(msg)
-
-
-def _validate_options(options, service_name, add_error):
-    """Lazily validate the options, ensuring that they are a dict.
-
-    Use the given add_error callable to register validation error.
-    """
-    if options is None:
-        return
-    if not isdict(options):
-        add_error('service {} has malformed options'.format(service_name))
-
-
-def _validate_annotations(annotations, label, add_error):
-    """Check that the given service or machine annotations are valid.
-
-    Use the given label (e.g. "machine X" or "service Y") to describe
-    possible errors.
-    Use the given add_error callable to register validation error.
-    """
-    if annotations is None:
-        return
-    if not isdict(annotations):
-        add_error('{} has invalid annotations {}'.format(label, annotations))
-        return
-    # Check that all the annotations keys are strings.
-    if not all(map(isstring, annotations)):
-        add_error(
-            '{} has invalid annotations: keys must be strings'.format(label))
-
-
-def _validate_placement(placement, services, machines, charm, add_error):
+def _validate_placement(
+        placement, services, machines, charm, add_error, parse_cache,
+        parts=()):
     """Validate a placement directive against other services.
 
     Receive the placement (possibly as a string), the services and machines
-    bundle sections, the corresponding charm (or None if invalid) and the
-    add_error callable used to register validation errors.
+    bundle sections, the corresponding charm (or None if invalid), the
+    add_error callable used to register validation errors, the parse cache
+    used to parse the placement and the path parts of the placement.
 
     If applicable, also validate the placement of other machines within the
     bundle.
@@ -314,27 +911,23 @@ def _validate_placement(placement, services, machines, charm, add_error):
     Return the placement machine id if applicable, None otherwise.
     """
     if not isstring(placement):
-        add_error(
-            'invalid placement {}: placement must be a string'
-            ''.format(placement))
+        add_error(BundleError(
+            'placement-not-string', parts, placement=placement))
         return
     is_legacy_bundle = machines is None
     try:
-        if is_legacy_bundle:
-            # This is a v3 legacy bundle.
-            unit_placement = models.parse_v3_unit_placement(placement)
-            # This is a v4 new style bundle.
-        else:
-            unit_placement = models.parse_v4_unit_placement(placement)
+        unit_placement = parse_cache.placement(placement, is_legacy_bundle)
     except ValueError as e:
-        add_error(pyutils.exception_string(e))
+        add_error(BundleError(
+            'placement-invalid', parts, placement=placement,
+            reason=pyutils.exception_string(e)))
         return
     if unit_placement.service:
         service = services.get(unit_placement.service)
         if service is None:
-            add_error(
-                'placement {} refers to non-existent service {}'
-                ''.format(placement, unit_placement.service))
+            add_error(BundleError(
+                'placement-service-missing', parts, placement=placement,
+                service=unit_placement.service))
             return
         if unit_placement.unit is not None:
             try:
@@ -344,10 +937,9 @@ def _validate_placement(placement, services, machines, charm, add_error):
                 pass
             else:
                 if int(unit_placement.unit) + 1 > num_units:
-                    add_error(
-                        'placement {} specifies a unit greater than the units '
-                        'in service {}'
-                        ''.format(placement, unit_placement.service))
+                    add_error(BundleError(
+                        'placement-unit-missing', parts, placement=placement,
+                        service=unit_placement.service))
     elif (
         unit_placement.machine and
         not is_legacy_bundle and
@@ -357,9 +949,9 @@ def _validate_placement(placement, services, machines, charm, add_error):
         # A machine can be included in machines but its value can be None.
         # This is so that we are compatible with go-style YAML unmarshaling.
         if machine_id not in machines:
-            add_error(
-                'placement {} refers to a non-existent machine {}'
-                ''.format(placement, unit_placement.machine))
+            add_error(BundleError(
+                'placement-machine-missing', parts, placement=placement,
+                machine=unit_placement.machine))
             return
         machine = machines[machine_id]
         if not isdict(machine):
@@ -374,11 +966,11 @@ def _validate_placement(placement, services, machines, charm, add_error):
                 # If the machine series is invalid, ignore this check, as an
                 # error for the machine will be added elsewhere.
                 errors = []
-                _validate_series(series, '', errors.append)
+                _validate_series(series, (), errors.append)
                 if not errors:
-                    add_error(
-                        'charm {} cannot be deployed to machine with '
-                        'different series {}'.format(charm, series))
+                    add_error(BundleError(
+                        'placement-series-mismatch', parts, charm=charm,
+                        series=series))
         return machine_id
 
 
@@ -391,47 +983,56 @@ def _validate_machines(machines, add_error):
     if not machines:
         return
     for machine_id, machine in machines.items():
-        if machine_id < 0:
-            add_error(
-                'machine {} has an invalid id, must be positive digit'
-                ''.format(machine_id))
-        if machine is None:
-            continue
-        elif not isdict(machine):
-            add_error(
-                'machine {} does not appear to be well-formed'
-                ''.format(machine_id))
-            continue
-        label = 'machine {}'.format(machine_id)
-        _validate_constraints(machine.get('constraints'), label, add_error)
-        _validate_series(machine.get('series'), label, add_error)
-        _validate_annotations(machine.get('annotations'), label, add_error)
+        _validate_machine(machine_id, machine, add_error)
+
+
+def _validate_machine(machine_id, machine, add_error):
+    """Validate the given machine, identified by the given integer id.
+
+    Use the given add_error callable to register validation error.
+    """
+    parts = ('machines', machine_id)
+    if machine_id < 0:
+        add_error(BundleError('machine-id-invalid', parts, machine=machine_id))
+    if machine is None:
+        return
+    elif not isdict(machine):
+        add_error(BundleError('machine-malformed', parts, machine=machine_id))
+        return
+    _validate_machine_fields(machine_id, machine, add_error)
 
 
-def _validate_relations(relations, services, add_error):
+def _validate_relations(relations, services, add_error, parse_cache):
     """Validate relations, ensuring that the endpoints exist.
 
     Receive the relations and services bundle sections.
-    Use the given add_error callable to register validation error.
+    Use the given add_error callable to register validation error, and the
+    given parse cache to parse relation endpoints.
     """
     if not relations:
         return
-    for relation in relations:
-        if not islist(relation):
-            add_error('relation {} is malformed'.format(relation))
+    for index, relation in enumerate(relations):
+        _validate_relation(index, relation, services, add_error, parse_cache)
+
+
+def _validate_relation(index, relation, services, add_error, parse_cache):
+    """Validate the relation at the given index in the relations section.
+
+    Use the given add_error callable to register validation error, and the
+    given parse cache to parse relation endpoints.
+    """
+    parts = ('relations', index)
+    if not islist(relation):
+        add_error(BundleError('relation-malformed', parts, relation=relation))
+        return
+    for endpoint_index, endpoint in enumerate(relation):
+        if not isstring(endpoint):
+            add_error(BundleError(
+                'endpoint-malformed', parts + (endpoint_index,),
+                relation=relation, endpoint=endpoint))
             continue
-        relation_str = ' -> '.join('{}'.format(i) for i in relation)
-        for endpoint in relation:
-            if not isstring(endpoint):
-                add_error(
-                    'relation {} has malformed endpoint {}'
-                    ''.format(relation_str, endpoint))
-                continue
-            try:
-                service, _ = endpoint.split(':')
-            except ValueError:
-                service = endpoint
-            if service not in services:
-                add_error(
-                    'relation {} endpoint {} refers to a non-existent service '
-                    '{}'.format(relation_str, endpoint, service))
+        service = parse_cache.endpoint(endpoint).name
+        if service not in services:
+            add_error(BundleError(
+                'endpoint-service-missing', parts + (endpoint_index,),
+                relation=relation, endpoint=endpoint, service=service))
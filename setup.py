@@ -17,6 +17,7 @@ with open('README.rst') as readme_file:
 
 requirements = [
     'PyYAML>=3.11',
+    'futures>=3.1; python_version < "3"',
 ]
 
 test_requirements = [